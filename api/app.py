@@ -1,59 +1,421 @@
-from flask import Flask, request, jsonify
-import face_recognition
-import pickle
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, Response, g, request, jsonify
 import numpy as np
-from PIL import Image
+import io
 import os
+import struct
+import sys
+import threading
+import time
+
+# Startup is reported from here (the first thing gunicorn does in a worker)
+STARTED = time.perf_counter()
+
+# Shared modules (gallery.py, ...) live at the repo root
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+if ROOT_DIR not in sys.path:
+    sys.path.insert(0, ROOT_DIR)
+
+from detection import AdaptiveDetector
+from gallery import ENCODING_DIM, load_shared_gallery, resolve_gallery_path
+from gallery_index import INDEX_PATH, attach_index
+from imaging import decode_image, scale_locations
+import metrics
+from prototypes import PROTOTYPES_PATH, apply_gallery_mode
+from result_cache import ResultCache
+from sharding import (ShardedGallery, ShardsUnavailable, configured_shard_urls, decode_queries,
+                      match_payload)
 
 app = Flask(__name__)
 
-# Load encodings at startup
-encodings_path = os.path.join(os.path.dirname(__file__), '..', 'encodings.pkl')
+# /recognize_batch limits and the pool that decodes/detects the images of a batch
+MAX_BATCH_IMAGES = int(os.environ.get('MAX_BATCH_IMAGES', 32))
+batch_pool = ThreadPoolExecutor(max_workers=int(os.environ.get('BATCH_WORKERS', os.cpu_count() or 2)))
+batch_jobs = {'pending': 0}  # submitted to batch_pool and not finished yet
+batch_jobs_lock = threading.Lock()
+
+# /recognize_faces payload (edge clients): header, then one record per face.
+# Keep in sync with client/orangepi_client.py.
+FACES_MAGIC = b'FACE'
+FACES_VERSION = 1
+FACES_KIND_ENCODINGS = 0  # record: location, 128 float32 encoding
+FACES_KIND_CROPS = 1  # record: location, face box inside the crop, JPEG length, JPEG bytes
+FACES_HEADER = struct.Struct('>4sBBHHH')  # magic, version, kind, face count, frame width, height
+FACES_BOX = struct.Struct('>4H')  # top, right, bottom, left
+FACES_ENCODING = struct.Struct(f'>{ENCODING_DIM}f')
+FACES_CROP_SIZE = struct.Struct('>I')
+MAX_PAYLOAD_FACES = int(os.environ.get('MAX_PAYLOAD_FACES', 64))
+
+# Seconds between checks of the gallery files for changes (0 disables the watcher)
+GALLERY_WATCH_INTERVAL = float(os.environ.get('GALLERY_WATCH_INTERVAL', 5))
+# Token required by POST /admin/reload (the endpoint is disabled when unset)
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN')
+# Load the gallery and models in the background so / and the probes answer at
+# once (WARM_UP_ASYNC=0 loads them before the app is returned to the server)
+WARM_UP_ASYNC = os.environ.get('WARM_UP_ASYNC', '1') != '0'
+RETRY_AFTER = int(os.environ.get('RETRY_AFTER', 1))
+
+# Directory of the gallery files (a shard directory on shard nodes). Shard nodes
+# can skip the face models with MATCH_ONLY=1, they only answer /match
+GALLERY_DIR = os.path.abspath(os.environ.get('GALLERY_DIR', ROOT_DIR))
+MATCH_ONLY = os.environ.get('MATCH_ONLY', '0') == '1'
+MAX_MATCH_FACES = int(os.environ.get('MAX_MATCH_FACES', 1024))
+MAX_MATCH_K = 20
+# Front node: match against these shard nodes instead of a local gallery (see sharding.py)
+SHARD_URLS = configured_shard_urls()
+
+# Previous results by uploaded image bytes (RESULT_CACHE=0 disables), dropped
+# whenever the gallery generation changes
+result_cache = ResultCache()
+
+# Picks the detection resolution per image (DETECT_TARGET_MS budget, DETECT_ADAPTIVE=0 disables).
+# Uploads from different clients are unrelated, so one request's face sizes don't plan the next
+detector = AdaptiveDetector(face_history=False)
+
+# Served at /metrics; stage timings come from metrics.timed() in the handlers
+REQUEST_SECONDS = metrics.histogram('face_request_seconds', 'Request latency per endpoint', labels=('endpoint',))
+REQUESTS = metrics.counter('face_requests_total', 'Requests per endpoint and status', labels=('endpoint', 'status'))
+
+def gallery_signature():
+    """(path, size, mtime) of every file the loaded gallery is built from
+    (on a front node, the generations of the shards)"""
+    if SHARD_URLS:
+        return gallery.signature() if gallery is not None else None
+    paths = [resolve_gallery_path(GALLERY_DIR),
+             os.path.join(GALLERY_DIR, INDEX_PATH),
+             os.path.join(GALLERY_DIR, PROTOTYPES_PATH)]
+    signature = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            signature.append((path, stat.st_size, stat.st_mtime_ns))
+        except FileNotFoundError:
+            signature.append((path, None, None))
+    return tuple(signature)
+
+def gallery_source():
+    return ', '.join(SHARD_URLS) or resolve_gallery_path(GALLERY_DIR)
+
+def load_matcher():
+    """Load the gallery, its index and the configured gallery mode"""
+    if SHARD_URLS:
+        # Front node: the same shard connections, with fresh sizes and generations
+        sharded = gallery if isinstance(gallery, ShardedGallery) else ShardedGallery(SHARD_URLS)
+        sharded.refresh()
+        print(f"✅ Matching against {len(SHARD_URLS)} gallery shards")
+        return sharded
+    # Memory-mapped read-only: every gunicorn worker shares one copy via the page cache
+    loaded, mapped_path = load_shared_gallery(GALLERY_DIR)
+    print(f"✅ Gallery memory-mapped from {mapped_path}")
+    attach_index(loaded, GALLERY_DIR)
+    return apply_gallery_mode(loaded, GALLERY_DIR)
+
+# Set by warm_up(); None until the gallery is loaded
+gallery = None
+gallery_signature_loaded = None
+# Bumped on every successful swap; requests keep the snapshot they started with
+gallery_generation = 0
+gallery_loaded_at = None
+last_reload_error = None
+reload_lock = threading.Lock()
+
+# Filled in by warm_up(); readiness needs both the gallery and the face models
+startup = {'warming_up': True, 'models_loaded': False, 'error': None, 'seconds': {}}
+STARTUP_SECONDS = metrics.gauge('face_startup_seconds', 'Seconds each startup phase took', labels=('phase',))
+
+def warm_up():
+    """Load the gallery, then dlib and its models, so no request pays for either"""
+    global gallery, gallery_generation, gallery_loaded_at, gallery_signature_loaded
+    seconds = startup['seconds']
+    print(f"Loading face encodings from: {gallery_source()}")
+    start = time.perf_counter()
+    gallery_signature_loaded = gallery_signature()
+    try:
+        loaded = load_matcher()
+        gallery = loaded
+        gallery_generation += 1
+        gallery_loaded_at = time.time()
+        if SHARD_URLS:
+            gallery_signature_loaded = gallery_signature()
+        seconds['gallery'] = time.perf_counter() - start
+        print(f"✅ Loaded {len(loaded)} face encodings")
+        print(f"✅ Known people: {set(loaded.known_people)}")
+    except Exception as e:
+        # Keep serving (unhealthy); the watcher loads the gallery once it is fixed
+        startup['error'] = str(e)
+        print(f"❌ Error loading encodings: {e}")
+    
+    if MATCH_ONLY:
+        # Shard node: no detection or encoding here, only /match
+        print("✅ Match-only node, face models not loaded")
+    else:
+        try:
+            start = time.perf_counter()
+            import face_recognition
+            seconds['import'] = time.perf_counter() - start
+        
+            # A tiny detection and encoding loads the HOG detector, landmark and encoder models
+            start = time.perf_counter()
+            blank = np.zeros((100, 100, 3), dtype=np.uint8)
+            face_recognition.face_locations(blank)
+            face_recognition.face_encodings(blank, [(10, 90, 90, 10)])
+            seconds['models'] = time.perf_counter() - start
+            startup['models_loaded'] = True
+        except Exception as e:
+            startup['error'] = str(e)
+            print(f"❌ Error loading face models: {e}")
+    
+    startup['warming_up'] = False
+    seconds['total'] = time.perf_counter() - STARTED
+    for phase, value in seconds.items():
+        STARTUP_SECONDS.set(value, phase)
+    if is_ready():
+        phases = ', '.join(f"{phase} {value:.2f}s" for phase, value in seconds.items() if phase != 'total')
+        print(f"✅ Ready in {seconds['total']:.2f}s ({phases})")
+    
+    if GALLERY_WATCH_INTERVAL > 0:
+        threading.Thread(target=watch_gallery, name='gallery-watcher', daemon=True).start()
+
+def is_ready():
+    return gallery is not None and (startup['models_loaded'] or MATCH_ONLY)
+
+def startup_report():
+    return {
+        'warming_up': startup['warming_up'],
+        'error': startup['error'],
+        'seconds': {phase: round(value, 3) for phase, value in startup['seconds'].items()}
+    }
+
+def reload_gallery():
+    """Build the new gallery (and index) off to the side, then swap it in atomically"""
+    global gallery, gallery_generation, gallery_loaded_at, gallery_signature_loaded, last_reload_error
+    if not reload_lock.acquire(blocking=False):
+        return False  # a reload is already running
+    try:
+        signature = gallery_signature()
+        print(f"🔄 Reloading gallery from {gallery_source()}")
+        start = time.perf_counter()
+        new_gallery = load_matcher()
+        # Rebinding the global is atomic; in-flight requests hold the old object
+        gallery = new_gallery
+        gallery_generation += 1
+        gallery_loaded_at = time.time()
+        gallery_signature_loaded = signature
+        last_reload_error = None
+        print(f"✅ Gallery generation {gallery_generation}: {len(new_gallery)} face encodings "
+              f"({time.perf_counter() - start:.2f}s)")
+        return True
+    except Exception as e:
+        last_reload_error = str(e)
+        print(f"❌ Gallery reload failed, keeping generation {gallery_generation}: {e}")
+        return False
+    finally:
+        reload_lock.release()
+
+def watch_gallery():
+    # Only reload once the files stop changing for a full interval, so train.py
+    # rewriting encodings, index and prototypes one after another is one reload
+    previous = gallery_signature_loaded
+    while True:
+        time.sleep(GALLERY_WATCH_INTERVAL)
+        try:
+            if SHARD_URLS and gallery is None:
+                reload_gallery()  # front node whose shards were all down so far
+                continue
+            signature = gallery_signature()
+            if signature != gallery_signature_loaded and signature == previous:
+                reload_gallery()
+            previous = signature
+        except Exception as e:
+            print(f"❌ Gallery watcher error: {e}")
+
+if WARM_UP_ASYNC:
+    threading.Thread(target=warm_up, name='warm-up', daemon=True).start()
+else:
+    warm_up()
+
+metrics.GALLERY_SIZE.set_function(lambda: len(gallery) if gallery is not None else 0)
+metrics.QUEUE_DEPTH.set_function(lambda: batch_jobs['pending'], 'batch')
+
+def batch_job_done(future):
+    with batch_jobs_lock:
+        batch_jobs['pending'] -= 1
+
+def batch_map(fn, items):
+    """batch_pool.map that keeps count of the unfinished jobs for the queue depth gauge"""
+    futures = []
+    for item in items:
+        with batch_jobs_lock:
+            batch_jobs['pending'] += 1
+        future = batch_pool.submit(fn, item)
+        future.add_done_callback(batch_job_done)
+        futures.append(future)
+    return [future.result() for future in futures]
+
+@app.before_request
+def start_timer():
+    g.start = time.perf_counter()
+
+@app.after_request
+def record_request(response):
+    endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+    if endpoint != '/metrics':
+        REQUEST_SECONDS.observe(time.perf_counter() - g.start, endpoint)
+        REQUESTS.inc(1, endpoint, response.status_code)
+    return response
+
+def unavailable():
+    """Response for requests that need the gallery before it is loaded"""
+    if startup['warming_up']:
+        return jsonify({
+            'success': False,
+            'error': 'Warming up, retry shortly'
+        }), 503, {'Retry-After': str(RETRY_AFTER)}
+    return jsonify({
+        'success': False,
+        'error': 'Model not loaded'
+    }), 500
 
-print(f"Loading face encodings from: {encodings_path}")
-try:
-    with open(encodings_path, "rb") as f:
-        encodings = pickle.load(f)
-    print(f"✅ Loaded {len(encodings['encodings'])} face encodings")
-    print(f"✅ Known people: {set(encodings['names'])}")
-except Exception as e:
-    print(f"❌ Error loading encodings: {e}")
-    encodings = None
+def wants_timings():
+    """Per-stage timings in the response, asked for with ?timings=1"""
+    return request.args.get('timings', '').lower() in ('1', 'true', 'yes')
 
 @app.route('/', methods=['GET'])
 def home():
     return jsonify({
         'name': 'Face Recognition API',
         'version': '1.0',
-        'status': 'healthy' if encodings else 'unhealthy',
+        'status': 'healthy' if gallery is not None else 'starting' if startup['warming_up'] else 'unhealthy',
         'endpoints': {
             '/': 'GET - API info',
             '/health': 'GET - Health check',
-            '/recognize': 'POST - Recognize faces (multipart/form-data with "image" field)'
+            '/livez': 'GET - Liveness probe (200 as soon as the process serves)',
+            '/readyz': 'GET - Readiness probe (200 once the gallery and face models are loaded)',
+            '/admin/reload': 'POST - Reload the gallery in the background (X-Admin-Token header)',
+            '/recognize': 'POST - Recognize faces (multipart/form-data with "image" field)',
+            '/recognize_batch': 'POST - Recognize faces in several images (multipart "images" fields, '
+                                'or application/octet-stream of 4-byte big-endian length + image bytes, repeated)',
+            '/recognize_faces': 'POST - Match faces detected on the client (application/octet-stream '
+                                'of face encodings or face crops, see DEPLOYMENT.md)',
+            '/match': 'POST - Top-k gallery matches for face encodings (application/octet-stream of '
+                      'little-endian float32 encodings, ?k=1&tolerance=0.6), used by sharded front nodes',
+            '/metrics': 'GET - Prometheus metrics (stage latency histograms, faces per image, gallery size)'
         }
     })
 
+@app.route('/livez', methods=['GET'])
+def livez():
+    return jsonify({
+        'status': 'alive',
+        'uptime_seconds': round(time.perf_counter() - STARTED, 3)
+    })
+
+@app.route('/readyz', methods=['GET'])
+def readyz():
+    if not is_ready():
+        return jsonify({
+            'status': 'starting' if startup['warming_up'] else 'not ready',
+            'startup': startup_report()
+        }), 503, {'Retry-After': str(RETRY_AFTER)}
+    return jsonify({
+        'status': 'ready',
+        'startup': startup_report()
+    })
+
 @app.route('/health', methods=['GET'])
 def health():
-    if encodings is None:
+    if gallery is None:
+        if startup['warming_up']:
+            return jsonify({
+                'status': 'starting',
+                'startup': startup_report()
+            }), 503, {'Retry-After': str(RETRY_AFTER)}
         return jsonify({
             'status': 'unhealthy',
             'error': 'Encodings not loaded'
         }), 500
     
+    current = gallery
     return jsonify({
         'status': 'healthy',
-        'faces_loaded': len(encodings['encodings']),
-        'known_people': list(set(encodings['names']))
+        'ready': is_ready(),
+        'startup': startup_report(),
+        'faces_loaded': len(current),
+        'known_people': current.known_people,
+        'gallery_generation': gallery_generation,
+        'gallery_loaded_at': gallery_loaded_at,
+        'last_reload_error': last_reload_error,
+        'detection': detector.stats(),
+        'cache': result_cache.stats(),
+        **({'shards': current.stats()} if SHARD_URLS else {})
     })
 
-@app.route('/recognize', methods=['POST'])
-def recognize():
-    if encodings is None:
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/admin/reload', methods=['POST'])
+def admin_reload():
+    if not ADMIN_TOKEN or request.headers.get('X-Admin-Token') != ADMIN_TOKEN:
         return jsonify({
             'success': False,
-            'error': 'Model not loaded'
-        }), 500
+            'error': 'Forbidden'
+        }), 403
+    
+    threading.Thread(target=reload_gallery, name='gallery-reload', daemon=True).start()
+    return jsonify({
+        'success': True,
+        'message': 'Reload started',
+        'gallery_generation': gallery_generation
+    }), 202
+
+def detect_faces(decoded, timings=None):
+    """Locations (in full image coordinates) and encodings of the faces in a DecodedImage"""
+    # Uploads are decoded at up to DECODE_MAX_SIDE and detection may use a further
+    # downscaled copy; encodings are computed on the decoded image
+    with metrics.timed('detect', timings):
+        face_locations = detector.detect(decoded.rgb)
+    import face_recognition
+    with metrics.timed('encode', timings):
+        face_encodings = face_recognition.face_encodings(decoded.rgb, face_locations)
+    metrics.FACES_PER_IMAGE.observe(len(face_locations))
+    return scale_locations(face_locations, decoded.scale), face_encodings
+
+def mark_partial(result, matches):
+    """Flag a result matched without some gallery shards; True if it is complete"""
+    missing = getattr(matches, 'missing', None)
+    if missing:
+        result['partial'] = True
+        result['missing_shards'] = missing
+    return not missing
+
+def shards_unavailable(e):
+    return jsonify({
+        'success': False,
+        'error': str(e)
+    }), 503, {'Retry-After': str(RETRY_AFTER)}
+
+def face_result(location, match):
+    top, right, bottom, left = location
+    return {
+        'name': match.name,
+        'confidence': float(match.confidence),
+        'location': {
+            'top': int(top),
+            'right': int(right),
+            'bottom': int(bottom),
+            'left': int(left)
+        }
+    }
+
+@app.route('/recognize', methods=['POST'])
+def recognize():
+    # Generation first: reload_gallery bumps it after swapping the gallery, so
+    # results are never cached under a newer generation than they were made with
+    generation = gallery_generation
+    current = gallery  # snapshot, stays valid if a reload swaps the gallery
+    if current is None:
+        return unavailable()
     
     try:
         # Check if image is provided
@@ -64,67 +426,359 @@ def recognize():
             }), 400
         
         image_file = request.files['image']
+        data = image_file.read()
+        timings = {}
         
-        # Open and convert image
-        image = Image.open(image_file.stream)
-        if image.mode != 'RGB':
-            image = image.convert('RGB')
+        # Same (or practically same) image as before: reuse its result
+        with metrics.timed('cache', timings):
+            fingerprint = result_cache.fingerprint(data)
+            cached = result_cache.get_result(fingerprint, generation)
+        if cached is not None:
+            print(f"Cache hit: {cached['total_faces']} face(s)")
+            result = dict(cached, cached=True)
+            if wants_timings():
+                result['timings'] = timings
+            return jsonify(result)
         
-        image_array = np.array(image)
+        # Decode straight to detection size, upright
+        with metrics.timed('decode', timings):
+            decoded = decode_image(data)
+        width, height = decoded.size
         
-        print(f"Processing image: {image.width}x{image.height}")
+        print(f"Processing image: {width}x{height} (decoded at {decoded.scale:.2g}x)")
         
         # Detect faces
-        face_locations = face_recognition.face_locations(image_array, model="hog")
-        face_encodings = face_recognition.face_encodings(image_array, face_locations)
+        face_locations, face_encodings = detect_faces(decoded, timings)
         
         print(f"Found {len(face_encodings)} face(s)")
         
+        # Match all faces in one batched pass over the gallery
+        with metrics.timed('match', timings):
+            matches = current.match_faces(face_encodings, tolerance=0.6)
+        
         results = []
-        for (top, right, bottom, left), face_encoding in zip(face_locations, face_encodings):
-            # Match faces
-            matches = face_recognition.compare_faces(
-                encodings["encodings"], 
-                face_encoding,
-                tolerance=0.6
-            )
-            
-            name = "Unknown"
-            confidence = 0
-            
-            if True in matches:
-                face_distances = face_recognition.face_distance(
-                    encodings["encodings"], 
-                    face_encoding
-                )
-                best_match_index = np.argmin(face_distances)
-                if matches[best_match_index]:
-                    name = encodings["names"][best_match_index]
-                    confidence = (1 - face_distances[best_match_index]) * 100
-            
-            results.append({
-                'name': name,
-                'confidence': float(confidence),
-                'location': {
-                    'top': int(top),
-                    'right': int(right),
-                    'bottom': int(bottom),
-                    'left': int(left)
-                }
-            })
-            
-            print(f"  - {name} ({confidence:.1f}%)")
+        for location, match in zip(face_locations, matches):
+            results.append(face_result(location, match))
+            print(f"  - {match.name} ({match.confidence:.1f}%)")
+        
+        result = {
+            'success': True,
+            'faces': results,
+            'total_faces': len(results),
+            'image_size': {
+                'width': width,
+                'height': height
+            }
+        }
+        # Answers missing a shard are not cached, the next request asks it again
+        if mark_partial(result, matches):
+            result_cache.put_result(fingerprint, result, generation)
+        if wants_timings():
+            result = dict(result, timings=timings)
+        return jsonify(result)
         
+    except ShardsUnavailable as e:
+        return shards_unavailable(e)
+    except Exception as e:
+        print(f"Error: {str(e)}")
         return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+def read_packed_images(stream):
+    """Split a packed batch body: 4-byte big-endian length + image bytes, repeated"""
+    images = []
+    while True:
+        header = stream.read(4)
+        if not header:
+            return images
+        if len(header) < 4:
+            raise ValueError('Truncated length header in packed batch')
+        (size,) = struct.unpack('>I', header)
+        data = stream.read(size)
+        if len(data) < size:
+            raise ValueError('Truncated image in packed batch')
+        images.append(io.BytesIO(data))
+        if len(images) > MAX_BATCH_IMAGES:
+            return images
+
+def analyze_image(stream):
+    """Decode + detect + encode one image of a batch (runs in batch_pool)"""
+    try:
+        timings = {}
+        with metrics.timed('decode', timings):
+            decoded = decode_image(stream)
+        face_locations, face_encodings = detect_faces(decoded, timings)
+        return {
+            'size': decoded.size,
+            'locations': face_locations,
+            'encodings': face_encodings,
+            'timings': timings
+        }
+    except Exception as e:
+        return {'error': str(e)}
+
+def recognize_images(streams, map_fn=map, with_timings=False):
+    """Recognize several images: decode/detect each (via map_fn), then match
+    every face of every image with a single gallery call.
+    
+    Returns one /recognize-shaped result dict per image, in order (with
+    with_timings, each including its stage timings; the shared match is
+    reported as 'match' on every image).
+    """
+    generation = gallery_generation  # before the gallery, see recognize()
+    current = gallery  # snapshot, stays valid if a reload swaps the gallery
+    
+    # Images seen before are answered from the cache, only the rest are analyzed
+    datas = [stream.read() for stream in streams]
+    fingerprints = [result_cache.fingerprint(data) for data in datas]
+    cached = [result_cache.get_result(fingerprint, generation) for fingerprint in fingerprints]
+    todo = [i for i, hit in enumerate(cached) if hit is None]
+    analyzed = dict(zip(todo, map_fn(analyze_image, [io.BytesIO(datas[i]) for i in todo])))
+    
+    # One batched gallery match for every face in the batch
+    all_encodings = [enc for item in analyzed.values() if 'error' not in item for enc in item['encodings']]
+    match_timings = {}
+    with metrics.timed('match', match_timings):
+        matches = current.match_faces(all_encodings, tolerance=0.6)
+    remaining = iter(matches)
+    
+    results = []
+    for i, hit in enumerate(cached):
+        if hit is not None:
+            results.append(dict(hit, cached=True))
+            continue
+        item = analyzed[i]
+        if 'error' in item:
+            results.append({'success': False, 'error': item['error']})
+            continue
+        faces = [face_result(location, next(remaining)) for location in item['locations']]
+        result = {
+            'success': True,
+            'faces': faces,
+            'total_faces': len(faces),
+            'image_size': {
+                'width': item['size'][0],
+                'height': item['size'][1]
+            }
+        }
+        if not faces or mark_partial(result, matches):
+            result_cache.put_result(fingerprints[i], dict(result), generation)
+        if with_timings:
+            result['timings'] = dict(item['timings'], **match_timings)
+        results.append(result)
+    return results
+
+@app.route('/recognize_batch', methods=['POST'])
+def recognize_batch():
+    if gallery is None:
+        return unavailable()
+    
+    try:
+        if request.mimetype == 'multipart/form-data':
+            streams = [f.stream for f in request.files.getlist('images')]
+        elif request.mimetype == 'application/octet-stream':
+            streams = read_packed_images(request.stream)
+        else:
+            streams = []
+        
+        if not streams:
+            return jsonify({
+                'success': False,
+                'error': 'No images provided. Send form-data with one or more "images" fields '
+                         'or an application/octet-stream packed batch'
+            }), 400
+        
+        if len(streams) > MAX_BATCH_IMAGES:
+            return jsonify({
+                'success': False,
+                'error': f'Too many images, at most {MAX_BATCH_IMAGES} per batch'
+            }), 413
+        
+        print(f"Processing batch of {len(streams)} image(s)")
+        
+        results = recognize_images(streams, batch_map, with_timings=wants_timings())
+        for i, result in enumerate(results):
+            result['index'] = i
+        total_faces = sum(result.get('total_faces', 0) for result in results)
+        
+        print(f"Found {total_faces} face(s) in batch")
+        
+        return jsonify({
+            'success': True,
+            'results': results,
+            'total_images': len(results),
+            'total_faces': total_faces
+        })
+        
+    except ShardsUnavailable as e:
+        return shards_unavailable(e)
+    except ValueError as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 400
+    except Exception as e:
+        print(f"Error: {str(e)}")
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+def box_overlap(a, b):
+    """Intersection over union of two (top, right, bottom, left) boxes"""
+    height = min(a[2], b[2]) - max(a[0], b[0])
+    width = min(a[1], b[1]) - max(a[3], b[3])
+    inter = max(height, 0) * max(width, 0)
+    union = (a[2] - a[0]) * (a[1] - a[3]) + (b[2] - b[0]) * (b[1] - b[3]) - inter
+    return inter / union if union > 0 else 0.0
+
+def crop_face_box(crop, client_box):
+    """The face box to encode a crop on, framed like the detector the gallery was built with.
+    
+    Clients find faces with an OpenCV Haar cascade, whose boxes are larger and
+    sit lower on the face than dlib's HOG boxes, and the encoder's landmark
+    model expects the latter. So the crop (small, with margin) is searched with
+    HOG and the detection overlapping the client's box is used; the client's
+    box only if HOG finds nothing there.
+    """
+    import face_recognition
+    upsample = 1 if min(crop.shape[:2]) < 160 else 0
+    detected = face_recognition.face_locations(crop, number_of_times_to_upsample=upsample, model='hog')
+    best = max(detected, key=lambda box: box_overlap(box, client_box), default=None)
+    if best is None or box_overlap(best, client_box) == 0:
+        return client_box
+    return best
+
+def read_face_payload(data):
+    """Parse a /recognize_faces body into (frame size, locations, encodings).
+    
+    Encodings are taken as sent; crops are decoded, the face is re-detected
+    inside the small crop and encoded there, so neither kind needs a
+    full-frame decode or detection.
+    """
+    import face_recognition
+    if len(data) < FACES_HEADER.size:
+        raise ValueError('Truncated header in face payload')
+    magic, version, kind, count, width, height = FACES_HEADER.unpack_from(data)
+    if magic != FACES_MAGIC or version != FACES_VERSION:
+        raise ValueError('Not a face payload (bad magic or version)')
+    if count > MAX_PAYLOAD_FACES:
+        raise ValueError(f'Too many faces, at most {MAX_PAYLOAD_FACES} per request')
+    
+    offset = FACES_HEADER.size
+    locations, encodings = [], []
+    try:
+        for _ in range(count):
+            locations.append(FACES_BOX.unpack_from(data, offset))
+            offset += FACES_BOX.size
+            if kind == FACES_KIND_ENCODINGS:
+                encoding = np.array(FACES_ENCODING.unpack_from(data, offset), dtype=np.float32)
+                offset += FACES_ENCODING.size
+            elif kind == FACES_KIND_CROPS:
+                face_box = FACES_BOX.unpack_from(data, offset)
+                (size,) = FACES_CROP_SIZE.unpack_from(data, offset + FACES_BOX.size)
+                offset += FACES_BOX.size + FACES_CROP_SIZE.size
+                if offset + size > len(data):
+                    raise ValueError('Truncated crop in face payload')
+                try:
+                    # Full resolution, face_box is in crop pixels
+                    crop = decode_image(memoryview(data)[offset:offset + size], max_side=0).rgb
+                except Exception as e:
+                    raise ValueError(f'Bad face crop: {e}')
+                offset += size
+                crop_encodings = face_recognition.face_encodings(crop, [crop_face_box(crop, face_box)])
+                encoding = crop_encodings[0]
+            else:
+                raise ValueError(f'Unknown face payload kind {kind}')
+            if not np.all(np.isfinite(encoding)):
+                raise ValueError('Face encoding is not finite')
+            encodings.append(encoding)
+    except struct.error:
+        raise ValueError('Truncated face record in face payload')
+    return (width, height), locations, encodings
+
+@app.route('/recognize_faces', methods=['POST'])
+def recognize_faces():
+    generation = gallery_generation  # before the gallery, see recognize()
+    current = gallery  # snapshot, stays valid if a reload swaps the gallery
+    if current is None:
+        return unavailable()
+    
+    try:
+        timings = {}
+        # Crops are decoded and encoded here, encodings only unpacked
+        with metrics.timed('payload', timings):
+            (width, height), face_locations, face_encodings = read_face_payload(request.get_data())
+        metrics.FACES_PER_IMAGE.observe(len(face_locations))
+        
+        # Same matching as /recognize, minus the decode and detection
+        with metrics.timed('match', timings):
+            matches = current.match_faces(face_encodings, tolerance=0.6)
+        results = [face_result(location, match) for location, match in zip(face_locations, matches)]
+        
+        print(f"Matched {len(results)} client-side face(s)")
+        
+        result = {
             'success': True,
             'faces': results,
             'total_faces': len(results),
             'image_size': {
-                'width': image.width,
-                'height': image.height
+                'width': width,
+                'height': height
             }
+        }
+        mark_partial(result, matches)
+        if wants_timings():
+            result['timings'] = timings
+        return jsonify(result)
+        
+    except ShardsUnavailable as e:
+        return shards_unavailable(e)
+    except ValueError as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 400
+    except Exception as e:
+        print(f"Error: {str(e)}")
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+@app.route('/match', methods=['POST'])
+def match():
+    """Shard RPC: top-k matches of already computed encodings against the local gallery"""
+    generation = gallery_generation  # before the gallery, see recognize()
+    current = gallery
+    if current is None:
+        return unavailable()
+    
+    try:
+        k = min(max(int(request.args.get('k', 1)), 1), MAX_MATCH_K)
+        tolerance = float(request.args.get('tolerance', 0.6))
+        queries = decode_queries(request.get_data())
+        if len(queries) > MAX_MATCH_FACES:
+            raise ValueError(f'Too many faces, at most {MAX_MATCH_FACES} per request')
+        
+        with metrics.timed('match'):
+            matches = match_payload(current, queries, k, tolerance)
+        return jsonify({
+            'success': True,
+            'matches': matches,
+            'faces_loaded': len(current),
+            'gallery_generation': generation
         })
         
+    except ShardsUnavailable as e:
+        return shards_unavailable(e)
+    except ValueError as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 400
     except Exception as e:
         print(f"Error: {str(e)}")
         return jsonify({
@@ -0,0 +1,361 @@
+"""Async (ASGI) server mode for the recognition API.
+
+Same `/`, `/health` and `/recognize` contract as app.py, but requests go into a
+bounded queue and are micro-batched onto a small pool of inference workers:
+each worker takes up to ASYNC_MAX_BATCH requests, waiting at most
+ASYNC_MAX_WAIT_MS for the batch to fill, decodes/detects them and matches all
+their faces with one gallery call. When the queue is full requests are
+rejected straight away with 503 + Retry-After instead of piling up.
+
+Run with:
+    uvicorn api.async_app:app --host 0.0.0.0 --port 5000
+or
+    python api/async_app.py
+"""
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import io
+import json
+import os
+import sys
+import time
+
+from urllib.parse import parse_qs
+
+from werkzeug.formparser import parse_form_data
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+if ROOT_DIR not in sys.path:
+    sys.path.insert(0, ROOT_DIR)
+
+# Reuse the Flask app's gallery and recognition helpers (warms up in the background once)
+from api import app as flask_api
+import metrics
+
+MAX_BATCH_SIZE = int(os.environ.get('ASYNC_MAX_BATCH', 8))
+MAX_WAIT_MS = float(os.environ.get('ASYNC_MAX_WAIT_MS', 10))
+QUEUE_SIZE = int(os.environ.get('ASYNC_QUEUE_SIZE', 64))
+WORKERS = int(os.environ.get('ASYNC_WORKERS', os.cpu_count() or 2))
+REQUEST_TIMEOUT = float(os.environ.get('REQUEST_TIMEOUT', 60))
+RETRY_AFTER = int(os.environ.get('RETRY_AFTER', 1))
+MAX_BODY_BYTES = int(os.environ.get('MAX_BODY_BYTES', 32 * 1024 * 1024))
+
+
+class Overloaded(Exception):
+    pass
+
+
+class MicroBatcher:
+    """Bounded request queue drained in micro-batches by inference workers."""
+
+    def __init__(self, max_batch_size=MAX_BATCH_SIZE, max_wait_ms=MAX_WAIT_MS,
+                 queue_size=QUEUE_SIZE, workers=WORKERS):
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.queue_size = queue_size
+        self.workers = workers
+        self.queue = None
+        self.pool = None
+        self.tasks = []
+        self.batches = 0
+        self.rejected = 0
+
+    def start(self):
+        if self.tasks:
+            return
+        self.queue = asyncio.Queue(maxsize=self.queue_size)
+        metrics.QUEUE_DEPTH.set_function(self.queue.qsize, 'async')
+        self.pool = ThreadPoolExecutor(max_workers=self.workers)
+        self.tasks = [asyncio.ensure_future(self._worker()) for _ in range(self.workers)]
+        print(f"✅ Inference workers: {self.workers}, batch <= {self.max_batch_size}, "
+              f"wait <= {self.max_wait * 1000:.0f} ms, queue {self.queue_size}")
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+        if self.pool:
+            self.pool.shutdown(wait=False)
+
+    def submit(self, image_bytes):
+        """Queue one image; returns a future for its /recognize result."""
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+        try:
+            self.queue.put_nowait((image_bytes, future))
+        except asyncio.QueueFull:
+            self.rejected += 1
+            raise Overloaded()
+        return future
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            # Requests that already timed out on the client side are skipped
+            batch = [(data, future) for data, future in batch if not future.done()]
+            if not batch:
+                continue
+            self.batches += 1
+            try:
+                streams = [io.BytesIO(data) for data, _ in batch]
+                # Timings are cheap, recognize() drops them unless the client asked
+                results = await loop.run_in_executor(self.pool, flask_api.recognize_images, streams, map, True)
+            except flask_api.ShardsUnavailable as e:
+                # Answered 503 + Retry-After by the handler, like the Flask app does
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            except Exception as e:
+                results = [{'success': False, 'error': str(e)}] * len(batch)
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+    def stats(self):
+        return {
+            'queue_depth': self.queue.qsize() if self.queue else 0,
+            'queue_size': self.queue_size,
+            'max_batch_size': self.max_batch_size,
+            'max_wait_ms': self.max_wait * 1000,
+            'workers': self.workers,
+            'batches': self.batches,
+            'rejected': self.rejected
+        }
+
+
+batcher = MicroBatcher()
+
+
+async def read_body(receive):
+    body = bytearray()
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if len(body) > MAX_BODY_BYTES:
+            return None
+        if not message.get('more_body'):
+            return bytes(body)
+
+
+async def send_json(send, payload, status=200, headers=()):
+    await send_body(send, json.dumps(payload).encode(), b'application/json', status, headers)
+
+
+async def send_body(send, body, content_type, status=200, headers=()):
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', content_type),
+                    (b'content-length', str(len(body)).encode()), *headers]
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+def wants_timings(scope):
+    values = parse_qs(scope.get('query_string', b'').decode('latin-1')).get('timings', [''])
+    return values[0].lower() in ('1', 'true', 'yes')
+
+
+def parse_image_upload(scope, body):
+    """The "image" field of a multipart upload, parsed with werkzeug like Flask does."""
+    headers = {k.decode('latin-1').lower(): v.decode('latin-1') for k, v in scope['headers']}
+    environ = {
+        'REQUEST_METHOD': 'POST',
+        'CONTENT_TYPE': headers.get('content-type', ''),
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.input': io.BytesIO(body)
+    }
+    _, _, files = parse_form_data(environ)
+    if 'image' not in files:
+        return None
+    return files['image'].read()
+
+
+def home():
+    return {
+        'name': 'Face Recognition API',
+        'version': '1.0',
+        'status': 'healthy' if flask_api.gallery is not None
+                  else 'starting' if flask_api.startup['warming_up'] else 'unhealthy',
+        'server': 'async',
+        'endpoints': {
+            '/': 'GET - API info',
+            '/health': 'GET - Health check',
+            '/livez': 'GET - Liveness probe',
+            '/readyz': 'GET - Readiness probe',
+            '/recognize': 'POST - Recognize faces (multipart/form-data with "image" field)',
+            '/metrics': 'GET - Prometheus metrics'
+        }
+    }, 200
+
+
+def retry_header():
+    return [(b'retry-after', str(RETRY_AFTER).encode())]
+
+
+def livez():
+    return {
+        'status': 'alive',
+        'uptime_seconds': round(time.perf_counter() - flask_api.STARTED, 3)
+    }, 200
+
+
+def readyz():
+    if not flask_api.is_ready():
+        return {
+            'status': 'starting' if flask_api.startup['warming_up'] else 'not ready',
+            'startup': flask_api.startup_report()
+        }, 503, retry_header()
+    return {
+        'status': 'ready',
+        'startup': flask_api.startup_report()
+    }, 200
+
+
+def health():
+    gallery = flask_api.gallery
+    if gallery is None:
+        if flask_api.startup['warming_up']:
+            return {
+                'status': 'starting',
+                'startup': flask_api.startup_report()
+            }, 503, retry_header()
+        return {
+            'status': 'unhealthy',
+            'error': 'Encodings not loaded'
+        }, 500
+    return {
+        'status': 'healthy',
+        'ready': flask_api.is_ready(),
+        'startup': flask_api.startup_report(),
+        'faces_loaded': len(gallery),
+        'known_people': gallery.known_people,
+        'gallery_generation': flask_api.gallery_generation,
+        'gallery_loaded_at': flask_api.gallery_loaded_at,
+        'last_reload_error': flask_api.last_reload_error,
+        'detection': flask_api.detector.stats(),
+        'cache': flask_api.result_cache.stats(),
+        'batching': batcher.stats()
+    }, 200
+
+
+async def recognize(scope, receive, send):
+    if flask_api.gallery is None:
+        if flask_api.startup['warming_up']:
+            return await send_json(send, {'success': False, 'error': 'Warming up, retry shortly'},
+                                   503, retry_header())
+        return await send_json(send, {'success': False, 'error': 'Model not loaded'}, 500)
+
+    body = await read_body(receive)
+    if body is None:
+        return await send_json(send, {'success': False, 'error': 'Request body too large'}, 413)
+
+    try:
+        # Multipart parsing copies the whole body, keep it off the event loop
+        image_bytes = await asyncio.get_running_loop().run_in_executor(None, parse_image_upload, scope, body)
+    except Exception as e:
+        return await send_json(send, {'success': False, 'error': str(e)}, 400)
+    if image_bytes is None:
+        return await send_json(send, {
+            'success': False,
+            'error': 'No image provided. Send as form-data with key "image"'
+        }, 400)
+
+    start = time.perf_counter()
+    try:
+        future = batcher.submit(image_bytes)
+    except Overloaded:
+        return await send_json(send, {
+            'success': False,
+            'error': 'Server overloaded, retry later'
+        }, 503, retry_header())
+
+    try:
+        result = await asyncio.wait_for(future, REQUEST_TIMEOUT)
+    except asyncio.TimeoutError:
+        return await send_json(send, {'success': False, 'error': 'Recognition timed out'}, 504)
+    except flask_api.ShardsUnavailable as e:
+        return await send_json(send, {'success': False, 'error': str(e)}, 503, retry_header())
+
+    if not result['success']:
+        print(f"Error: {result['error']}")
+        return await send_json(send, result, 500)
+    if 'timings' in result:
+        result = dict(result)
+        timings = result.pop('timings')
+        if wants_timings(scope):
+            result['timings'] = dict(timings, queue=round((time.perf_counter() - start) * 1000
+                                                          - sum(timings.values()), 3))
+    print(f"Recognized {result['total_faces']} face(s) in {(time.perf_counter() - start) * 1000:.0f} ms")
+    await send_json(send, result)
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            batcher.start()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await batcher.stop()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    if scope['type'] != 'http':
+        return
+
+    path, method = scope['path'], scope['method']
+    start = time.perf_counter()
+    endpoint = path
+    response = {}
+
+    async def send(message, send=send):
+        if message['type'] == 'http.response.start':
+            response['status'] = message['status']
+        await send(message)
+
+    if path == '/' and method == 'GET':
+        await send_json(send, *home())
+    elif path == '/health' and method == 'GET':
+        await send_json(send, *health())
+    elif path == '/livez' and method == 'GET':
+        await send_json(send, *livez())
+    elif path == '/readyz' and method == 'GET':
+        await send_json(send, *readyz())
+    elif path == '/metrics' and method == 'GET':
+        return await send_body(send, metrics.render().encode(), b'text/plain; version=0.0.4')
+    elif path == '/recognize' and method == 'POST':
+        await recognize(scope, receive, send)
+    elif path in ('/', '/health', '/livez', '/readyz', '/metrics', '/recognize'):
+        endpoint = 'unmatched'
+        await send_json(send, {'success': False, 'error': 'Method not allowed'}, 405)
+    else:
+        endpoint = 'unmatched'
+        await send_json(send, {'success': False, 'error': 'Not found'}, 404)
+    # Same series as the Flask app records
+    flask_api.REQUEST_SECONDS.observe(time.perf_counter() - start, endpoint)
+    flask_api.REQUESTS.inc(1, endpoint, response.get('status', 500))
+
+
+if __name__ == '__main__':
+    import uvicorn
+
+    port = int(os.environ.get('PORT', 5001))
+    uvicorn.run(app, host='0.0.0.0', port=port)
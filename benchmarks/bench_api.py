@@ -0,0 +1,110 @@
+"""End-to-end /recognize latency percentiles under concurrent load.
+
+    python benchmarks/bench_api.py --concurrency 1 4 8 --requests 100
+    python benchmarks/bench_api.py --url http://localhost:5000
+
+By default the Flask app runs in-process through its test client with a
+synthetic gallery of --gallery-size faces (0 keeps the repo's encodings) and
+the result cache off, so every request does the full decode, detect, encode
+and match. With --url the requests go to a running server instead.
+"""
+import argparse
+import contextlib
+import io
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from common import percentiles, synthetic_gallery, test_image_paths, write_results
+
+
+def in_process_client(gallery_size, cache):
+    # Before the import: no watcher swapping our gallery, cache as requested
+    os.environ["GALLERY_WATCH_INTERVAL"] = "0"
+    os.environ.setdefault("RESULT_CACHE", "1" if cache else "0")
+    with contextlib.redirect_stdout(io.StringIO()):
+        from api import app as api_app
+    if gallery_size:
+        api_app.gallery, _ = synthetic_gallery(gallery_size)
+        api_app.gallery_generation += 1
+    local = threading.local()
+
+    def post(data):
+        # One test client per thread
+        if not hasattr(local, "client"):
+            local.client = api_app.app.test_client()
+        response = local.client.post("/recognize", data={"image": (io.BytesIO(data), "frame.jpg")},
+                                     content_type="multipart/form-data")
+        return response.status_code
+    return post
+
+
+def http_client(url):
+    session = requests.Session()
+
+    def post(data):
+        response = session.post(f"{url}/recognize", files={"image": ("frame.jpg", data, "image/jpeg")}, timeout=60)
+        return response.status_code
+    return post
+
+
+def run_load(post, images, concurrency, n_requests):
+    def one(i):
+        start = time.perf_counter()
+        status = post(images[i % len(images)])
+        return (time.perf_counter() - start) * 1000, status
+
+    start = time.perf_counter()
+    # The app prints a few lines per request, keep them out of the report
+    with contextlib.redirect_stdout(io.StringIO()), ThreadPoolExecutor(max_workers=concurrency) as pool:
+        samples = list(pool.map(one, range(n_requests)))
+    elapsed = time.perf_counter() - start
+    return {
+        "concurrency": concurrency,
+        "requests": n_requests,
+        "errors": sum(1 for _, status in samples if status != 200),
+        "requests_per_s": n_requests / elapsed,
+        **percentiles([ms for ms, _ in samples])
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 8])
+    parser.add_argument("--requests", type=int, default=50, help="requests per concurrency level")
+    parser.add_argument("--gallery-size", type=int, default=10000)
+    parser.add_argument("--cache", action="store_true", help="keep the result cache on (in-process only)")
+    parser.add_argument("--url", default=None, help="benchmark a running server instead of the in-process app")
+    parser.add_argument("--out", default=None)
+    args = parser.parse_args()
+
+    images = []
+    for path in test_image_paths():
+        with open(path, "rb") as f:
+            images.append(f.read())
+    if not images:
+        print("❌ No images in test_images/")
+        return
+
+    post = http_client(args.url.rstrip("/")) if args.url else in_process_client(args.gallery_size, args.cache)
+    with contextlib.redirect_stdout(io.StringIO()):
+        post(images[0])  # warm-up
+
+    results = []
+    for concurrency in args.concurrency:
+        row = run_load(post, images, concurrency, args.requests)
+        print(f"{concurrency:>3} concurrent: p50 {row['p50_ms']:.1f} ms  p90 {row['p90_ms']:.1f} ms  "
+              f"p99 {row['p99_ms']:.1f} ms  {row['requests_per_s']:.2f} req/s  {row['errors']} error(s)")
+        results.append(row)
+    write_results("api", {
+        "target": args.url or "in-process",
+        "gallery_size": None if args.url else args.gallery_size,
+        "levels": results
+    }, args.out)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""Decode time and peak memory of imaging.decode_image against the old full decode.
+
+    python benchmarks/bench_decode.py --max-side 1600 800
+
+"full" is what the API did before (PIL open, convert to RGB, np.array copy),
+which is also what face_recognition.load_image_file does. Peak memory is the
+growth of the peak RSS during one decode in a fresh process (Linux, where
+/proc/self/clear_refs can reset the peak); elsewhere it is reported as null.
+"""
+import argparse
+import io
+import multiprocessing
+
+import numpy as np
+from PIL import Image
+
+from common import percentiles, test_image_paths, time_ms, write_results
+from imaging import decode_image
+
+
+def full_decode(data):
+    image = Image.open(io.BytesIO(data))
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    return np.array(image)
+
+
+def _status_kb(field):
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(field):
+                return int(line.split()[1])
+    return None
+
+
+def _peak_in_child(fn, args):
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")  # reset VmHWM to the current RSS
+        before = _status_kb("VmRSS:")
+        fn(*args)
+        return (_status_kb("VmHWM:") - before) / 1024
+    except OSError:
+        return None
+
+
+def peak_memory_mb(fn, *args):
+    """Extra peak RSS while running fn(*args), None where it can't be measured.
+
+    Runs in a fresh process: memory freed by earlier decodes stays with the
+    allocator and would hide the growth.
+    """
+    with multiprocessing.get_context("spawn").Pool(1) as pool:
+        return pool.apply(_peak_in_child, (fn, args))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--max-side", type=int, nargs="+", default=[1600, 800])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--out", default=None)
+    args = parser.parse_args()
+
+    results = []
+    for path in test_image_paths():
+        with open(path, "rb") as f:
+            data = f.read()
+        size = Image.open(io.BytesIO(data)).size
+        full = percentiles(time_ms(full_decode, data, repeat=args.repeat))
+        full_mb = peak_memory_mb(full_decode, data)
+        print(f"{path.split('/')[-1]} ({size[0]}x{size[1]}): full {full['p50_ms']:.1f} ms"
+              + (f", {full_mb:.1f} MB" if full_mb is not None else ""))
+        row = {"image": path.split("/")[-1], "width": size[0], "height": size[1],
+               "full": dict(full, peak_mb=full_mb), "reduced": []}
+        for max_side in args.max_side:
+            decoded = decode_image(data, max_side)
+            reduced = percentiles(time_ms(decode_image, data, max_side, repeat=args.repeat))
+            reduced_mb = peak_memory_mb(decode_image, data, max_side)
+            saved = {
+                "max_side": max_side,
+                "decoded_width": decoded.rgb.shape[1],
+                "decoded_height": decoded.rgb.shape[0],
+                "peak_mb": reduced_mb,
+                "time_saved_ms": full["p50_ms"] - reduced["p50_ms"],
+                "memory_saved_mb": full_mb - reduced_mb if None not in (full_mb, reduced_mb) else None,
+                **reduced
+            }
+            print(f"  max side {max_side:>5}: {saved['decoded_width']}x{saved['decoded_height']} "
+                  f"{reduced['p50_ms']:.1f} ms (saves {saved['time_saved_ms']:.1f} ms"
+                  + (f", {saved['memory_saved_mb']:.1f} MB" if saved["memory_saved_mb"] is not None else "") + ")")
+            row["reduced"].append(saved)
+        results.append(row)
+    write_results("decode", results, args.out)
+
+
+if __name__ == "__main__":
+    main()
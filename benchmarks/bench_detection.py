@@ -0,0 +1,67 @@
+"""Detection and encoding throughput on test_images/ at different detail levels.
+
+    python benchmarks/bench_detection.py --details 0.25 0.5 1 2
+
+A detail level is what detection.py scans at (scale * 2 ** upsample, 2 being
+face_locations' default of full resolution plus one upsample). "adaptive" is
+AdaptiveDetector.detect as the API runs it. Encoding is always done on the
+full resolution image.
+"""
+import argparse
+
+import face_recognition
+
+from common import load_test_images, percentiles, time_ms, write_results
+from detection import AdaptiveDetector
+
+
+def bench_image(image, details, repeat):
+    detector = AdaptiveDetector()
+    rows = []
+    for detail in details:
+        samples = time_ms(detector._detect_at, image, detail, repeat=repeat)
+        rows.append({"detail": detail, "faces": len(detector._detect_at(image, detail)), **percentiles(samples)})
+
+    adaptive = AdaptiveDetector()
+    samples = time_ms(adaptive.detect, image, repeat=repeat)
+    locations = adaptive.detect(image)
+    rows.append({"detail": "adaptive", "faces": len(locations), "plan": adaptive.stats(), **percentiles(samples)})
+
+    encode = percentiles(time_ms(face_recognition.face_encodings, image, locations, repeat=repeat)) if locations else {}
+    return rows, encode, len(locations)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--details", type=float, nargs="+", default=[0.25, 0.5, 1.0, 2.0])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--out", default=None)
+    args = parser.parse_args()
+
+    images = load_test_images()
+    if not images:
+        print("❌ No images in test_images/")
+        return
+
+    results = []
+    for name, image in images:
+        h, w = image.shape[:2]
+        rows, encode, faces = bench_image(image, args.details, args.repeat)
+        print(f"{name} ({w}x{h})")
+        for row in rows:
+            print(f"  detail {row['detail']:>8}  {row['p50_ms']:8.1f} ms  "
+                  f"{1000 / max(row['p50_ms'], 1e-9):6.2f} img/s  {row['faces']} face(s)")
+        if encode:
+            print(f"  encoding {faces} face(s): {encode['p50_ms']:.1f} ms ({encode['p50_ms'] / faces:.1f} ms/face)")
+        results.append({
+            "image": name,
+            "width": w,
+            "height": h,
+            "detection": rows,
+            "encoding": dict(encode, faces=faces, ms_per_face=encode["p50_ms"] / faces) if encode else None
+        })
+    write_results("detection", results, args.out)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""Gallery load time and per-face match latency on synthetic galleries.
+
+    python benchmarks/bench_gallery.py --sizes 1000 10000 100000 1000000
+
+Load times cover the three ways a gallery is opened: the legacy pickle,
+a full .npz read and the memory-mapped .npz the servers use. Match latency
+is per face, for a single face and for a batch of faces from one frame.
+"""
+import argparse
+import os
+import pickle
+import tempfile
+import time
+
+from common import percentiles, synthetic_gallery, synthetic_queries, time_ms, write_results
+from gallery import load_gallery, save_gallery
+
+
+def bench_load(gallery, directory, legacy):
+    npz_path = os.path.join(directory, "encodings.npz")
+    save_gallery(gallery, npz_path)
+    row = {"npz_mb": os.path.getsize(npz_path) / 2**20}
+    row["load_npz"] = percentiles(time_ms(load_gallery, npz_path, repeat=3))
+    # Mapping is lazy, so also touch every row once as the first match would
+    row["load_mmap"] = percentiles(time_ms(lambda: load_gallery(npz_path, mmap=True).encodings.sum(), repeat=3))
+    if legacy:
+        pkl_path = os.path.join(directory, "encodings.pkl")
+        with open(pkl_path, "wb") as f:
+            pickle.dump(gallery.to_legacy_dict(), f)
+        row["load_pkl"] = percentiles(time_ms(load_gallery, pkl_path, repeat=3))
+    return row
+
+
+def bench_match(gallery, queries, batch):
+    samples = []
+    for start in range(0, len(queries) - batch + 1, batch):
+        t = time.perf_counter()
+        gallery.match_faces(queries[start:start + batch], tolerance=0.6)
+        samples.append((time.perf_counter() - t) * 1000 / batch)
+    return percentiles(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--queries", type=int, default=256)
+    parser.add_argument("--batch", type=int, default=8, help="faces per match call for the batched numbers")
+    parser.add_argument("--legacy-max", type=int, default=100000,
+                        help="largest gallery to also time as encodings.pkl (pickling is slow)")
+    parser.add_argument("--out", default=None)
+    args = parser.parse_args()
+
+    results = []
+    for size in args.sizes:
+        gallery, centres = synthetic_gallery(size)
+        queries = synthetic_queries(centres, args.queries)
+        with tempfile.TemporaryDirectory() as directory:
+            row = {"gallery_size": size, **bench_load(gallery, directory, size <= args.legacy_max)}
+        row["match_single"] = bench_match(gallery, queries, 1)
+        row[f"match_batch{args.batch}"] = bench_match(gallery, queries, args.batch)
+        print(f"{size:>8}  load npz {row['load_npz']['p50_ms']:.1f} ms  mmap {row['load_mmap']['p50_ms']:.1f} ms"
+              + (f"  pkl {row['load_pkl']['p50_ms']:.1f} ms" if "load_pkl" in row else "")
+              + f"  match {row['match_single']['p50_ms']:.3f} ms/face"
+              f" ({row[f'match_batch{args.batch}']['p50_ms']:.3f} ms/face batched)")
+        results.append(row)
+    write_results("gallery", results, args.out)
+
+
+if __name__ == "__main__":
+    main()
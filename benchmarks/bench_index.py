@@ -0,0 +1,76 @@
+"""Recall vs latency of the gallery indexes against exact search.
+
+    python benchmarks/bench_index.py --sizes 10000 100000 --kinds brute ivf hnsw
+    python benchmarks/bench_index.py --sizes 100000 --kinds brute fp16 int8 pq
+
+Recall@k is the fraction of the exact top-k rows an index returns; top-1 name
+agreement is what actually matters for recognition at the 0.6 tolerance.
+"""
+import argparse
+import time
+
+import numpy as np
+
+from common import percentiles, synthetic_gallery, synthetic_queries, write_results
+from gallery import ENCODING_DIM
+from gallery_index import INDEX_KINDS, make_index
+
+
+def bytes_per_face(index, n):
+    """Index structures plus the float32 rows it keeps in RAM (quantized indexes
+    only read their re-rank shortlist from the mapped matrix)."""
+    state = sum(np.asarray(value).nbytes for value in index.state().values())
+    rows = 0 if getattr(index, "quantized", False) else 4 * ENCODING_DIM
+    return rows + state / max(n, 1)
+
+
+def bench_index(gallery, queries, kind, k, exact_idx):
+    start = time.perf_counter()
+    index = make_index(kind).build(gallery.encodings)
+    build_s = time.perf_counter() - start
+
+    latencies, found = [], []
+    for q in queries:
+        t = time.perf_counter()
+        idx, _ = index.search(q[None, :], k)
+        latencies.append((time.perf_counter() - t) * 1000)
+        found.append(idx[0])
+
+    recall = np.mean([len(set(f) & set(e)) / len(e) for f, e in zip(found, exact_idx)])
+    top1 = np.mean([gallery.labels[f[0]] == gallery.labels[e[0]] if f[0] >= 0 else False
+                    for f, e in zip(found, exact_idx)])
+    return {
+        "kind": kind,
+        "build_s": build_s,
+        f"recall@{k}": float(recall),
+        "top1_name_agreement": float(top1),
+        "bytes_per_face": bytes_per_face(index, len(gallery)),
+        **percentiles(latencies),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 50000])
+    parser.add_argument("--kinds", nargs="+", default=list(INDEX_KINDS), choices=INDEX_KINDS)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("-k", type=int, default=10)
+    parser.add_argument("--out", default=None)
+    args = parser.parse_args()
+
+    results = []
+    for size in args.sizes:
+        gallery, centres = synthetic_gallery(size)
+        queries = synthetic_queries(centres, args.queries)
+        exact_idx, _ = gallery.exact_top_k(queries, args.k)
+        for kind in args.kinds:
+            row = {"gallery_size": size, **bench_index(gallery, queries, kind, args.k, exact_idx)}
+            print(f"{size:>8} {kind:>6}  build {row['build_s']:.2f}s  "
+                  f"recall@{args.k} {row[f'recall@{args.k}']:.3f}  p50 {row['p50_ms']:.3f} ms  "
+                  f"{row['bytes_per_face']:.0f} B/face")
+            results.append(row)
+    write_results("index", results, args.out)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""Training throughput (images/sec) of train.py's encoding pipeline.
+
+    python benchmarks/bench_train.py --copies 20 --workers 1 2 4
+
+Runs train.run_pipeline on copies of the test_images/ files (or the images
+under --training) with a throwaway checkpoint, so the real training state is
+never touched.
+"""
+import argparse
+import glob
+import os
+import shutil
+import tempfile
+import time
+
+from common import IMAGE_EXTENSIONS, test_image_paths, write_results
+from train import run_pipeline
+
+
+def training_images(directory, copies):
+    if directory:
+        return sorted(p for p in glob.glob(os.path.join(directory, "*", "*"))
+                      if p.lower().endswith(IMAGE_EXTENSIONS))
+    return test_image_paths() * copies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, os.cpu_count() or 1])
+    parser.add_argument("--copies", type=int, default=10, help="copies of each test image to encode")
+    parser.add_argument("--training", default=None, help="use training/<person>/<image> files from this directory")
+    parser.add_argument("--out", default=None)
+    args = parser.parse_args()
+
+    sources = training_images(args.training, args.copies)
+    if not sources:
+        print("❌ No images to train on")
+        return
+
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        # Distinct paths, run_pipeline skips paths it has already seen
+        paths = []
+        for i, source in enumerate(sources):
+            path = os.path.join(directory, f"{i:05d}{os.path.splitext(source)[1]}")
+            shutil.copyfile(source, path)
+            paths.append(path)
+
+        for workers in args.workers:
+            checkpoint = os.path.join(directory, f"checkpoint-{workers}.pkl")
+            start = time.perf_counter()
+            encoded = run_pipeline(paths, workers=workers, checkpoint_path=checkpoint)
+            elapsed = time.perf_counter() - start
+            row = {
+                "workers": workers,
+                "images": len(paths),
+                "faces": sum(len(codes) for codes in encoded.values()),
+                "seconds": elapsed,
+                "images_per_s": len(paths) / elapsed
+            }
+            print(f"{workers:>3} worker(s): {row['images_per_s']:.2f} img/s ({row['faces']} faces)")
+            results.append(row)
+    write_results("train", results, args.out)
+
+
+if __name__ == "__main__":
+    main()
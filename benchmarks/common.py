@@ -0,0 +1,103 @@
+"""Helpers shared by the benchmark scripts (synthetic galleries, JSON output)."""
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import numpy as np
+from PIL import Image
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+if ROOT_DIR not in sys.path:
+    sys.path.insert(0, ROOT_DIR)
+
+TEST_IMAGES_DIR = os.path.join(ROOT_DIR, "test_images")
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+
+from gallery import FaceGallery
+
+
+def synthetic_gallery(n_faces, n_people=None, spread=0.05, seed=0):
+    """Random clustered 128-d gallery: one centre per person, noisy samples around it.
+
+    Returns the gallery plus the per-person centres, which make good queries.
+    """
+    rng = np.random.default_rng(seed)
+    n_people = n_people or max(1, n_faces // 10)
+    centres = rng.normal(0, 0.09, (n_people, 128)).astype(np.float32)
+    labels = rng.integers(0, n_people, n_faces)
+    encodings = centres[labels] + rng.normal(0, spread, (n_faces, 128)).astype(np.float32)
+    names = [f"person_{i}" for i in range(n_people)]
+    return FaceGallery(encodings, labels, names), centres
+
+
+def synthetic_queries(centres, n_queries, spread=0.05, seed=1):
+    rng = np.random.default_rng(seed)
+    picks = rng.integers(0, len(centres), n_queries)
+    return centres[picks] + rng.normal(0, spread, (n_queries, 128)).astype(np.float32)
+
+
+def percentiles(samples_ms):
+    samples_ms = np.asarray(samples_ms, dtype=np.float64)
+    if len(samples_ms) == 0:
+        return {}
+    return {
+        "mean_ms": float(samples_ms.mean()),
+        "p50_ms": float(np.percentile(samples_ms, 50)),
+        "p90_ms": float(np.percentile(samples_ms, 90)),
+        "p99_ms": float(np.percentile(samples_ms, 99)),
+    }
+
+
+def test_image_paths(directory=TEST_IMAGES_DIR):
+    """Input images in test_images/ (recognize.py's *_output files are skipped)."""
+    return [os.path.join(directory, name) for name in sorted(os.listdir(directory))
+            if name.lower().endswith(IMAGE_EXTENSIONS) and "_output" not in name]
+
+
+def load_test_images(directory=TEST_IMAGES_DIR):
+    """[(file name, RGB array)] for the images in test_images/."""
+    return [(os.path.basename(path), np.array(Image.open(path).convert("RGB")))
+            for path in test_image_paths(directory)]
+
+
+def time_ms(fn, *args, repeat=5):
+    """Latencies in ms of `repeat` calls of fn(*args), after one warm-up call."""
+    fn(*args)
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(*args)
+        samples.append((time.perf_counter() - start) * 1000)
+    return samples
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       cwd=ROOT_DIR, text=True).strip()
+    except Exception:
+        return None
+
+
+def write_results(name, results, out_path=None):
+    """Print results and write them as JSON (benchmarks/results/<name>.json by default)."""
+    payload = {
+        "benchmark": name,
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "results": results,
+    }
+    if out_path is None:
+        out_dir = os.path.join(ROOT_DIR, "benchmarks", "results")
+        os.makedirs(out_dir, exist_ok=True)
+        out_path = os.path.join(out_dir, f"{name}.json")
+    with open(out_path, "w") as f:
+        json.dump(payload, f, indent=2)
+    print(f"✅ Results written to {out_path}")
+    return out_path
@@ -0,0 +1,64 @@
+"""Compare two benchmark result files, e.g. from two commits.
+
+    git stash && python benchmarks/bench_gallery.py --out before.json && git stash pop
+    python benchmarks/bench_gallery.py --out after.json
+    python benchmarks/compare.py before.json after.json
+
+Every timing (keys ending in _ms / _s) and rate (keys ending in _per_s)
+present in both files is listed with its relative change. Changes beyond
+--threshold in the wrong direction are flagged, and the exit status is 1
+if there are any.
+"""
+import argparse
+import json
+import sys
+
+
+def flatten(value, prefix=""):
+    """{"results.0.load_npz.p50_ms": 1.2, ...} for the numeric leaves of a result."""
+    if isinstance(value, dict):
+        items = value.items()
+    elif isinstance(value, list):
+        items = enumerate(value)
+    else:
+        return {prefix: value} if isinstance(value, (int, float)) and not isinstance(value, bool) else {}
+    flat = {}
+    for key, item in items:
+        flat.update(flatten(item, f"{prefix}.{key}" if prefix else str(key)))
+    return flat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("before")
+    parser.add_argument("after")
+    parser.add_argument("--threshold", type=float, default=0.10, help="relative change that counts as a regression")
+    args = parser.parse_args()
+
+    with open(args.before) as f:
+        before = json.load(f)
+    with open(args.after) as f:
+        after = json.load(f)
+    print(f"{before['benchmark']}: {before.get('commit')} -> {after.get('commit')}")
+
+    old, new = flatten(before["results"]), flatten(after["results"])
+    regressions = 0
+    for key in old:
+        higher_is_better = key.endswith("_per_s")
+        if key not in new or not (higher_is_better or key.endswith(("_ms", "_s"))) or old[key] == 0:
+            continue
+        change = (new[key] - old[key]) / old[key]
+        worse = -change if higher_is_better else change
+        flag = ""
+        if worse > args.threshold:
+            flag = "  ⚠️  regression"
+            regressions += 1
+        print(f"  {key:<50} {old[key]:>12.3f} -> {new[key]:>12.3f}  {change:+7.1%}{flag}")
+    if regressions:
+        print(f"❌ {regressions} regression(s) beyond {args.threshold:.0%}")
+        sys.exit(1)
+    print("✅ No regressions")
+
+
+if __name__ == "__main__":
+    main()
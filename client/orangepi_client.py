@@ -5,30 +5,66 @@ import cv2
 import time
 from datetime import datetime
 import os
+import struct
+import sys
 from dotenv import load_dotenv
 load_dotenv()
 
+# the motion gate (motion.py) lives at the repo root, see make_motion_gate
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+from upload_engine import UploadEngine
+
 # grab the api url from env or just use localhost
 API_URL = os.getenv('API_URL', 'http://localhost:5001')
 
+# MOTION_GATE=0 uploads every frame like before
+MOTION_GATE = os.getenv('MOTION_GATE', '1') != '0'
+# upload the whole frame instead of crops once this much of it changed
+FULL_FRAME_SHARE = float(os.getenv('FULL_FRAME_SHARE', 0.5))
+MAX_REGIONS = 8
+# check the full frame anyway after this many unchanged frames (0 = never)
+MOTION_FORCE_EVERY = int(os.getenv('MOTION_FORCE_EVERY', 0))
+JPEG_QUALITY = int(os.getenv('JPEG_QUALITY', 90))
+
+# stream mode: uploads in flight at once, and the on-disk buffer for when the api is down
+UPLOAD_IN_FLIGHT = int(os.getenv('UPLOAD_IN_FLIGHT', 4))
+OFFLINE_DIR = os.getenv('OFFLINE_DIR', os.path.join(REPO_ROOT, 'client', 'offline'))
+OFFLINE_MAX_FRAMES = int(os.getenv('OFFLINE_MAX_FRAMES', 500))
+
+# one keep-alive session for every request instead of a new connection each time
+session = requests.Session()
+
+# EDGE_MODE=crops finds faces on the device and uploads small face crops,
+# EDGE_MODE=encodings also encodes them there (needs face_recognition installed)
+# and uploads just the numbers, off sends the whole jpeg like before
+EDGE_MODE = os.getenv('EDGE_MODE', 'off')
+EDGE_FACE_PX = 150  # face crops get scaled down to about this size
+CROP_PAD = 0.3  # margin around the face so the server can find the landmarks
+
+# /recognize_faces payload, keep in sync with api/app.py
+FACES_MAGIC = b'FACE'
+FACES_VERSION = 1
+FACES_KIND_ENCODINGS = 0
+FACES_KIND_CROPS = 1
+FACES_HEADER = struct.Struct('>4sBBHHH')  # magic, version, kind, face count, frame width, height
+FACES_BOX = struct.Struct('>4H')  # top, right, bottom, left
+FACES_ENCODING = struct.Struct('>128f')
+FACES_CROP_SIZE = struct.Struct('>I')
+
 # print(API_URL)
 
-def capture_and_recognize():
-    """capture a pic, send to the ML model, show the result"""
-    
-    print("taking a photo...")
+_face_cascade = None
 
-    # make sure we've got a test_images folder in the right spot
-    repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-    test_images_dir = os.path.join(repo_root, "client", "test_images")
-    os.makedirs(test_images_dir, exist_ok=True)
+def grab_frame():
+    """open the camera, grab one frame, close it again"""
     
     # using camera 1 (change if your cam is different)
     camera = cv2.VideoCapture(0)
     
     if not camera.isOpened():
         print("couldn't open the camera :(")
-        return
+        return None
     
     # letting the camera warm up a bit
     time.sleep(0.5)
@@ -39,46 +75,123 @@ def capture_and_recognize():
     
     if not ret:
         print("couldn't grab an image from the camera")
-        return
+        return None
+    return frame
+
+def find_faces_on_device(frame):
+    """face boxes (top, right, bottom, left) found on the device, plus encodings in encodings mode"""
+    if EDGE_MODE == 'encodings':
+        import face_recognition  # only needed on devices that can run dlib
+        rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+        locations = face_recognition.face_locations(rgb, model="hog")
+        return locations, face_recognition.face_encodings(rgb, locations)
+    
+    # opencv's bundled haar cascade, no extra dependencies. its boxes are framed
+    # differently from dlib's, fine for cutting crops (the server finds the face
+    # again inside each crop) but never feed them to face_encodings
+    global _face_cascade
+    if _face_cascade is None:
+        _face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    boxes = _face_cascade.detectMultiScale(gray, scaleFactor=1.1, minNeighbors=5, minSize=(40, 40))
+    return [(int(y), int(x + w), int(y + h), int(x)) for x, y, w, h in boxes], None
+
+def pack_faces(frame, locations, encodings=None):
+    """build the /recognize_faces payload: encodings if we have them, else face crops"""
+    h, w = frame.shape[:2]
+    kind = FACES_KIND_ENCODINGS if encodings is not None else FACES_KIND_CROPS
+    parts = [FACES_HEADER.pack(FACES_MAGIC, FACES_VERSION, kind, len(locations), w, h)]
+    
+    for i, (top, right, bottom, left) in enumerate(locations):
+        parts.append(FACES_BOX.pack(top, right, bottom, left))
+        if encodings is not None:
+            parts.append(FACES_ENCODING.pack(*encodings[i]))
+            continue
+        
+        # crop with some margin, then shrink big faces so the crop stays a few KB
+        pad_y, pad_x = int((bottom - top) * CROP_PAD), int((right - left) * CROP_PAD)
+        y0, y1 = max(0, top - pad_y), min(h, bottom + pad_y)
+        x0, x1 = max(0, left - pad_x), min(w, right + pad_x)
+        crop = frame[y0:y1, x0:x1]
+        scale = min(1.0, EDGE_FACE_PX / max(1, right - left))
+        if scale < 1.0:
+            crop = cv2.resize(crop, (0, 0), fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        face_box = (int((top - y0) * scale), int((right - x0) * scale),
+                    int((bottom - y0) * scale), int((left - x0) * scale))
+        ok, jpeg = cv2.imencode('.jpg', crop, [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY])
+        jpeg = jpeg.tobytes()
+        parts += [FACES_BOX.pack(*face_box), FACES_CROP_SIZE.pack(len(jpeg)), jpeg]
+    return b''.join(parts)
+
+def recognize_on_device(frame):
+    """detect (and maybe encode) here, only send the faces to the server"""
+    locations, encodings = find_faces_on_device(frame)
+    if not locations:
+        # nobody in the picture, no need to bother the server
+        h, w = frame.shape[:2]
+        return {'success': True, 'faces': [], 'total_faces': 0, 'image_size': {'width': w, 'height': h}}
+    
+    body = pack_faces(frame, locations, encodings)
+    print(f"sending {len(locations)} face(s) as {EDGE_MODE} ({len(body)} bytes)...")
+    return session.post(f"{API_URL}/recognize_faces", data=body,
+                         headers={'Content-Type': 'application/octet-stream'}, timeout=30)
+
+def recognize_frame(frame):
+    """send the whole frame as a jpeg, straight from memory"""
+    ok, jpeg = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY])
+    files = {'image': ('capture.jpg', jpeg.tobytes(), 'image/jpeg')}
+    return session.post(f"{API_URL}/recognize", files=files, timeout=30)
 
-    # save the image so we can upload it
-    image_path = os.path.join(test_images_dir, f"capture_{datetime.now().strftime('%Y%m%d_%H%M%S')}.jpg")
-    print(f"saving image here: {image_path}")
-    cv2.imwrite(image_path, frame)
-    print(f"saved the photo")
+def show_result(result):
+    print("="*50)
+    print("these are the recognition results")
+    print("="*50)
+    print(f"found {result['total_faces']} face(s)")
+    print(f"image size: {result['image_size']['width']} x {result['image_size']['height']}")
+    print()
+    
+    for i, face in enumerate(result['faces'], 1):
+        print(f"face #{i}:")
+        print(f"  the name: {face['name']}")
+        print(f"  confidence: {face['confidence']:.1f}%")
+        print(f"  location: ({face['location']['left']}, {face['location']['top']}) -> ({face['location']['right']}, {face['location']['bottom']})")
+        print()
 
+def capture_and_recognize(frame=None):
+    """capture a pic, send to the ML model, show the result
+    
+    everything stays in memory, nothing gets written to disk
+    """
+    
+    if frame is None:
+        print("taking a photo...")
+        frame = grab_frame()
+        if frame is None:
+            return
+    
     # now send it to the api and ask for faces
     print("sending image up to the ML model for checking...")
     
     try:
-        with open(image_path, 'rb') as img_file:
-            files = {'image': img_file}
-            response = requests.post(f"{API_URL}/recognize", files=files, timeout=30)
+        if EDGE_MODE in ('crops', 'encodings'):
+            response = recognize_on_device(frame)
+        else:
+            response = recognize_frame(frame)
         
-        if response.status_code == 200:
+        if isinstance(response, dict):
+            result = response  # answered on the device
+        elif response.status_code == 200:
             result = response.json()
-            
-            if result.get('success'):
-                print("="*50)
-                print("these are the recognition results")
-                print("="*50)
-                print(f"found {result['total_faces']} face(s)")
-                print(f"image size: {result['image_size']['width']} x {result['image_size']['height']}")
-                print()
-                
-                for i, face in enumerate(result['faces'], 1):
-                    print(f"face #{i}:")
-                    print(f"  the name: {face['name']}")
-                    print(f"  confidence: {face['confidence']:.1f}%")
-                    print(f"  location: ({face['location']['left']}, {face['location']['top']}) -> ({face['location']['right']}, {face['location']['bottom']})")
-                    print()
-                
-                return result
-            else:
-                print(f"didn't work: {result.get('error')}")
         else:
             print(f"server gave an error: code {response.status_code}")
             print(response.text)
+            return
+        
+        if result.get('success'):
+            show_result(result)
+            return result
+        else:
+            print(f"didn't work: {result.get('error')}")
             
     except requests.exceptions.Timeout:
         print("the request took too long and timed out")
@@ -86,17 +199,13 @@ def capture_and_recognize():
         print(f"couldn't send the image: {e}")
     except Exception as e:
         print(f"some other error happened: {e}")
-    finally:
-        # get rid of the image file after sending
-        if os.path.exists(image_path):
-            os.remove(image_path)
 
 def check_health():
     """just check if the api is up and see what's loaded"""
     health_url = f"{API_URL}/health"
     
     try:
-        response = requests.get(health_url, timeout=10)
+        response = session.get(health_url, timeout=10)
         if response.status_code == 200:
             data = response.json()
             print(f"api status: {data['status']}")
@@ -107,19 +216,187 @@ def check_health():
     except Exception as e:
         print(f"can't reach the api: {e}")
 
+def pack_images(jpegs):
+    """/recognize_batch octet-stream body: 4-byte big-endian length + jpeg, repeated"""
+    return b''.join(struct.pack('>I', len(jpeg)) + jpeg for jpeg in jpegs)
+
+def recognize_regions(frame, regions):
+    """send only the changed parts of the frame, faces come back in full frame coords
+    
+    returns (faces, bytes sent), faces is None if the upload failed
+    """
+    h, w = frame.shape[:2]
+    changed_area = sum((bottom - top) * (right - left) for top, right, bottom, left in regions)
+    if changed_area >= FULL_FRAME_SHARE * h * w or len(regions) > MAX_REGIONS:
+        # crops wouldn't save much, just send the whole thing
+        regions = [(0, w, h, 0)]
+    
+    jpegs = []
+    for top, right, bottom, left in regions:
+        ok, jpeg = cv2.imencode('.jpg', frame[top:bottom, left:right], [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY])
+        jpegs.append(jpeg.tobytes())
+    body = pack_images(jpegs)
+    
+    try:
+        response = session.post(f"{API_URL}/recognize_batch", data=body,
+                                 headers={'Content-Type': 'application/octet-stream'}, timeout=30)
+    except requests.exceptions.RequestException as e:
+        print(f"couldn't send the image: {e}")
+        return None, len(body)
+    if response.status_code != 200:
+        print(f"server gave an error: code {response.status_code}")
+        return None, len(body)
+    
+    # shift each crop's face boxes back to where the crop sits in the frame
+    faces = []
+    for (top, _, _, left), result in zip(regions, response.json()['results']):
+        for face in result.get('faces', []):
+            loc = face['location']
+            loc['top'] += top
+            loc['bottom'] += top
+            loc['left'] += left
+            loc['right'] += left
+            faces.append(face)
+    return faces, len(body)
+
+def make_motion_gate(**kwargs):
+    """the motion gate, or None with MOTION_GATE=0 or when motion.py isn't next to
+    the client (copied to the board on its own), then every frame gets uploaded"""
+    if not MOTION_GATE:
+        return None
+    if REPO_ROOT not in sys.path:
+        sys.path.insert(0, REPO_ROOT)
+    try:
+        from motion import MotionGate, load_rois
+    except ImportError as e:
+        print(f"no motion gate ({e}), uploading every frame. copy motion.py next to the client or set MOTION_GATE=0")
+        return None
+    return MotionGate(rois=load_rois(), force_every=MOTION_FORCE_EVERY or None, **kwargs)
+
 def continuous_monitoring(interval=5):
-    """just keeps capturing every so often until you stop it ctrl+c"""
+    """just keeps capturing every so often until you stop it ctrl+c
+    
+    frames go through a motion gate first: if nothing changed (inside the
+    ROIs from ROI_CONFIG for CAMERA_ID) nothing is uploaded, otherwise only
+    the changed regions are, or just the faces in EDGE_MODE
+    """
+    
+    # frames are seconds apart, so compare mostly against the previous one
+    gate = make_motion_gate(learning_rate=0.5)
+    if gate is None:
+        print(f"starting monitoring, grabbing a photo every {interval} seconds")
+        print("hit ctrl+c when you're over it\n")
+        try:
+            while True:
+                capture_and_recognize()
+                print(f"\nwaiting {interval} seconds...\n")
+                time.sleep(interval)
+        except KeyboardInterrupt:
+            print("\nok, stopped monitoring")
+        return
+    
+    # keep the camera open, reopening it every time costs more than the check
+    camera = cv2.VideoCapture(0)
+    if not camera.isOpened():
+        print("couldn't open the camera :(")
+        return
+    time.sleep(0.5)
+    
+    uploads, bytes_sent = 0, 0
     
-    print(f"starting monitoring, grabbing a photo every {interval} seconds")
+    print(f"starting monitoring, checking for changes every {interval} seconds")
     print("hit ctrl+c when you're over it\n")
     
     try:
         while True:
-            capture_and_recognize()
-            print(f"\nwaiting {interval} seconds...\n")
+            # drop whatever the driver buffered while we slept
+            camera.grab()
+            ret, frame = camera.read()
+            if not ret:
+                print("couldn't grab an image from the camera")
+                time.sleep(interval)
+                continue
+            
+            regions = gate.check(frame)
+            if not regions:
+                print(f"nothing changed ({gate.changed_share:.1%}), skipping upload")
+            elif EDGE_MODE in ('crops', 'encodings'):
+                # faces get found here anyway, so just send those
+                capture_and_recognize(frame)
+            else:
+                print(f"{len(regions)} changed region(s), sending them up...")
+                faces, sent = recognize_regions(frame, regions)
+                uploads += 1
+                bytes_sent += sent
+                if faces is not None:
+                    print(f"found {len(faces)} face(s)")
+                    for face in faces:
+                        print(f"  {face['name']} ({face['confidence']:.1f}%)")
             time.sleep(interval)
     except KeyboardInterrupt:
         print("\nok, stopped monitoring")
+    finally:
+        camera.release()
+        print(f"checked {gate.frames} frame(s), skipped {gate.skipped}, "
+              f"uploaded {uploads} ({bytes_sent / 1024:.0f} KB)")
+
+def show_streamed_result(result, captured_at):
+    stamp = datetime.fromtimestamp(captured_at).strftime('%H:%M:%S.%f')[:-3]
+    if not result.get('success'):
+        print(f"[{stamp}] didn't work: {result.get('error')}")
+        return
+    names = ', '.join(f"{face['name']} ({face['confidence']:.1f}%)" for face in result['faces'])
+    print(f"[{stamp}] {result['total_faces']} face(s) {names}")
+
+def stream_monitoring(max_fps=None):
+    """keeps the camera open and captures as fast as it goes (or max_fps)
+    
+    uploads run in the background, several at once over one keep-alive
+    session, so the network never slows the capture down. if every upload
+    slot is busy only the newest frame waits for one, if the api is down
+    frames wait in OFFLINE_DIR and get sent in batches once it's back. with the motion gate on, frames where
+    nothing changed are skipped
+    """
+    
+    camera = cv2.VideoCapture(0)
+    if not camera.isOpened():
+        print("couldn't open the camera :(")
+        return
+    
+    gate = make_motion_gate()
+    engine = UploadEngine(API_URL, show_streamed_result, max_in_flight=UPLOAD_IN_FLIGHT,
+                          ring_dir=OFFLINE_DIR, ring_size=OFFLINE_MAX_FRAMES)
+    if len(engine.ring):
+        print(f"{len(engine.ring)} frame(s) left over from last time, sending them too")
+    
+    print(f"streaming to {API_URL}, up to {UPLOAD_IN_FLIGHT} uploads at once")
+    print("hit ctrl+c when you're over it\n")
+    
+    frames, last_report = 0, time.time()
+    try:
+        while True:
+            ret, frame = camera.read()
+            if not ret:
+                print("couldn't grab an image from the camera")
+                break
+            captured_at = time.time()
+            frames += 1
+            
+            if gate is None or gate.check(frame):
+                ok, jpeg = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY])
+                engine.submit(jpeg.tobytes(), captured_at)
+            
+            if max_fps:
+                time.sleep(max(0, 1 / max_fps - (time.time() - captured_at)))
+            if time.time() - last_report >= 10:
+                print(f"capturing {frames / (time.time() - last_report):.1f} fps, uploads: {engine.stats()}")
+                frames, last_report = 0, time.time()
+    except KeyboardInterrupt:
+        print("\nok, stopped streaming")
+    finally:
+        camera.release()
+        engine.close()
+        print(f"uploads: {engine.stats()}")
 
 if __name__ == "__main__":
     import sys
@@ -128,6 +405,9 @@ if __name__ == "__main__":
         if sys.argv[1] == "continuous":
             interval = int(sys.argv[2]) if len(sys.argv) > 2 else 5
             continuous_monitoring(interval)
+        elif sys.argv[1] == "stream":
+            max_fps = float(sys.argv[2]) if len(sys.argv) > 2 else None
+            stream_monitoring(max_fps)
         elif sys.argv[1] == "health":
             check_health()
     else:
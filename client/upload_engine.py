@@ -0,0 +1,285 @@
+"""upload engine for the long-running client
+
+keeps one keep-alive session to the api, has a few uploads in flight at once
+so the camera never waits on the network. when all upload slots are busy only
+the newest frame is held in memory and goes out as soon as a slot frees up,
+older ones are skipped (results are about now, not a backlog). when the api
+can't be reached frames go into a bounded ring of jpeg files on disk that gets
+drained in /recognize_batch batches once the api is back
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+import os
+import struct
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+CONNECT_TIMEOUT = 3
+READ_TIMEOUT = 30
+RETRY_SECONDS = 5  # how often to poke /health while offline
+
+
+class OfflineRing:
+    """bounded fifo of jpeg frames on disk, oldest ones get dropped when it's full
+
+    files are named <sequence>_<capture time in ms>.jpg so the order and the
+    capture time survive a restart of the client
+    """
+
+    def __init__(self, directory, max_frames=500):
+        self.directory = directory
+        self.max_frames = max_frames
+        self.dropped = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        names = []
+        for name in os.listdir(directory):
+            if name.endswith('.tmp'):
+                os.remove(os.path.join(directory, name))  # half-written before a crash
+            elif name.endswith('.jpg'):
+                names.append(name)
+        self._names = deque(sorted(names))
+        self._seq = int(self._names[-1].split('_')[0]) + 1 if self._names else 0
+
+    def __len__(self):
+        return len(self._names)
+
+    def put(self, jpeg, captured_at):
+        with self._lock:
+            name = f"{self._seq:012d}_{int(captured_at * 1000)}.jpg"
+            self._seq += 1
+            path = os.path.join(self.directory, name)
+            with open(path + '.tmp', 'wb') as f:
+                f.write(jpeg)
+            os.replace(path + '.tmp', path)
+            self._names.append(name)
+            while len(self._names) > self.max_frames:
+                self._remove(self._names.popleft())
+                self.dropped += 1
+
+    def peek(self, n):
+        """up to n oldest frames as (name, jpeg bytes, capture time)"""
+        with self._lock:
+            names = list(self._names)[:n]
+        frames = []
+        for name in names:
+            try:
+                with open(os.path.join(self.directory, name), 'rb') as f:
+                    frames.append((name, f.read(), int(name[:-4].split('_')[1]) / 1000))
+            except FileNotFoundError:
+                pass  # dropped meanwhile
+        return frames
+
+    def remove(self, names):
+        with self._lock:
+            for name in names:
+                try:
+                    self._names.remove(name)
+                except ValueError:
+                    continue
+                self._remove(name)
+
+    def _remove(self, name):
+        try:
+            os.remove(os.path.join(self.directory, name))
+        except FileNotFoundError:
+            pass
+
+
+class UploadEngine:
+    """submit() jpegs as fast as the camera delivers them, on_result gets called
+    with (result, capture time) from a background thread for each one"""
+
+    def __init__(self, api_url, on_result, max_in_flight=4, ring_dir='offline',
+                 ring_size=500, batch_size=16):
+        self.api_url = api_url
+        self.on_result = on_result
+        self.batch_size = batch_size
+        self.ring = OfflineRing(ring_dir, ring_size)
+        self.online = True
+        self.sent = 0
+        self.failed = 0
+        self.skipped = 0
+        self._batch_endpoint = True
+
+        # one pooled keep-alive connection per upload slot
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_in_flight)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+        self._in_flight = 0
+        self._latest = None  # (jpeg, capture time) waiting for a free slot
+        self._count_lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=max_in_flight)
+        self._stopping = threading.Event()
+        self._drainer = threading.Thread(target=self._drain, name='ring-drainer', daemon=True)
+        self._drainer.start()
+
+    def submit(self, jpeg, captured_at=None):
+        """never blocks: uploads right away if a slot is free, otherwise keeps it as
+        the newest frame waiting for a slot (offline: buffers it on disk)"""
+        captured_at = captured_at or time.time()
+        if not self.online:
+            self.ring.put(jpeg, captured_at)
+            return
+        with self._count_lock:
+            # same lock as _next_or_release, so a slot freed meanwhile can't be missed
+            if self._slots.acquire(blocking=False):
+                self._in_flight += 1
+            else:
+                if self._latest is not None:
+                    self.skipped += 1
+                self._latest = (jpeg, captured_at)
+                return
+        self._pool.submit(self._send, jpeg, captured_at)
+
+    def _next_or_release(self):
+        """the frame waiting for a slot, which keeps this one, or None after the slot is given back"""
+        with self._count_lock:
+            frame, self._latest = self._latest, None
+            if frame is None:
+                self._in_flight -= 1
+                self._slots.release()
+            return frame
+
+    def _send(self, jpeg, captured_at):
+        frame = (jpeg, captured_at)
+        while frame is not None:
+            if self.online:
+                self._upload(*frame)
+            else:
+                self.ring.put(*frame)
+            frame = self._next_or_release()
+
+    def _upload(self, jpeg, captured_at):
+        try:
+            files = {'image': ('frame.jpg', jpeg, 'image/jpeg')}
+            response = self.session.post(f"{self.api_url}/recognize", files=files,
+                                         timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
+            if response.status_code >= 500:
+                raise requests.exceptions.RequestException(f"server error {response.status_code}")
+            self.sent += 1
+            self.on_result(response.json(), captured_at)
+        except requests.exceptions.RequestException as e:
+            # keep the frame for later, the drainer takes it from here
+            self._went_offline(e)
+            self.ring.put(jpeg, captured_at)
+        except Exception as e:
+            self.failed += 1
+            print(f"upload failed: {e}")
+
+    def _went_offline(self, error):
+        if self.online:
+            print(f"api unreachable ({error}), buffering frames in {self.ring.directory}")
+        self.online = False
+
+    def _probe(self):
+        try:
+            response = self.session.get(f"{self.api_url}/health", timeout=CONNECT_TIMEOUT)
+            return response.status_code == 200
+        except requests.exceptions.RequestException:
+            return False
+
+    def _drain(self):
+        while not self._stopping.is_set():
+            if not len(self.ring):
+                self._stopping.wait(0.5)
+                continue
+            if not self.online:
+                if not self._probe():
+                    self._stopping.wait(RETRY_SECONDS)
+                    continue
+                print(f"api is back, sending {len(self.ring)} buffered frame(s)")
+                self.online = True
+
+            # a batch takes an upload slot like any other request
+            if not self._slots.acquire(timeout=0.5):
+                continue
+            with self._count_lock:
+                self._in_flight += 1
+            frames = self.ring.peek(self.batch_size if self._batch_endpoint else 1)
+            error = None
+            try:
+                results = self._post_frames(frames)
+            except (requests.exceptions.RequestException, ValueError) as e:
+                error = e
+            finally:
+                self._hand_over_slot()
+            if error is not None:
+                self._went_offline(error)
+                self._stopping.wait(RETRY_SECONDS)
+                continue
+            if results is None:
+                continue  # try again one frame at a time
+
+            self.ring.remove([name for name, _, _ in frames])
+            self.sent += len(results)
+            for (_, _, captured_at), result in zip(frames, results):
+                self.on_result(result, captured_at)
+
+    def _hand_over_slot(self):
+        """the drainer is done with its slot: the waiting live frame gets it, if any"""
+        frame = self._next_or_release()
+        if frame is None:
+            return
+        try:
+            self._pool.submit(self._send, *frame)
+        except RuntimeError:
+            # closing, the pool takes no more work
+            while frame is not None:
+                self.ring.put(*frame)
+                frame = self._next_or_release()
+
+    def _post_frames(self, frames):
+        """one /recognize_batch request for the frames (or /recognize for a single
+        frame on servers without the batch endpoint), returns one result per frame,
+        or None if the frames should be sent again differently"""
+        if self._batch_endpoint:
+            body = b''.join(struct.pack('>I', len(jpeg)) + jpeg for _, jpeg, _ in frames)
+            response = self.session.post(f"{self.api_url}/recognize_batch", data=body,
+                                         headers={'Content-Type': 'application/octet-stream'},
+                                         timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
+            if response.status_code in (404, 405):
+                print("no /recognize_batch on this server, draining one frame at a time")
+                self._batch_endpoint = False
+                return None
+        else:
+            files = {'image': ('frame.jpg', frames[0][1], 'image/jpeg')}
+            response = self.session.post(f"{self.api_url}/recognize", files=files,
+                                         timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
+        if response.status_code >= 500:
+            raise requests.exceptions.RequestException(f"server error {response.status_code}")
+
+        data = response.json()
+        if not self._batch_endpoint:
+            return [data]
+        if 'results' not in data:
+            # rejected as a whole (bad request), these frames won't get any better
+            print(f"buffered batch rejected: {data.get('error')}")
+            self.failed += len(frames)
+            return []
+        return data['results']
+
+    def stats(self):
+        return {
+            'online': self.online,
+            'in_flight': self._in_flight,
+            'sent': self.sent,
+            'failed': self.failed,
+            'skipped': self.skipped,
+            'buffered': len(self.ring),
+            'dropped': self.ring.dropped
+        }
+
+    def close(self, timeout=10):
+        """wait for the in-flight uploads, frames still in the ring stay on disk for next time"""
+        self._stopping.set()
+        self._drainer.join(timeout=timeout)
+        self._pool.shutdown(wait=True)
+        self.session.close()
@@ -0,0 +1,185 @@
+"""Adaptive face detection shared by recognize.py, the API and the realtime loop.
+
+HOG detection cost grows with the number of pixels scanned, and dlib only
+finds faces of roughly HOG_MIN_FACE_PX or more in the image it is given. So
+instead of always scanning at a fixed resolution, each call picks a detail
+level
+
+    detail = scale * 2 ** upsample
+
+(the input is resized by `scale`, then upsampled `upsample` times by dlib): a
+face of F pixels is seen at F * detail pixels and the scan costs about
+pixels * detail ** 2. The detail is the lowest that still shows the smallest
+recently seen face at DETECT_MIN_FACE_PX, capped by the latency budget using
+the measured cost per scanned pixel. Boxes are mapped back to the full
+resolution image, and encodings are computed there, so a coarse detection
+never lowers encoding quality.
+
+face_recognition (dlib and its model files) is only imported on the first
+detection, so importing this module is cheap.
+"""
+from collections import deque
+import math
+import os
+import threading
+import time
+
+import cv2
+import numpy as np
+
+HOG_MIN_FACE_PX = 80  # dlib's HOG detection window
+DETECT_MIN_FACE_PX = 100  # size we want the smallest expected face to be seen at
+BASELINE_DETAIL = 2.0  # full resolution + one upsample, face_locations' default
+MIN_DETAIL = 0.05
+MAX_DETAIL = 4.0
+COARSE_SIDE = 800  # long side of the first pass when recent face sizes are unknown
+FACE_HISTORY = 10  # recent results whose face sizes drive the plan
+DETECT_SHARE = 0.5  # share of the frame time the realtime loop spends detecting
+DEFAULT_SECONDS_PER_PIXEL = 1.5e-7  # first guess until a scan has been timed
+EMA = 0.3
+
+
+def configured_target_ms(default=500):
+    """Detection latency budget in ms (DETECT_TARGET_MS)."""
+    return float(os.environ.get("DETECT_TARGET_MS", default))
+
+
+def detail_params(detail):
+    """(scale, upsample) for a detail level: downscale below 1, upsample above."""
+    upsample = max(0, math.ceil(math.log2(detail) - 1e-9))
+    return detail / 2 ** upsample, upsample
+
+
+def scale_location(location, sy, sx, shape):
+    top, right, bottom, left = location
+    h, w = shape[:2]
+    return (min(int(round(top * sy)), h), min(int(round(right * sx)), w),
+            min(int(round(bottom * sy)), h), min(int(round(left * sx)), w))
+
+
+class AdaptiveDetector:
+    """Chooses detection scale / upsample (and the realtime frame skip) from
+    measured timings and the face sizes of recent results. Thread-safe.
+
+    face_history=False plans every image on its own (coarse pass, then finer),
+    for callers whose images are unrelated, like the API's clients; the
+    measured scan cost is still shared.
+    """
+
+    def __init__(self, target_ms=None, adaptive=None, face_history=True):
+        self.target = (configured_target_ms() if target_ms is None else target_ms) / 1000
+        if adaptive is None:
+            adaptive = os.environ.get("DETECT_ADAPTIVE", "1") != "0"
+        self.adaptive = adaptive
+        self.face_history = face_history
+        self.seconds_per_pixel = DEFAULT_SECONDS_PER_PIXEL
+        self.scans = 0
+        self.detect_seconds = None  # whole detect() call, smoothed
+        self.face_sizes = deque(maxlen=FACE_HISTORY)  # smallest face height / image height
+        self.last = {}
+        self._lock = threading.Lock()
+
+    def budget_detail(self, pixels, seconds=None):
+        """Highest detail a scan of `pixels` can afford in `seconds` (default: the target)."""
+        seconds = self.target if seconds is None else seconds
+        return math.sqrt(max(seconds, 0.0) / (max(self.seconds_per_pixel, 1e-12) * pixels))
+
+    def plan(self, shape, refine=True):
+        """Detail for the first pass over an image of this shape."""
+        h, w = shape[:2]
+        with self._lock:
+            sizes = list(self.face_sizes)
+        budget = self.budget_detail(h * w)
+        if sizes:
+            detail = DETECT_MIN_FACE_PX / (min(sizes) * h)
+        elif refine:
+            detail = COARSE_SIDE / max(h, w)  # coarse first, refined below if nothing is found
+        else:
+            detail = budget  # searching: as fine as the budget allows
+        return float(np.clip(min(detail, budget), MIN_DETAIL, MAX_DETAIL))
+
+    def detect(self, image, refine=True):
+        """Face locations (top, right, bottom, left) in full resolution `image` coordinates.
+
+        With refine, a pass that finds nothing is retried at higher detail:
+        always up to BASELINE_DETAIL, so no face the plain face_locations call
+        finds is missed, and beyond that while the budget lasts. The realtime
+        loop passes refine=False and simply tries again on a later frame.
+        """
+        if not self.adaptive:
+            import face_recognition
+            return face_recognition.face_locations(image, model="hog")
+
+        start = time.perf_counter()
+        h, w = image.shape[:2]
+        detail = self.plan(image.shape, refine)
+        passes = 0
+        while True:
+            locations = self._detect_at(image, detail)
+            passes += 1
+            if locations or not refine or detail >= MAX_DETAIL:
+                break
+            next_detail = min(detail * 2, MAX_DETAIL)
+            if detail < BASELINE_DETAIL < next_detail:
+                next_detail = BASELINE_DETAIL
+            remaining = self.target - (time.perf_counter() - start)
+            if next_detail > BASELINE_DETAIL and next_detail > self.budget_detail(h * w, remaining):
+                break
+            detail = next_detail
+
+        elapsed = time.perf_counter() - start
+        scale, upsample = detail_params(detail)
+        with self._lock:
+            if self.detect_seconds is None:
+                self.detect_seconds = elapsed
+            else:
+                self.detect_seconds += EMA * (elapsed - self.detect_seconds)
+            if self.face_history and locations:
+                self.face_sizes.append(min(bottom - top for top, _, bottom, _ in locations) / h)
+            elif self.face_history:
+                self.face_sizes.clear()  # nobody to size for, search finer next time
+            self.last = {
+                'detail': round(detail, 3),
+                'scale': round(scale, 3),
+                'upsample': upsample,
+                'passes': passes,
+                'ms': round(elapsed * 1000, 1)
+            }
+        return locations
+
+    def _detect_at(self, image, detail):
+        import face_recognition
+        scale, upsample = detail_params(detail)
+        h, w = image.shape[:2]
+        if scale < 1:
+            size = (max(1, round(w * scale)), max(1, round(h * scale)))
+            small = cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+        else:
+            small = image
+        start = time.perf_counter()
+        locations = face_recognition.face_locations(small, number_of_times_to_upsample=upsample, model="hog")
+        seconds = time.perf_counter() - start
+
+        scanned = small.shape[0] * small.shape[1] * 4 ** upsample
+        with self._lock:
+            if self.scans == 0:
+                self.seconds_per_pixel = seconds / scanned  # replace the first guess
+            else:
+                self.seconds_per_pixel += EMA * (seconds / scanned - self.seconds_per_pixel)
+            self.scans += 1
+        sy, sx = h / small.shape[0], w / small.shape[1]
+        return [scale_location(location, sy, sx, image.shape) for location in locations]
+
+    def detect_interval(self, fps, min_interval=1, max_interval=30):
+        """Frames between detections so detection uses about DETECT_SHARE of the frame time."""
+        if not self.detect_seconds or fps <= 0:
+            return min_interval
+        interval = math.ceil(self.detect_seconds * fps / DETECT_SHARE)
+        return int(np.clip(interval, min_interval, max_interval))
+
+    def stats(self):
+        return dict(self.last,
+                    adaptive=self.adaptive,
+                    face_history=self.face_history,
+                    target_ms=self.target * 1000,
+                    ms_per_megapixel=round(self.seconds_per_pixel * 1e9, 2))
@@ -0,0 +1,275 @@
+"""Shared face gallery used by train.py, recognize.py, the realtime loop and the API.
+
+Encodings live in one contiguous float32 matrix and names are stored as an int
+label per row plus a small label table, so matching every face in a frame is a
+single batched distance computation instead of a Python loop over the gallery.
+"""
+import hashlib
+import os
+import pickle
+import struct
+import tempfile
+import zipfile
+from collections import namedtuple
+
+import numpy as np
+
+ENCODING_DIM = 128
+DEFAULT_TOLERANCE = 0.6
+UNKNOWN_NAME = "Unknown"
+
+# On-disk gallery format (bump when the .npz layout changes)
+GALLERY_FORMAT_VERSION = 1
+GALLERY_PATH = "encodings.npz"
+LEGACY_PATH = "encodings.pkl"
+
+Match = namedtuple("Match", ["name", "confidence", "distance", "index"])
+
+
+class FaceGallery:
+    """Known face encodings as a (N, 128) float32 matrix with int labels."""
+
+    def __init__(self, encodings, labels, label_names, sq_norms=None, fingerprint=None):
+        # asarray/ascontiguousarray keep memory-mapped float32 input zero-copy
+        encodings = np.asarray(encodings, dtype=np.float32)
+        self.encodings = np.ascontiguousarray(encodings.reshape(-1, ENCODING_DIM))
+        self.labels = np.asarray(labels, dtype=np.int32)
+        self.label_names = [str(n) for n in label_names]
+        if len(self.labels) != len(self.encodings):
+            raise ValueError(
+                f"Got {len(self.encodings)} encodings but {len(self.labels)} labels"
+            )
+        # Cached squared norms for the ||a||^2 + ||b||^2 - 2ab distance expansion
+        if sq_norms is None:
+            sq_norms = np.einsum("ij,ij->i", self.encodings, self.encodings)
+        self._sq_norms = sq_norms
+        self._fingerprint = fingerprint
+        # Optional approximate index (see gallery_index.py); None means exact scan
+        self.index = None
+
+    @classmethod
+    def from_names(cls, names, encodings):
+        """Build a gallery from parallel lists of names and encodings (train.py layout)."""
+        label_names = sorted(set(names))
+        index = {name: i for i, name in enumerate(label_names)}
+        labels = [index[name] for name in names]
+        if len(encodings) == 0:
+            encodings = np.empty((0, ENCODING_DIM), dtype=np.float32)
+        return cls(np.asarray(encodings, dtype=np.float32), labels, label_names)
+
+    def __len__(self):
+        return len(self.encodings)
+
+    @property
+    def names(self):
+        """Per-row names, same order as the encodings."""
+        return [self.label_names[i] for i in self.labels]
+
+    @property
+    def known_people(self):
+        return list(self.label_names)
+
+    def name_of(self, index):
+        return self.label_names[self.labels[index]]
+
+    def to_legacy_dict(self):
+        """The {"names": [...], "encodings": [...]} dict stored in encodings.pkl."""
+        return {
+            "names": self.names,
+            "encodings": [row.astype(np.float64) for row in self.encodings],
+        }
+
+    def distances(self, face_encodings):
+        """Euclidean distances from each query to every gallery row, shape (M, N)."""
+        queries = as_queries(face_encodings)
+        q_norms = np.einsum("ij,ij->i", queries, queries)
+        sq = q_norms[:, None] + self._sq_norms[None, :] - 2.0 * (queries @ self.encodings.T)
+        np.maximum(sq, 0.0, out=sq)
+        return np.sqrt(sq, out=sq)
+
+    def fingerprint(self):
+        """Content hash of the encodings, used to tell whether a saved index is stale."""
+        if self._fingerprint is None:
+            self._fingerprint = hashlib.blake2b(memoryview(self.encodings), digest_size=16).hexdigest()
+        return self._fingerprint
+
+    def top_k(self, face_encodings, k=1):
+        """Indices and distances of the k nearest gallery rows for each query.
+
+        Rows missing from an approximate index's result are padded with -1.
+        """
+        if self.index is not None:
+            return self.index.search(face_encodings, k)
+        return self.exact_top_k(face_encodings, k)
+
+    def exact_top_k(self, face_encodings, k=1):
+        """Brute-force top-k over the whole gallery.
+
+        Candidates come from the batched matrix product and are then re-scored
+        with the direct difference norm, so the returned distances do not carry
+        the cancellation error of the expanded form.
+        """
+        queries = as_queries(face_encodings)
+        n = len(self.encodings)
+        k = min(k, n)
+        if k == 0 or len(queries) == 0:
+            return (np.empty((len(queries), 0), dtype=np.int64),
+                    np.empty((len(queries), 0), dtype=np.float32))
+
+        dists = self.distances(queries)
+        if k == 1:
+            idx = np.argmin(dists, axis=1)[:, None]
+        elif k < n:
+            idx = np.argpartition(dists, k - 1, axis=1)[:, :k]
+        else:
+            idx = np.broadcast_to(np.arange(n), (len(queries), n)).copy()
+        exact = np.linalg.norm(self.encodings[idx] - queries[:, None, :], axis=2)
+        order = np.argsort(exact, axis=1, kind="stable")
+        return np.take_along_axis(idx, order, 1), np.take_along_axis(exact, order, 1)
+
+    def match_faces(self, face_encodings, tolerance=DEFAULT_TOLERANCE):
+        """Best match for every face in one batched pass; Unknown above tolerance."""
+        idx, dists = self.top_k(face_encodings, k=1)
+        return [self._to_match(i[0], d[0], tolerance) if len(i) and i[0] >= 0 else _unknown()
+                for i, d in zip(idx, dists)]
+
+    def match_faces_top_k(self, face_encodings, k=5, tolerance=DEFAULT_TOLERANCE):
+        """Up to k candidate matches per face, nearest first, all within tolerance."""
+        idx, dists = self.top_k(face_encodings, k=k)
+        return [[self._to_match(i, d, tolerance) for i, d in zip(row_i, row_d) if i >= 0 and d <= tolerance]
+                for row_i, row_d in zip(idx, dists)]
+
+    def _to_match(self, index, distance, tolerance):
+        distance = float(distance)
+        if distance > tolerance:
+            return Match(UNKNOWN_NAME, 0.0, distance, int(index))
+        return Match(self.name_of(index), (1 - distance) * 100, distance, int(index))
+
+
+def _unknown():
+    return Match(UNKNOWN_NAME, 0.0, float("inf"), -1)
+
+
+def as_queries(face_encodings):
+    """Stack query encodings into an (M, 128) float32 array."""
+    if len(face_encodings) == 0:
+        return np.empty((0, ENCODING_DIM), dtype=np.float32)
+    return np.asarray(face_encodings, dtype=np.float32).reshape(-1, ENCODING_DIM)
+
+
+def save_gallery(gallery, path=GALLERY_PATH):
+    """Write the gallery as an uncompressed, versioned .npz file.
+
+    Members are stored uncompressed so load_gallery(mmap=True) can map them
+    in place; squared norms and the fingerprint are saved so mapped loads
+    don't have to touch every row.
+    """
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        np.savez(
+            f,
+            version=np.int32(GALLERY_FORMAT_VERSION),
+            encodings=gallery.encodings,
+            labels=gallery.labels,
+            label_names=np.array(gallery.label_names, dtype=np.str_),
+            sq_norms=gallery._sq_norms,
+            fingerprint=np.str_(gallery.fingerprint()),
+        )
+    os.replace(tmp_path, path)
+
+
+def load_npz(path, mmap=False):
+    """All arrays of an .npz file; with mmap, uncompressed numeric members are
+    returned as read-only memory maps into the file instead of being read."""
+    if not mmap:
+        with np.load(path, allow_pickle=False) as data:
+            return {key: data[key] for key in data.files}
+
+    arrays = {}
+    with zipfile.ZipFile(path) as zf, open(path, "rb") as f:
+        for info in zf.infolist():
+            key = info.filename[:-4] if info.filename.endswith(".npy") else info.filename
+            mapped = _mmap_npz_member(path, f, info) if info.compress_type == zipfile.ZIP_STORED else None
+            if mapped is None:
+                with zf.open(info) as member:
+                    mapped = np.lib.format.read_array(member, allow_pickle=False)
+            arrays[key] = mapped
+    return arrays
+
+
+def _mmap_npz_member(path, f, info):
+    # Skip the zip local file header to reach the .npy payload
+    f.seek(info.header_offset)
+    header = f.read(30)
+    name_len, extra_len = struct.unpack("<HH", header[26:30])
+    f.seek(info.header_offset + 30 + name_len + extra_len)
+    version = np.lib.format.read_magic(f)
+    if version == (1, 0):
+        shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+    else:
+        shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+    if dtype.hasobject or dtype.kind == "U" or 0 in shape or shape == ():
+        return None
+    return np.memmap(path, dtype=dtype, mode="r", offset=f.tell(), shape=shape,
+                     order="F" if fortran_order else "C")
+
+
+def load_gallery(path=None, base_dir=".", mmap=False):
+    """Load a gallery from .npz or the legacy encodings.pkl.
+
+    With no path, prefer encodings.npz unless encodings.pkl is newer (e.g. it
+    was just rewritten by train.ipynb). With mmap, the .npz arrays are mapped
+    read-only, so every process loading the same file shares one copy in the
+    OS page cache.
+    """
+    if path is None:
+        path = resolve_gallery_path(base_dir)
+
+    if path.endswith(".pkl"):
+        with open(path, "rb") as f:
+            data = pickle.load(f)
+        return FaceGallery.from_names(data["names"], data["encodings"])
+
+    data = load_npz(path, mmap=mmap)
+    version = int(data["version"])
+    if version > GALLERY_FORMAT_VERSION:
+        raise ValueError(f"{path} has gallery format v{version}, newest supported is v{GALLERY_FORMAT_VERSION}")
+    return FaceGallery(data["encodings"], data["labels"], data["label_names"].tolist(),
+                       sq_norms=data.get("sq_norms"),
+                       fingerprint=str(data["fingerprint"]) if "fingerprint" in data else None)
+
+
+def load_shared_gallery(base_dir="."):
+    """Memory-mapped gallery for multi-process servers.
+
+    A legacy encodings.pkl is converted once to an .npz in GALLERY_CACHE_DIR
+    (keyed by the pickle's path, size and mtime) and mapped from there, so only
+    the first worker pays for unpickling.
+    """
+    path = resolve_gallery_path(base_dir)
+    if path.endswith(".pkl"):
+        path = _converted_legacy_path(path)
+    return load_gallery(path, mmap=True), path
+
+
+def _converted_legacy_path(pkl_path):
+    cache_dir = os.environ.get("GALLERY_CACHE_DIR", os.path.join(tempfile.gettempdir(), "face-gallery-cache"))
+    stat = os.stat(pkl_path)
+    key = hashlib.blake2b(f"{os.path.abspath(pkl_path)}:{stat.st_size}:{stat.st_mtime_ns}".encode(),
+                          digest_size=8).hexdigest()
+    npz_path = os.path.join(cache_dir, f"gallery-{key}.npz")
+    if not os.path.exists(npz_path):
+        os.makedirs(cache_dir, exist_ok=True)
+        # Workers racing here each write their own tmp file; os.replace keeps it atomic
+        save_gallery(load_gallery(pkl_path), f"{npz_path}.{os.getpid()}")
+        os.replace(f"{npz_path}.{os.getpid()}", npz_path)
+    return npz_path
+
+
+def resolve_gallery_path(base_dir="."):
+    npz_path = os.path.join(base_dir, GALLERY_PATH)
+    pkl_path = os.path.join(base_dir, LEGACY_PATH)
+    if os.path.exists(npz_path):
+        if not os.path.exists(pkl_path) or os.path.getmtime(npz_path) >= os.path.getmtime(pkl_path):
+            return npz_path
+    return pkl_path
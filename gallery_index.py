@@ -0,0 +1,415 @@
+"""Pluggable nearest-neighbour indexes behind FaceGallery.top_k.
+
+- "brute": exact scan of the whole gallery (the default, no index file)
+- "ivf":   k-means partitioned inverted lists, only the nprobe closest lists are scanned
+- "hnsw":  hierarchical navigable small world graph
+- "fp16", "int8", "pq": scan of compressed encodings with an exact re-rank
+  of the shortlist (see quantization.py)
+
+All of them are pure NumPy/Python. train.py builds the configured index and
+saves it next to the encodings as encodings.index.npz; the recognizers load it
+with attach_index(). Select one with the GALLERY_INDEX environment variable.
+"""
+import heapq
+import math
+import os
+
+import numpy as np
+
+from gallery import as_queries, load_npz
+
+INDEX_PATH = "encodings.index.npz"
+INDEX_KINDS = ("brute", "ivf", "hnsw", "fp16", "int8", "pq")
+
+
+def _pad_results(rows, k):
+    """Turn per-query [(dist, idx), ...] lists into (M, k) arrays padded with -1 / inf."""
+    idx = np.full((len(rows), k), -1, dtype=np.int64)
+    dists = np.full((len(rows), k), np.inf, dtype=np.float32)
+    for r, row in enumerate(rows):
+        row = row[:k]
+        if row:
+            dists[r, :len(row)] = [d for d, _ in row]
+            idx[r, :len(row)] = [i for _, i in row]
+    return idx, dists
+
+
+def _exact_rerank(vectors, query, candidates, k):
+    """Exact distances for a candidate id array, nearest k first."""
+    if len(candidates) == 0:
+        return []
+    d = np.linalg.norm(vectors[candidates] - query, axis=1)
+    if len(candidates) > k:
+        part = np.argpartition(d, k - 1)[:k]
+    else:
+        part = np.arange(len(candidates))
+    order = part[np.argsort(d[part], kind="stable")]
+    return list(zip(d[order].tolist(), candidates[order].tolist()))
+
+
+class BruteForceIndex:
+    """Exact search; mostly useful as the baseline in benchmarks."""
+
+    kind = "brute"
+
+    def __init__(self):
+        self.vectors = None
+        self._sq_norms = None
+
+    def build(self, vectors):
+        self.vectors = vectors
+        self._sq_norms = np.einsum("ij,ij->i", vectors, vectors)
+        return self
+
+    def search(self, face_encodings, k=1):
+        queries = as_queries(face_encodings)
+        k = min(k, len(self.vectors))
+        if k == 0:
+            return _pad_results([[] for _ in queries], 0)
+        sq = (np.einsum("ij,ij->i", queries, queries)[:, None] + self._sq_norms[None, :]
+              - 2.0 * (queries @ self.vectors.T))
+        if k < len(self.vectors):
+            cand = np.argpartition(sq, k - 1, axis=1)[:, :k]
+        else:
+            cand = np.broadcast_to(np.arange(len(self.vectors)), sq.shape)
+        return _pad_results([_exact_rerank(self.vectors, q, c, k) for q, c in zip(queries, cand)], k)
+
+    def state(self):
+        return {}
+
+    def load_state(self, state, vectors):
+        return self.build(vectors)
+
+
+class IVFIndex:
+    """Inverted-file index: k-means centroids, rows grouped by nearest centroid."""
+
+    kind = "ivf"
+
+    def __init__(self, nlist=None, nprobe=8, n_iter=20, seed=0):
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.n_iter = n_iter
+        self.seed = seed
+        self.vectors = None
+        self.centroids = None
+        self.order = None    # row ids sorted by list
+        self.offsets = None  # list c holds order[offsets[c]:offsets[c + 1]]
+
+    def build(self, vectors):
+        self.vectors = vectors
+        n = len(vectors)
+        nlist = self.nlist or max(1, int(4 * math.sqrt(n)))
+        nlist = max(1, min(nlist, n))
+        self.centroids = _kmeans(vectors, nlist, self.n_iter, self.seed)
+        assign = _nearest_centroid(vectors, self.centroids)
+        self._set_lists(assign)
+        return self
+
+    def _set_lists(self, assign):
+        self.order = np.argsort(assign, kind="stable").astype(np.int64)
+        self.offsets = np.searchsorted(assign[self.order], np.arange(len(self.centroids) + 1))
+
+    def search(self, face_encodings, k=1):
+        queries = as_queries(face_encodings)
+        if len(self.vectors) == 0:
+            return _pad_results([[] for _ in queries], k)
+        nprobe = min(self.nprobe, len(self.centroids))
+        c_dists = _sq_distances(queries, self.centroids)
+        probes = np.argpartition(c_dists, nprobe - 1, axis=1)[:, :nprobe]
+        rows = []
+        for q, probe in zip(queries, probes):
+            cand = np.concatenate([self.order[self.offsets[c]:self.offsets[c + 1]] for c in probe])
+            rows.append(_exact_rerank(self.vectors, q, cand, k))
+        return _pad_results(rows, k)
+
+    def state(self):
+        return {
+            "centroids": self.centroids,
+            "order": self.order,
+            "offsets": self.offsets,
+            "nprobe": np.int32(self.nprobe),
+        }
+
+    def load_state(self, state, vectors):
+        self.vectors = vectors
+        self.centroids = state["centroids"]
+        self.order = state["order"]
+        self.offsets = state["offsets"]
+        self.nlist = len(self.centroids)
+        if "nprobe" in state and not os.environ.get("IVF_NPROBE"):
+            self.nprobe = int(state["nprobe"])
+        return self
+
+
+class HNSWIndex:
+    """Hierarchical navigable small world graph (Malkov & Yashunin).
+
+    Built incrementally in Python, so building large galleries is slow (minutes
+    for 100k faces) but searching touches only a few hundred rows per query.
+    """
+
+    kind = "hnsw"
+
+    def __init__(self, M=16, ef_construction=100, ef_search=64, seed=0):
+        self.M = M
+        self.M0 = 2 * M
+        self.ef_construction = ef_construction
+        self.ef_search = ef_search
+        self.seed = seed
+        self.vectors = None
+        self.node_levels = None
+        self.entry_point = -1
+        self.max_level = -1
+        self._links = None  # build time: per node, per level list of neighbour ids
+        self._level0 = None  # frozen: (N, M0) neighbour ids padded with -1
+        self._upper = None  # frozen: per level >= 1, {node: neighbour id array}
+
+    def build(self, vectors):
+        self.vectors = vectors
+        n = len(vectors)
+        rng = np.random.default_rng(self.seed)
+        m_l = 1.0 / math.log(max(self.M, 2))
+        self.node_levels = np.floor(-np.log(1.0 - rng.random(n)) * m_l).astype(np.int32)
+        self._links = [[[] for _ in range(level + 1)] for level in self.node_levels]
+        self.entry_point, self.max_level = -1, -1
+        for node in range(n):
+            self._insert(node)
+        self._freeze()
+        return self
+
+    def _neighbours(self, node, level):
+        if self._links is not None:
+            return self._links[node][level]
+        if level == 0:
+            row = self._level0[node]
+            return row[row >= 0].tolist()
+        return self._upper[level - 1].get(node, ())
+
+    def _insert(self, node):
+        level = int(self.node_levels[node])
+        if self.entry_point < 0:
+            self.entry_point, self.max_level = node, level
+            return
+
+        q = self.vectors[node]
+        ep = [self.entry_point]
+        for lc in range(self.max_level, level, -1):
+            ep = [self._search_layer(q, ep, 1, lc)[0][1]]
+
+        for lc in range(min(level, self.max_level), -1, -1):
+            found = self._search_layer(q, ep, self.ef_construction, lc)
+            m_max = self.M0 if lc == 0 else self.M
+            chosen = self._select_neighbours(found, self.M)
+            self._links[node][lc] = chosen
+            for nb in chosen:
+                links = self._links[nb][lc]
+                links.append(node)
+                if len(links) > m_max:
+                    self._links[nb][lc] = self._closest(self.vectors[nb], links, m_max)
+            ep = [i for _, i in found]
+
+        if level > self.max_level:
+            self.entry_point, self.max_level = node, level
+
+    def _search_layer(self, q, entry_points, ef, level):
+        """Greedy best-first search on one layer; returns [(sq_dist, id)] nearest first."""
+        visited = set(entry_points)
+        d0 = _sq_to(self.vectors, q, entry_points)
+        candidates = list(zip(d0, entry_points))
+        heapq.heapify(candidates)
+        results = [(-d, i) for d, i in candidates]
+        heapq.heapify(results)
+        while len(results) > ef:
+            heapq.heappop(results)
+
+        while candidates:
+            dc, c = heapq.heappop(candidates)
+            if dc > -results[0][0]:
+                break
+            fresh = [nb for nb in self._neighbours(c, level) if nb not in visited]
+            if not fresh:
+                continue
+            visited.update(fresh)
+            for dn, nb in zip(_sq_to(self.vectors, q, fresh), fresh):
+                if len(results) < ef or dn < -results[0][0]:
+                    heapq.heappush(candidates, (dn, nb))
+                    heapq.heappush(results, (-dn, nb))
+                    if len(results) > ef:
+                        heapq.heappop(results)
+        return sorted((-d, i) for d, i in results)
+
+    def _select_neighbours(self, found, m):
+        """Neighbour selection heuristic: keep a candidate only if it is closer to
+        the new node than to every neighbour already kept (keeps the graph navigable)."""
+        ids = [i for _, i in found]
+        pair = _sq_distances(self.vectors[ids], self.vectors[ids]).tolist()
+        chosen, chosen_pos = [], []
+        for pos, (d, i) in enumerate(found):
+            if len(chosen) == m:
+                break
+            if any(pair[pos][c] < d for c in chosen_pos):
+                continue
+            chosen.append(i)
+            chosen_pos.append(pos)
+        if len(chosen) < m:
+            kept = set(chosen)
+            chosen += [i for _, i in found if i not in kept][:m - len(chosen)]
+        return chosen
+
+    def _closest(self, v, ids, m):
+        d = _sq_to(self.vectors, v, ids)
+        order = np.argsort(d, kind="stable")[:m]
+        return [ids[j] for j in order]
+
+    def _freeze(self):
+        n = len(self.vectors)
+        self._level0 = np.full((n, self.M0), -1, dtype=np.int32)
+        self._upper = [dict() for _ in range(max(self.max_level, 0))]
+        for node, levels in enumerate(self._links or []):
+            self._level0[node, :len(levels[0])] = levels[0]
+            for lc in range(1, len(levels)):
+                self._upper[lc - 1][node] = list(levels[lc])
+        self._links = None
+
+    def search(self, face_encodings, k=1):
+        queries = as_queries(face_encodings)
+        if self.entry_point < 0:
+            return _pad_results([[] for _ in queries], k)
+        ef = max(self.ef_search, k)
+        rows = []
+        for q in queries:
+            ep = [self.entry_point]
+            for lc in range(self.max_level, 0, -1):
+                ep = [self._search_layer(q, ep, 1, lc)[0][1]]
+            found = self._search_layer(q, ep, ef, 0)[:k]
+            cand = np.array([i for _, i in found], dtype=np.int64)
+            rows.append(_exact_rerank(self.vectors, q, cand, k))
+        return _pad_results(rows, k)
+
+    def state(self):
+        # Upper layers are flattened to (level, node, neighbour) triples
+        triples = [(lc + 1, node, nb)
+                   for lc, layer in enumerate(self._upper)
+                   for node, nbs in layer.items() for nb in nbs]
+        return {
+            "level0": self._level0,
+            "upper": np.asarray(triples, dtype=np.int32).reshape(-1, 3),
+            "node_levels": self.node_levels,
+            "entry_point": np.int64(self.entry_point),
+            "max_level": np.int32(self.max_level),
+            "M": np.int32(self.M),
+        }
+
+    def load_state(self, state, vectors):
+        self.vectors = vectors
+        self._level0 = state["level0"]
+        self.node_levels = state["node_levels"]
+        self.entry_point = int(state["entry_point"])
+        self.max_level = int(state["max_level"])
+        self.M = int(state["M"])
+        self.M0 = self._level0.shape[1]
+        self._upper = [dict() for _ in range(max(self.max_level, 0))]
+        for level, node, nb in state["upper"].tolist():
+            self._upper[level - 1].setdefault(node, []).append(nb)
+        self._links = None
+        return self
+
+
+def _sq_to(vectors, q, ids):
+    diff = vectors[ids] - q
+    return np.einsum("ij,ij->i", diff, diff).tolist()
+
+
+def _sq_distances(a, b):
+    sq = np.einsum("ij,ij->i", a, a)[:, None] + np.einsum("ij,ij->i", b, b)[None, :] - 2.0 * (a @ b.T)
+    return np.maximum(sq, 0.0, out=sq)
+
+
+def _nearest_centroid(vectors, centroids, chunk=8192):
+    out = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), chunk):
+        out[start:start + chunk] = np.argmin(_sq_distances(vectors[start:start + chunk], centroids), axis=1)
+    return out
+
+
+def _kmeans(vectors, k, n_iter, seed, max_train=256):
+    """Lloyd's k-means on a sample of at most max_train points per centroid."""
+    rng = np.random.default_rng(seed)
+    sample = vectors
+    if len(vectors) > k * max_train:
+        sample = vectors[rng.choice(len(vectors), k * max_train, replace=False)]
+    centroids = sample[rng.choice(len(sample), k, replace=False)].copy()
+    for _ in range(n_iter):
+        assign = _nearest_centroid(sample, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, sample)
+        counts = np.bincount(assign, minlength=k)
+        empty = counts == 0
+        centroids[~empty] = sums[~empty] / counts[~empty, None]
+        # Re-seed empty clusters from random points so every list gets used
+        if empty.any():
+            centroids[empty] = sample[rng.choice(len(sample), int(empty.sum()), replace=False)]
+    return centroids
+
+
+def make_index(kind):
+    """Unbuilt index of the given kind, tuned from environment variables."""
+    if kind == "brute":
+        return BruteForceIndex()
+    if kind == "ivf":
+        nlist = os.environ.get("IVF_NLIST")
+        return IVFIndex(nlist=int(nlist) if nlist else None,
+                        nprobe=int(os.environ.get("IVF_NPROBE", 8)))
+    if kind == "hnsw":
+        return HNSWIndex(M=int(os.environ.get("HNSW_M", 16)),
+                         ef_construction=int(os.environ.get("HNSW_EF_CONSTRUCTION", 100)),
+                         ef_search=int(os.environ.get("HNSW_EF_SEARCH", 64)))
+    if kind in ("fp16", "int8", "pq"):
+        from quantization import make_quantized_index  # imports this module
+        return make_quantized_index(kind)
+    raise ValueError(f"Unknown index kind '{kind}', expected one of {INDEX_KINDS}")
+
+
+def configured_index_kind():
+    return os.environ.get("GALLERY_INDEX", "brute").lower()
+
+
+def build_index(gallery, kind=None):
+    kind = kind or configured_index_kind()
+    return make_index(kind).build(gallery.encodings)
+
+
+def save_index(index, gallery, path=INDEX_PATH):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        np.savez(f, kind=np.str_(index.kind), fingerprint=np.str_(gallery.fingerprint()),
+                 **index.state())
+    os.replace(tmp_path, path)
+
+
+def load_index(gallery, path=INDEX_PATH):
+    """Saved index for this gallery, or None if missing or built from other encodings."""
+    if not os.path.exists(path):
+        return None
+    # Memory-mapped like the gallery, so server workers share one copy
+    state = load_npz(path, mmap=True)
+    if str(state.pop("fingerprint")) != gallery.fingerprint():
+        return None
+    return make_index(str(state.pop("kind"))).load_state(state, gallery.encodings)
+
+
+def attach_index(gallery, base_dir=".", kind=None):
+    """Attach the configured index to the gallery, loading it from disk when fresh."""
+    kind = kind or configured_index_kind()
+    if kind == "brute" or len(gallery) == 0:
+        gallery.index = None
+        return None
+
+    path = os.path.join(base_dir, INDEX_PATH)
+    index = load_index(gallery, path)
+    if index is None or index.kind != kind:
+        print(f"⚠️  No up-to-date {kind} index at {path}, building it in memory...")
+        index = build_index(gallery, kind)
+    gallery.index = index
+    return index
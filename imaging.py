@@ -0,0 +1,127 @@
+"""Image decoding shared by the API, train.py and recognize.py.
+
+Phone photos are far larger than detection needs. JPEGs are decoded straight
+to a reduced size in the DCT domain (OpenCV's IMREAD_REDUCED_COLOR_2/4/8,
+the same trick as PIL's draft mode), choosing the strongest reduction that
+still keeps the long side at DECODE_MAX_SIDE or more, so faces keep plenty
+of pixels for encoding. EXIF orientation is applied, so sideways phone
+photos come out upright.
+
+OpenCV decodes into one writable array; the BGR -> RGB swap happens in
+place. Formats OpenCV can't read (HEIC needs the optional pillow-heif
+package) go through PIL, with draft mode where the format supports it.
+Bytes and BytesIO uploads are decoded from their buffer without a copy.
+
+Boxes found on the decoded image map back to the original with
+DecodedImage.scale.
+"""
+from collections import namedtuple
+import io
+import math
+import os
+
+import cv2
+import numpy as np
+from PIL import Image, ImageOps
+
+DECODE_MAX_SIDE = int(os.environ.get("DECODE_MAX_SIDE", 1600))  # 0 decodes at full resolution
+ORIENTATION_TAG = 0x0112
+REDUCED_FLAGS = {2: cv2.IMREAD_REDUCED_COLOR_2, 4: cv2.IMREAD_REDUCED_COLOR_4, 8: cv2.IMREAD_REDUCED_COLOR_8}
+
+# rgb: (H, W, 3) uint8 array; size: (width, height) of the full upright image;
+# scale: decoded / full size (1.0 when decoded at full resolution)
+DecodedImage = namedtuple("DecodedImage", ["rgb", "size", "scale"])
+
+try:
+    from pillow_heif import register_heif_opener
+    register_heif_opener()
+except ImportError:
+    register_heif_opener = None
+
+
+def _buffer(source):
+    """Raw encoded bytes of a path, bytes-like object or file-like object, without copying if possible."""
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return source
+    if isinstance(source, io.BytesIO):
+        return source.getbuffer()
+    if hasattr(source, "read"):
+        return source.read()
+    with open(source, "rb") as f:
+        return f.read()
+
+
+def reduction_for(size, max_side=DECODE_MAX_SIDE):
+    """Largest JPEG reduction (1, 2, 4 or 8) that keeps the long side >= max_side."""
+    if not max_side:
+        return 1
+    reduction = 1
+    while reduction < 8 and max(size) / (reduction * 2) >= max_side:
+        reduction *= 2
+    return reduction
+
+
+def apply_orientation(array, orientation):
+    """Rotate / flip a decoded array the way EXIF orientation 1-8 says."""
+    if orientation == 2:
+        return cv2.flip(array, 1)
+    if orientation == 3:
+        return cv2.rotate(array, cv2.ROTATE_180)
+    if orientation == 4:
+        return cv2.flip(array, 0)
+    if orientation == 5:
+        return cv2.transpose(array)
+    if orientation == 6:
+        return cv2.rotate(array, cv2.ROTATE_90_CLOCKWISE)
+    if orientation == 7:
+        return cv2.flip(cv2.transpose(array), -1)
+    if orientation == 8:
+        return cv2.rotate(array, cv2.ROTATE_90_COUNTERCLOCKWISE)
+    return array
+
+
+def decode_image(source, max_side=DECODE_MAX_SIDE):
+    """Decode an image file, path or bytes into an upright RGB DecodedImage,
+    reduced towards max_side when the format allows it cheaply."""
+    data = _buffer(source)
+    # Header only: size, format and orientation without decoding any pixels
+    try:
+        image = Image.open(io.BytesIO(data))
+    except Image.UnidentifiedImageError:
+        if register_heif_opener is None and bytes(data[4:8]) == b"ftyp":
+            raise ValueError("HEIC images need the pillow-heif package (pip install pillow-heif)")
+        raise
+    orientation = image.getexif().get(ORIENTATION_TAG, 1)
+    width, height = image.size
+    full_size = (height, width) if orientation in (5, 6, 7, 8) else (width, height)
+
+    rgb = None
+    if image.format in ("JPEG", "PNG", "BMP", "TIFF", "WEBP"):
+        reduction = reduction_for(image.size, max_side) if image.format == "JPEG" else 1
+        flags = REDUCED_FLAGS.get(reduction, cv2.IMREAD_COLOR) | cv2.IMREAD_IGNORE_ORIENTATION
+        bgr = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), flags)
+        if bgr is not None:
+            rgb = cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB, dst=bgr)
+            rgb = apply_orientation(rgb, orientation)
+    if rgb is None:
+        rgb = _decode_with_pil(image, max_side)
+
+    return DecodedImage(rgb, full_size, rgb.shape[1] / full_size[0])
+
+
+def _decode_with_pil(image, max_side):
+    if max_side and max(image.size) > max_side:
+        # Formats with a draft mode (JPEG) decode at a reduced scale, others ignore it
+        factor = max_side / max(image.size)
+        image.draft("RGB", (math.ceil(image.width * factor), math.ceil(image.height * factor)))
+    image = ImageOps.exif_transpose(image)
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    return np.array(image)
+
+
+def scale_locations(locations, scale):
+    """(top, right, bottom, left) boxes on a decoded image -> full image coordinates."""
+    if scale == 1:
+        return list(locations)
+    return [tuple(int(round(v / scale)) for v in location) for location in locations]
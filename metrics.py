@@ -0,0 +1,195 @@
+"""Low-overhead metrics shared by the API, train.py and the realtime loop.
+
+Histograms have fixed buckets and only count (one bisect and a few additions
+under a lock per observation), gauges can be backed by a function that is
+only called when the metrics are rendered, so leaving them on costs a few
+microseconds per request. Everything lives in one registry per process and
+renders in the Prometheus text format: the API serves it at /metrics, batch
+jobs write it to METRICS_TEXTFILE (for node_exporter's textfile collector).
+With several gunicorn workers every worker reports its own numbers.
+
+METRICS=0 turns observations into no-ops.
+"""
+from bisect import bisect_left
+from contextlib import contextmanager
+import os
+import threading
+import time
+
+ENABLED = os.environ.get("METRICS", "1") != "0"
+TEXTFILE = os.environ.get("METRICS_TEXTFILE")
+
+# Seconds, from a cached gallery match to a slow upsampled HOG scan
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+FACE_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50)
+
+_registry = {}
+_registry_lock = threading.Lock()
+
+
+def _format_labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{value}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+
+def _format_value(value):
+    return repr(float(value)) if value not in (float("inf"), float("-inf")) else ("+Inf" if value > 0 else "-Inf")
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self._values = {}  # label values -> state
+        self._lock = threading.Lock()
+
+    def header(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, *label_values):
+        if not ENABLED:
+            return
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self):
+        with self._lock:
+            values = dict(self._values)
+        return self.header() + [f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}"
+                                for key, value in sorted(values.items())]
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def __init__(self, name, help_text, labels=()):
+        super().__init__(name, help_text, labels)
+        self._functions = {}
+
+    def set(self, value, *label_values):
+        with self._lock:
+            self._values[label_values] = value
+
+    def set_function(self, fn, *label_values):
+        """Read the value from fn() whenever the metrics are rendered."""
+        with self._lock:
+            self._functions[label_values] = fn
+
+    def render(self):
+        with self._lock:
+            values = dict(self._values)
+            functions = dict(self._functions)
+        for key, fn in functions.items():
+            try:
+                values[key] = fn()
+            except Exception:
+                continue  # e.g. nothing loaded yet
+        return self.header() + [f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}"
+                                for key, value in sorted(values.items())]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *label_values):
+        if not ENABLED:
+            return
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(label_values)
+            if state is None:
+                state = self._values[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][i] += 1
+            state[1] += value
+            state[2] += 1
+
+    def render(self):
+        with self._lock:
+            values = {key: ([*counts], total, count) for key, (counts, total, count) in self._values.items()}
+        lines = self.header()
+        for key, (counts, total, count) in sorted(values.items()):
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float("inf"),), counts):
+                cumulative += n
+                labels = _format_labels(self.labels + ("le",), key + (_format_value(bound),))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labels, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+def _register(cls, name, help_text, **kwargs):
+    with _registry_lock:
+        metric = _registry.get(name)
+        if metric is None:
+            metric = _registry[name] = cls(name, help_text, **kwargs)
+        return metric
+
+
+def counter(name, help_text, labels=()):
+    return _register(Counter, name, help_text, labels=labels)
+
+
+def gauge(name, help_text, labels=()):
+    return _register(Gauge, name, help_text, labels=labels)
+
+
+def histogram(name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+    return _register(Histogram, name, help_text, labels=labels, buckets=buckets)
+
+
+# Shared by every component, so dashboards can compare the API with training
+STAGE_SECONDS = histogram("face_stage_seconds", "Time spent in one pipeline stage", labels=("stage",))
+FACES_PER_IMAGE = histogram("face_faces_per_image", "Faces found per image or frame", buckets=FACE_BUCKETS)
+GALLERY_SIZE = gauge("face_gallery_size", "Face encodings in the loaded gallery")
+QUEUE_DEPTH = gauge("face_queue_depth", "Items waiting in a work queue", labels=("queue",))
+
+
+@contextmanager
+def timed(stage, timings=None):
+    """Observe the time spent in the block as STAGE_SECONDS{stage}; with a
+    timings dict, also add the milliseconds to timings[stage]."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        STAGE_SECONDS.observe(seconds, stage)
+        if timings is not None:
+            timings[stage] = round(timings.get(stage, 0.0) + seconds * 1000, 3)
+
+
+def render():
+    """Every registered metric in the Prometheus text format."""
+    with _registry_lock:
+        metrics = list(_registry.values())
+    lines = []
+    for metric in metrics:
+        lines += metric.render()
+    return "\n".join(lines) + "\n"
+
+
+def write_textfile(path=None):
+    """Write render() to path (default METRICS_TEXTFILE) atomically, if set."""
+    path = path or TEXTFILE
+    if not path:
+        return None
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(render())
+    os.replace(tmp_path, path)
+    return path
@@ -0,0 +1,158 @@
+"""Motion / change gate in front of face detection and uploads.
+
+Frames are shrunk to a small blurred grayscale thumbnail and compared with a
+running-average background (cv2.accumulateWeighted). If too few thumbnail
+pixels inside the configured regions of interest changed, the frame is
+considered unchanged and the caller skips detection / upload altogether;
+otherwise the changed areas come back as padded boxes in frame coordinates
+so only those need to be looked at.
+
+ROIs are polygons in fractions of the frame size, so they survive resolution
+changes, kept per camera in a JSON file (ROI_CONFIG):
+
+    {"door-cam": [[[0.1, 0.0], [0.6, 0.0], [0.6, 1.0], [0.1, 1.0]]]}
+"""
+import json
+import os
+
+import cv2
+import numpy as np
+
+THUMB_WIDTH = 160
+BLUR = 5
+PIXEL_THRESHOLD = 25  # gray-level difference that counts as a changed pixel
+MIN_CHANGED = 0.005  # changed share of the ROI that counts as a changed frame
+REGION_PAD = 0.25  # boxes grow by this share of their size on every side
+MIN_REGION_PX = 160  # smallest box side in frame pixels, enough for HOG to find a face
+
+
+def load_rois(path=None, camera_id=None):
+    """ROI polygons of one camera from ROI_CONFIG (None = whole frame)."""
+    path = path or os.environ.get("ROI_CONFIG")
+    camera_id = camera_id or os.environ.get("CAMERA_ID", "default")
+    if not path or not os.path.exists(path):
+        return None
+    with open(path) as f:
+        config = json.load(f)
+    return config.get(camera_id) or config.get("default")
+
+
+class MotionGate:
+    """Tells whether a frame changed (within the ROIs) since the recent background."""
+
+    def __init__(self, rois=None, learning_rate=0.1, min_changed=MIN_CHANGED,
+                 force_every=None):
+        self.rois = rois
+        self.learning_rate = learning_rate  # 1.0 = plain difference with the previous frame
+        self.min_changed = min_changed
+        self.force_every = force_every  # report a change at least every N frames
+        self.background = None
+        self.mask = None
+        self.changed_share = 0.0
+        self.frames = 0
+        self.skipped = 0
+        self._since_change = 0
+
+    def _thumbnail(self, frame):
+        h, w = frame.shape[:2]
+        size = (THUMB_WIDTH, max(1, round(h * THUMB_WIDTH / w)))
+        gray = frame if frame.ndim == 2 else cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        thumb = cv2.resize(gray, size, interpolation=cv2.INTER_AREA)
+        return cv2.GaussianBlur(thumb, (BLUR, BLUR), 0)
+
+    def _roi_mask(self, shape):
+        mask = np.zeros(shape, dtype=np.uint8)
+        if not self.rois:
+            mask[:] = 255
+            return mask
+        h, w = shape
+        for polygon in self.rois:
+            points = np.round(np.asarray(polygon, dtype=np.float32) * [w, h]).astype(np.int32)
+            cv2.fillPoly(mask, [points], 255)
+        return mask
+
+    def check(self, frame):
+        """Changed regions as (top, right, bottom, left) boxes in frame coordinates,
+        [] when the frame is unchanged. The first frame is all change."""
+        h, w = frame.shape[:2]
+        thumb = self._thumbnail(frame)
+        self.frames += 1
+        if self.background is None or self.background.shape != thumb.shape:
+            self.background = thumb.astype(np.float32)
+            self.mask = self._roi_mask(thumb.shape)
+            self._since_change = 0
+            return self._full_frame(h, w)
+
+        diff = cv2.absdiff(thumb, cv2.convertScaleAbs(self.background))
+        cv2.accumulateWeighted(thumb, self.background, self.learning_rate)
+        _, changed = cv2.threshold(diff, PIXEL_THRESHOLD, 255, cv2.THRESH_BINARY)
+        changed = cv2.bitwise_and(changed, self.mask)
+        self.changed_share = cv2.countNonZero(changed) / max(1, cv2.countNonZero(self.mask))
+
+        self._since_change += 1
+        if self.changed_share < self.min_changed:
+            if self.force_every and self._since_change >= self.force_every:
+                self._since_change = 0
+                return self._full_frame(h, w)
+            self.skipped += 1
+            return []
+        self._since_change = 0
+
+        changed = cv2.dilate(changed, None, iterations=2)
+        contours, _ = cv2.findContours(changed, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        scale = w / thumb.shape[1]
+        boxes = [_pad_box(cv2.boundingRect(c), scale, h, w) for c in contours]
+        return _merge_boxes(boxes)
+
+    def _full_frame(self, h, w):
+        if not self.rois:
+            return [(0, w, h, 0)]
+        x, y, bw, bh = cv2.boundingRect(self.mask)
+        return [_pad_box((x, y, bw, bh), w / self.mask.shape[1], h, w, pad=0)]
+
+    def contains(self, location, shape):
+        """Whether the centre of a (top, right, bottom, left) box lies inside the ROIs."""
+        if not self.rois or self.mask is None:
+            return True
+        top, right, bottom, left = location
+        h, w = shape[:2]
+        mh, mw = self.mask.shape
+        y = min(mh - 1, int((top + bottom) / 2 * mh / h))
+        x = min(mw - 1, int((left + right) / 2 * mw / w))
+        return self.mask[y, x] > 0
+
+    def stats(self):
+        return {
+            'frames': self.frames,
+            'skipped': self.skipped,
+            'changed_share': round(self.changed_share, 4)
+        }
+
+
+def _pad_box(rect, scale, h, w, pad=REGION_PAD):
+    """Thumbnail (x, y, w, h) -> padded frame (top, right, bottom, left)."""
+    x, y, bw, bh = (v * scale for v in rect)
+    cx, cy = x + bw / 2, y + bh / 2
+    half_w = max(bw * (1 + 2 * pad), MIN_REGION_PX) / 2
+    half_h = max(bh * (1 + 2 * pad), MIN_REGION_PX) / 2
+    return (int(max(0, cy - half_h)), int(min(w, cx + half_w)),
+            int(min(h, cy + half_h)), int(max(0, cx - half_w)))
+
+
+def _merge_boxes(boxes):
+    """Union overlapping boxes until none overlap."""
+    boxes = list(boxes)
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(boxes)):
+            for j in range(i + 1, len(boxes)):
+                a, b = boxes[i], boxes[j]
+                if a[0] < b[2] and b[0] < a[2] and a[3] < b[1] and b[3] < a[1]:
+                    boxes[i] = (min(a[0], b[0]), max(a[1], b[1]), max(a[2], b[2]), min(a[3], b[3]))
+                    del boxes[j]
+                    merged = True
+                    break
+            if merged:
+                break
+    return boxes
@@ -0,0 +1,260 @@
+"""Building blocks for staged (capture -> inference -> render) frame pipelines.
+
+Stages run in their own threads and are connected by bounded queues that drop
+the oldest item when full, so a slow stage never makes a faster one wait and
+never builds up a backlog of stale frames. FrameReader is the offline
+counterpart for files, where every frame matters: it reads ahead but blocks
+instead of dropping.
+"""
+import os
+import queue
+import threading
+import time
+from collections import deque
+
+import cv2
+
+
+class DropOldestQueue:
+    """Bounded queue whose put() discards the oldest item instead of blocking."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.dropped = 0
+        self._items = deque()
+        self._cond = threading.Condition()
+
+    def put(self, item):
+        with self._cond:
+            if len(self._items) >= self.maxsize:
+                self._items.popleft()
+                self.dropped += 1
+            self._items.append(item)
+            self._cond.notify()
+
+    def get(self, timeout=None):
+        """Oldest item, or None if nothing arrived within timeout."""
+        with self._cond:
+            if not self._items and not self._cond.wait_for(lambda: self._items, timeout):
+                return None
+            return self._items.popleft()
+
+    def drain(self):
+        with self._cond:
+            items = list(self._items)
+            self._items.clear()
+            return items
+
+    def __len__(self):
+        return len(self._items)
+
+
+class StageStats:
+    """Events per second of one stage over a sliding window."""
+
+    def __init__(self, name, window=2.0):
+        self.name = name
+        self.window = window
+        self.total = 0
+        self._times = deque()
+        self._lock = threading.Lock()
+
+    def tick(self, n=1):
+        now = time.perf_counter()
+        with self._lock:
+            self.total += n
+            self._times.extend([now] * n)
+            while self._times and now - self._times[0] > self.window:
+                self._times.popleft()
+
+    def rate(self):
+        now = time.perf_counter()
+        with self._lock:
+            while self._times and now - self._times[0] > self.window:
+                self._times.popleft()
+            return len(self._times) / self.window
+
+
+class FrameGrabber(threading.Thread):
+    """Capture thread that reads as fast as the camera delivers and keeps only
+    the newest frame, so the consumer never sees a backlog."""
+
+    def __init__(self, source=0):
+        super().__init__(name="capture", daemon=True)
+        self.capture = cv2.VideoCapture(source)
+        # Ask the driver not to queue frames on its side either
+        self.capture.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+        self.frames = DropOldestQueue(1)
+        self.stats = StageStats("capture")
+        self.finished = threading.Event()
+        self._stopping = threading.Event()
+
+    def is_opened(self):
+        return self.capture.isOpened()
+
+    def run(self):
+        frame_id = 0
+        while not self._stopping.is_set():
+            ret, frame = self.capture.read()
+            if not ret:
+                break
+            frame_id += 1
+            self.frames.put((frame_id, frame))
+            self.stats.tick()
+        self.finished.set()
+
+    def read(self, timeout=1.0):
+        """(frame_id, frame) of the newest frame, or None on timeout."""
+        return self.frames.get(timeout)
+
+    def stop(self):
+        self._stopping.set()
+        self.join(timeout=2)
+        self.capture.release()
+
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp", ".webp")
+
+
+class FrameReader(threading.Thread):
+    """Read-ahead decode thread for offline sources (video files or image
+    directories). Unlike FrameGrabber it never drops frames: it blocks once
+    `maxsize` decoded frames are waiting.
+
+    Iterating yields (frame_index, seconds, frame, name) for every `every`-th
+    frame from `start` on; skipped video frames are grabbed but not decoded.
+    """
+
+    _END = object()
+
+    def __init__(self, source, start=0, every=1, maxsize=8):
+        super().__init__(name="decode", daemon=True)
+        self.source = source
+        self.start_index = start
+        self.every = max(1, every)
+        self.frames = queue.Queue(maxsize)
+        self.stats = StageStats("decode")
+        self.error = None
+        self._stopping = threading.Event()
+        if os.path.isdir(source):
+            self.files = sorted(f for f in os.listdir(source) if f.lower().endswith(IMAGE_EXTENSIONS))
+            self.capture = None
+            self.fps = None
+            self.frame_count = len(self.files)
+        else:
+            self.files = None
+            self.capture = cv2.VideoCapture(source)
+            self.fps = self.capture.get(cv2.CAP_PROP_FPS) or None
+            self.frame_count = int(self.capture.get(cv2.CAP_PROP_FRAME_COUNT)) or None
+
+    def is_opened(self):
+        return self.files is not None or self.capture.isOpened()
+
+    def _put(self, item):
+        while not self._stopping.is_set():
+            try:
+                self.frames.put(item, timeout=0.2)
+                return
+            except queue.Full:
+                continue
+
+    def run(self):
+        try:
+            if self.files is not None:
+                self._read_directory()
+            else:
+                self._read_video()
+        except Exception as e:
+            self.error = e
+        finally:
+            self._put(self._END)
+
+    def _read_directory(self):
+        for index in range(self.start_index, len(self.files)):
+            if self._stopping.is_set():
+                return
+            if index % self.every:
+                continue
+            name = self.files[index]
+            frame = cv2.imread(os.path.join(self.source, name))
+            if frame is None:
+                print(f"⚠️  Skipping {name}: cannot decode")
+                continue
+            self._put((index, None, frame, name))
+            self.stats.tick()
+
+    def _read_video(self):
+        index = self.start_index
+        if index:
+            self.capture.set(cv2.CAP_PROP_POS_FRAMES, index)
+        while not self._stopping.is_set():
+            if not self.capture.grab():
+                return
+            if index % self.every == 0:
+                ret, frame = self.capture.retrieve()
+                if not ret:
+                    return
+                seconds = index / self.fps if self.fps else None
+                self._put((index, seconds, frame, None))
+                self.stats.tick()
+            index += 1
+
+    def __iter__(self):
+        while True:
+            item = self.frames.get()
+            if item is self._END:
+                if self.error:
+                    raise self.error
+                return
+            yield item
+
+    def stop(self):
+        self._stopping.set()
+        self.join(timeout=2)
+        if self.capture is not None:
+            self.capture.release()
+
+
+class WorkerPool:
+    """Threads running handler(job) for jobs from a drop-oldest queue; results
+    go to another drop-oldest queue the consumer drains when convenient."""
+
+    def __init__(self, handler, workers=2, max_pending=None, name="inference"):
+        self.handler = handler
+        self.jobs = DropOldestQueue(max_pending or workers)
+        self.results = DropOldestQueue(64)
+        self.stats = StageStats(name)
+        self.busy = 0
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._threads = [threading.Thread(target=self._run, name=f"{name}-{i}", daemon=True)
+                         for i in range(workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, job):
+        self.jobs.put(job)
+
+    def in_flight(self):
+        return len(self.jobs) + self.busy
+
+    def _run(self):
+        while not self._stopping.is_set():
+            job = self.jobs.get(timeout=0.2)
+            if job is None:
+                continue
+            with self._lock:
+                self.busy += 1
+            try:
+                self.results.put(self.handler(job))
+            except Exception as e:
+                print(f"❌ {threading.current_thread().name}: {e}")
+            finally:
+                with self._lock:
+                    self.busy -= 1
+            self.stats.tick()
+
+    def stop(self):
+        self._stopping.set()
+        for thread in self._threads:
+            thread.join(timeout=2)
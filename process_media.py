@@ -0,0 +1,297 @@
+"""Headless face recognition over video files, image directories and streams.
+
+    python process_media.py footage.mp4 --annotate footage.annotated.mp4
+    python process_media.py frames/ --workers 8 -o frames.faces.jsonl
+    python process_media.py rtsp://camera/stream --every 5
+
+Frames are decoded in a background thread and recognized across a process
+pool (every worker memory-maps the same gallery). Results are written in
+frame order, one JSON line per processed frame, so the output can be read
+while it grows. For files and directories a checkpoint next to the output
+records how much of it is complete, and an interrupted run resumes there
+(with --annotate, the frames already in the video are copied into the resumed
+one, so it covers the whole run).
+"""
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque
+import argparse
+import json
+import os
+import time
+
+import cv2
+
+from detection import AdaptiveDetector
+from gallery import load_shared_gallery
+from gallery_index import attach_index
+from pipeline import FrameGrabber, FrameReader
+from prototypes import apply_gallery_mode
+
+CHECKPOINT_EVERY = 5.0  # seconds between checkpoint writes
+REPORT_EVERY = 5.0
+STREAM_PREFIXES = ("rtsp://", "rtmp://", "http://", "https://")
+
+_worker = {}
+
+
+def init_worker(target_ms):
+    # Parallelism comes from the process pool, keep OpenCV to one thread per worker
+    cv2.setNumThreads(1)
+    gallery, _ = load_shared_gallery(".")
+    attach_index(gallery)
+    _worker["gallery"] = apply_gallery_mode(gallery)
+    _worker["detector"] = AdaptiveDetector(target_ms)
+
+
+def recognize_frame(rgb_frame):
+    """Detect, encode and match one frame (runs in a worker process)."""
+    import face_recognition
+    face_locations = _worker["detector"].detect(rgb_frame)
+    face_encodings = face_recognition.face_encodings(rgb_frame, face_locations)
+    matches = _worker["gallery"].match_faces(face_encodings, tolerance=0.6)
+    faces = []
+    for (top, right, bottom, left), match in zip(face_locations, matches):
+        faces.append({
+            "name": match.name,
+            "confidence": round(float(match.confidence), 2),
+            "distance": round(match.distance, 4) if match.distance != float("inf") else None,
+            "location": {"top": int(top), "right": int(right), "bottom": int(bottom), "left": int(left)}
+        })
+    return faces
+
+
+def load_checkpoint(path, source, every):
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        checkpoint = json.load(f)
+    if checkpoint.get("source") != os.path.abspath(source) or checkpoint.get("every") != every:
+        print(f"⚠️  {path} belongs to a different source or --every, starting over")
+        return None
+    return checkpoint
+
+
+def save_checkpoint(path, checkpoint):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(checkpoint, f)
+    os.replace(tmp_path, path)
+
+
+def live_frames(grabber, every):
+    """(frame_index, seconds, frame, name) from a live stream, newest frame only.
+
+    The grabber drops frames we are too slow for, so its frame ids have gaps;
+    a frame is taken once at least `every` frames were captured since the last.
+    """
+    start = time.time()
+    last_id = None
+    while True:
+        item = grabber.read(timeout=1.0)
+        if item is None:
+            if grabber.finished.is_set():
+                return
+            continue
+        frame_id, frame = item
+        if last_id is None or frame_id - last_id >= every:
+            last_id = frame_id
+            yield frame_id, time.time() - start, frame, None
+
+
+def resume_annotation(path, frames, fps):
+    """(writer, size, temporary path) continuing the annotated video at path.
+
+    A video can't be appended to in place, so its first `frames` frames are
+    copied into a new one next to it, which replaces it when the run ends.
+    None if path doesn't hold that many frames (e.g. the previous run crashed
+    before the video was finalized).
+    """
+    capture = cv2.VideoCapture(path)
+    root, ext = os.path.splitext(path)
+    tmp_path = f"{root}.resume{ext}"
+    writer = size = None
+    copied = 0
+    while copied < frames:
+        ret, frame = capture.read()
+        if not ret:
+            break
+        if writer is None:
+            size = (frame.shape[1], frame.shape[0])
+            writer = cv2.VideoWriter(tmp_path, cv2.VideoWriter_fourcc(*"mp4v"), fps, size)
+        writer.write(frame)
+        copied += 1
+    capture.release()
+    if copied < frames:
+        if writer is not None:
+            writer.release()
+            os.remove(tmp_path)
+        return None
+    return writer, size, tmp_path
+
+
+def draw_faces(frame, faces):
+    for face in faces:
+        loc = face["location"]
+        color = (0, 255, 0) if face["name"] != "Unknown" else (0, 0, 255)
+        cv2.rectangle(frame, (loc["left"], loc["top"]), (loc["right"], loc["bottom"]), color, 2)
+        cv2.putText(frame, f"{face['name']} ({face['confidence']:.1f}%)", (loc["left"], loc["bottom"] + 20),
+                    cv2.FONT_HERSHEY_DUPLEX, 0.6, color, 1)
+    return frame
+
+
+def process_media(source, output=None, workers=None, every=1, annotate=None, live=None,
+                  restart=False, target_ms=None):
+    """Recognize faces in every `every`-th frame of source, writing JSONL to output."""
+    if live is None:
+        live = source.startswith(STREAM_PREFIXES) or source.isdigit()
+    name = os.path.basename(os.path.normpath(source)) if not source.isdigit() else f"camera{source}"
+    output = output or f"{os.path.splitext(name)[0]}.faces.jsonl"
+    checkpoint_path = f"{output}.ckpt"
+    workers = workers or os.cpu_count() or 1
+
+    # Load (and convert a legacy pickle) once here, workers then only map it
+    gallery, gallery_path = load_shared_gallery(".")
+    print(f"Gallery: {len(gallery)} encodings from {gallery_path}")
+
+    checkpoint = None if live or restart else load_checkpoint(checkpoint_path, source, every)
+    start = checkpoint["next_frame"] if checkpoint else 0
+    if live:
+        reader = FrameGrabber(int(source) if source.isdigit() else source)
+    else:
+        reader = FrameReader(source, start=start, every=every, maxsize=workers * 2)
+    if not reader.is_opened():
+        print(f"❌ Could not open {source}")
+        return
+
+    fps = None if live else reader.fps
+    # Only processed frames are written, so the video runs at the sampled rate
+    video_fps = fps / every if fps else 5
+    writer = None
+    writer_size = None
+    writer_path = annotate
+    if annotate and checkpoint and checkpoint["frames_done"]:
+        resumed = resume_annotation(annotate, checkpoint["frames_done"], video_fps)
+        if resumed is None:
+            print(f"❌ {annotate} doesn't hold the {checkpoint['frames_done']} annotated frame(s) of the "
+                  f"interrupted run, rerun with --restart to start over")
+            return
+        writer, writer_size, writer_path = resumed
+
+    out = open(output, "r+b" if checkpoint else "wb")
+    if checkpoint:
+        # Anything after the checkpointed size is a partial line from the crash
+        out.truncate(checkpoint["output_bytes"])
+        out.seek(checkpoint["output_bytes"])
+        print(f"🔄 Resuming {source} at frame {start} ({checkpoint['frames_done']} frame(s) already in {output})")
+    frames_done = checkpoint["frames_done"] if checkpoint else 0
+
+    window = deque()
+    last_checkpoint = last_report = run_start = time.perf_counter()
+    frames_this_run = 0
+    last_seconds = None
+    next_frame = start
+
+    def checkpoint_now():
+        out.flush()
+        save_checkpoint(checkpoint_path, {
+            "source": os.path.abspath(source),
+            "every": every,
+            "next_frame": next_frame,
+            "output_bytes": out.tell(),
+            "frames_done": frames_done
+        })
+
+    def write(item):
+        nonlocal writer, writer_size, frames_done, frames_this_run, last_seconds, next_frame
+        index, seconds, frame, file_name, future = item
+        faces = future.result()
+        record = {"frame": index, "time": round(seconds, 3) if seconds is not None else None, "faces": faces}
+        if file_name:
+            record["file"] = file_name
+        out.write((json.dumps(record) + "\n").encode())
+        frames_done += 1
+        frames_this_run += 1
+        last_seconds = seconds
+        next_frame = index + 1
+        if annotate:
+            if writer is None:
+                writer_size = (frame.shape[1], frame.shape[0])
+                writer = cv2.VideoWriter(writer_path, cv2.VideoWriter_fourcc(*"mp4v"), video_fps, writer_size)
+            if (frame.shape[1], frame.shape[0]) != writer_size:
+                frame = cv2.resize(frame, writer_size)
+            writer.write(draw_faces(frame, faces))
+
+    print(f"Processing {source} with {workers} worker(s) -> {output}")
+    reader.start()
+    frames = live_frames(reader, every) if live else iter(reader)
+
+    try:
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(target_ms,)) as pool:
+            for index, seconds, frame, file_name in frames:
+                rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+                window.append((index, seconds, frame if annotate else None, file_name,
+                               pool.submit(recognize_frame, rgb_frame)))
+
+                # Write finished frames in order; wait for the oldest once enough are in flight
+                while window and (len(window) > workers * 2 or window[0][4].done()):
+                    write(window.popleft())
+
+                    now = time.perf_counter()
+                    if not live and now - last_checkpoint >= CHECKPOINT_EVERY:
+                        checkpoint_now()
+                        last_checkpoint = now
+                    if now - last_report >= REPORT_EVERY:
+                        last_report = now
+                        print(progress_report(frames_this_run, now - run_start, last_seconds, start, fps))
+
+            while window:
+                write(window.popleft())
+    except KeyboardInterrupt:
+        if live:
+            print("\nStopped")
+        else:
+            checkpoint_now()
+            print(f"\n⚠️  Interrupted at frame {next_frame}, rerun the same command to resume")
+        return
+    finally:
+        reader.stop()
+        out.close()
+        if writer is not None:
+            writer.release()
+            if writer_path != annotate:
+                os.replace(writer_path, annotate)
+
+    elapsed = time.perf_counter() - run_start
+    print(progress_report(frames_this_run, elapsed, last_seconds, start, fps))
+    if os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    print(f"✅ {frames_done} frame(s) written to {output}")
+    if annotate:
+        print(f"✅ Annotated video saved as {annotate}")
+
+
+def progress_report(frames, elapsed, last_seconds, start, fps):
+    report = f"  {frames} frame(s) in {elapsed:.1f}s ({frames / max(elapsed, 1e-9):.1f} frames/s)"
+    if fps and last_seconds is not None:
+        # How much footage was covered per wall-clock second
+        covered = last_seconds - start / fps
+        report += f", {covered / max(elapsed, 1e-9):.1f}x real time"
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Recognize faces in a video file, image directory or stream")
+    parser.add_argument("source", help="video file, directory of images, stream URL or camera index")
+    parser.add_argument("-o", "--output", help="JSONL output (default: <source name>.faces.jsonl)")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: all cores)")
+    parser.add_argument("--every", type=int, default=1, help="process every Nth frame")
+    parser.add_argument("--annotate", metavar="VIDEO", help="also write the processed frames with boxes to this video")
+    parser.add_argument("--live", action="store_true", default=None,
+                        help="treat the source as live (keep only the newest frame, no checkpoints); "
+                             "implied for stream URLs and camera indexes")
+    parser.add_argument("--restart", action="store_true", help="ignore an existing checkpoint")
+    parser.add_argument("--target-ms", type=float, default=None,
+                        help="detection latency budget per frame (default: DETECT_TARGET_MS or 500)")
+    args = parser.parse_args()
+    process_media(args.source, output=args.output, workers=args.workers, every=args.every,
+                  annotate=args.annotate, live=args.live, restart=args.restart, target_ms=args.target_ms)
@@ -0,0 +1,192 @@
+"""Per-identity prototype gallery ("prototype" gallery mode).
+
+Instead of every training sample, each person is represented by their centroid
+or a few k-medoids, plus spread statistics of their samples around those
+prototypes. Faces are matched against the prototypes first, which is a gallery
+an order of magnitude smaller for people with many photos, and each person gets
+their own tolerance derived from their spread instead of the global 0.6.
+Optionally the winning candidates are re-ranked against their raw samples;
+the nearest-sample distance is then held to the global tolerance, as in the
+samples mode, since the per-person tolerances describe distances to prototypes.
+
+Enable with GALLERY_MODE=prototype (PROTOTYPE_RERANK=1 for the re-rank step).
+"""
+import os
+
+import numpy as np
+
+from gallery import DEFAULT_TOLERANCE, FaceGallery, Match, UNKNOWN_NAME, as_queries
+
+PROTOTYPES_PATH = "encodings.prototypes.npz"
+MAX_PROTOTYPES = 3
+SAMPLES_PER_PROTOTYPE = 20  # one extra medoid per this many samples, up to MAX_PROTOTYPES
+MIN_SAMPLES_FOR_SPREAD = 3  # fewer samples than this fall back to the global tolerance
+SPREAD_SIGMAS = 3.0
+MIN_TOLERANCE = 0.45  # floor so near-duplicate training photos don't make a person unmatchable
+
+
+class PrototypeGallery:
+    """Prototype matcher with the same match_faces() interface as FaceGallery.
+
+    Match.index is a prototype row, or a raw sample row when re-ranking.
+    """
+
+    def __init__(self, prototypes, tolerances, spread, samples=None):
+        self.prototypes = prototypes  # FaceGallery, one or more rows per person
+        self.tolerances = np.asarray(tolerances, dtype=np.float32)  # per label
+        self.spread = spread  # {"mean", "std", "max", "count"} arrays per label
+        self.samples = samples  # raw FaceGallery, needed only for re-ranking
+        self.rerank = False
+        self._sample_rows = None
+
+    def __len__(self):
+        return len(self.samples) if self.samples is not None else len(self.prototypes)
+
+    @property
+    def known_people(self):
+        return self.prototypes.known_people
+
+    @property
+    def label_names(self):
+        return self.prototypes.label_names
+
+    def tolerance_for(self, label, tolerance=DEFAULT_TOLERANCE):
+        """Per-identity tolerance, never looser than the global one."""
+        return min(float(self.tolerances[label]), tolerance)
+
+    def match_faces(self, face_encodings, tolerance=DEFAULT_TOLERANCE, candidates=3):
+        queries = as_queries(face_encodings)
+        if len(self.prototypes) == 0:
+            return [Match(UNKNOWN_NAME, 0.0, float("inf"), -1) for _ in queries]
+
+        # A few extra prototypes so several distinct people can be candidates
+        k = min(len(self.prototypes), candidates * MAX_PROTOTYPES)
+        idx, dists = self.prototypes.exact_top_k(queries, k)
+        results = []
+        for q, row_idx, row_d in zip(queries, idx, dists):
+            best = {}
+            for i, d in zip(row_idx.tolist(), row_d.tolist()):
+                label = int(self.prototypes.labels[i])
+                if label not in best:
+                    best[label] = (d, i)
+                if len(best) == candidates:
+                    break
+
+            reranked = self.rerank and self.samples is not None
+            if reranked:
+                best = {label: self._nearest_sample(q, label) for label in best}
+
+            label, (d, i) = min(best.items(), key=lambda item: item[1][0])
+            if d <= (tolerance if reranked else self.tolerance_for(label, tolerance)):
+                results.append(Match(self.label_names[label], (1 - d) * 100, d, i))
+            else:
+                results.append(Match(UNKNOWN_NAME, 0.0, d, i))
+        return results
+
+    def _nearest_sample(self, query, label):
+        """Exact distance to the closest raw sample of one person."""
+        if self._sample_rows is None:
+            order = np.argsort(self.samples.labels, kind="stable")
+            offsets = np.searchsorted(self.samples.labels[order], np.arange(len(self.label_names) + 1))
+            self._sample_rows = (order, offsets)
+        order, offsets = self._sample_rows
+        rows = order[offsets[label]:offsets[label + 1]]
+        d = np.linalg.norm(self.samples.encodings[rows] - query, axis=1)
+        j = int(np.argmin(d))
+        return float(d[j]), int(rows[j])
+
+
+def build_prototypes(gallery, max_prototypes=MAX_PROTOTYPES, tolerance=DEFAULT_TOLERANCE):
+    """Centroid (or k-medoids for people with many photos) per person plus spread stats."""
+    n_labels = len(gallery.label_names)
+    proto_rows, proto_labels = [], []
+    spread = {key: np.zeros(n_labels, dtype=np.float32) for key in ("mean", "std", "max")}
+    spread["count"] = np.zeros(n_labels, dtype=np.int32)
+    tolerances = np.full(n_labels, tolerance, dtype=np.float32)
+
+    for label in range(n_labels):
+        samples = gallery.encodings[gallery.labels == label]
+        if len(samples) == 0:
+            continue
+        k = min(max_prototypes, 1 + (len(samples) - 1) // SAMPLES_PER_PROTOTYPE)
+        protos = samples.mean(axis=0, keepdims=True) if k == 1 else _k_medoids(samples, k)
+        proto_rows.append(protos)
+        proto_labels += [label] * len(protos)
+
+        # Spread: distance of each sample to its nearest prototype
+        d = np.min(np.linalg.norm(samples[:, None, :] - protos[None, :, :], axis=2), axis=1)
+        spread["mean"][label], spread["std"][label], spread["max"][label] = d.mean(), d.std(), d.max()
+        spread["count"][label] = len(samples)
+        if len(samples) >= MIN_SAMPLES_FOR_SPREAD:
+            tolerances[label] = np.clip(d.mean() + SPREAD_SIGMAS * d.std(), MIN_TOLERANCE, tolerance)
+
+    encodings = np.concatenate(proto_rows) if proto_rows else np.empty((0, 128), dtype=np.float32)
+    prototypes = FaceGallery(encodings, proto_labels, gallery.label_names)
+    return PrototypeGallery(prototypes, tolerances, spread, samples=gallery)
+
+
+def _k_medoids(samples, k, n_iter=20):
+    """Alternating k-medoids on the person's own pairwise distance matrix."""
+    sq_norms = np.einsum("ij,ij->i", samples, samples)
+    dist = np.sqrt(np.maximum(sq_norms[:, None] + sq_norms[None, :] - 2.0 * (samples @ samples.T), 0.0))
+    # Deterministic farthest-point seeding, starting from the most central sample
+    medoids = [int(np.argmin(dist.sum(axis=1)))]
+    while len(medoids) < k:
+        medoids.append(int(np.argmax(dist[:, medoids].min(axis=1))))
+    medoids = np.array(medoids)
+    for _ in range(n_iter):
+        assign = np.argmin(dist[:, medoids], axis=1)
+        new = medoids.copy()
+        for c in range(k):
+            members = np.flatnonzero(assign == c)
+            if len(members):
+                new[c] = members[np.argmin(dist[np.ix_(members, members)].sum(axis=1))]
+        if np.array_equal(new, medoids):
+            break
+        medoids = new
+    return samples[medoids]
+
+
+def save_prototypes(protos, path=PROTOTYPES_PATH):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        np.savez(
+            f,
+            fingerprint=np.str_(protos.samples.fingerprint()),
+            encodings=protos.prototypes.encodings,
+            labels=protos.prototypes.labels,
+            label_names=np.array(protos.label_names, dtype=np.str_),
+            tolerances=protos.tolerances,
+            **{f"spread_{key}": value for key, value in protos.spread.items()},
+        )
+    os.replace(tmp_path, path)
+
+
+def load_prototypes(gallery, path=PROTOTYPES_PATH):
+    """Saved prototypes for this gallery, or None if missing or stale."""
+    if not os.path.exists(path):
+        return None
+    with np.load(path, allow_pickle=False) as data:
+        if str(data["fingerprint"]) != gallery.fingerprint():
+            return None
+        prototypes = FaceGallery(data["encodings"], data["labels"], data["label_names"].tolist())
+        spread = {key: data[f"spread_{key}"] for key in ("mean", "std", "max", "count")}
+        return PrototypeGallery(prototypes, data["tolerances"], spread, samples=gallery)
+
+
+def configured_gallery_mode():
+    return os.environ.get("GALLERY_MODE", "samples").lower()
+
+
+def apply_gallery_mode(gallery, base_dir="."):
+    """The matcher to use for this gallery: itself, or its prototypes in prototype mode."""
+    if configured_gallery_mode() != "prototype":
+        return gallery
+    path = os.path.join(base_dir, PROTOTYPES_PATH)
+    protos = load_prototypes(gallery, path)
+    if protos is None:
+        print(f"⚠️  No up-to-date prototypes at {path}, building them in memory...")
+        protos = build_prototypes(gallery)
+    protos.rerank = os.environ.get("PROTOTYPE_RERANK", "0") == "1"
+    print(f"✅ Prototype mode: {len(protos.prototypes)} prototypes for {len(protos.label_names)} people")
+    return protos
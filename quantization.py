@@ -0,0 +1,266 @@
+"""Compressed gallery storage: float16, int8 and product-quantized encodings.
+
+A float32 encoding takes 512 bytes (the float64 arrays in encodings.pkl take
+1KB plus object overhead). The codecs here keep a compact copy of every row:
+
+- "fp16": half precision, 256 bytes per face
+- "int8": one byte per dimension with a per-dimension scale and offset, 128 bytes
+- "pq":   product quantization, PQ_M sub-vectors each replaced by the id of the
+          nearest of 256 sub-centroids, PQ_M bytes per face (16 by default)
+
+fp16 and int8 also keep the squared norm of each decoded row (4 bytes), so a
+scan is one cast and one matrix product per block. PQ uses asymmetric distance
+tables: the query stays float32, only the gallery side is quantized, and the
+distance to a row is the sum of PQ_M table lookups.
+
+QuantizedIndex scans the codes to shortlist QUANT_RERANK candidates per query
+and re-ranks them with exact float32 distances. Only the shortlisted rows of
+the float32 matrix are read, so with the gallery memory-mapped the full
+matrix stays on disk and out of RAM. QUANT_RERANK=0 skips the re-rank and
+returns the approximate distances.
+
+They plug into gallery_index.py as the fp16, int8 and pq index kinds.
+"""
+import os
+
+import numpy as np
+
+from gallery import ENCODING_DIM, as_queries
+from gallery_index import _exact_rerank, _kmeans, _nearest_centroid, _pad_results, _sq_distances
+
+QUANT_KINDS = ("fp16", "int8", "pq")
+# Rows decoded / scored per block (2MB of float32, stays in cache)
+SCAN_CHUNK = 4096
+
+
+class Float16Codec:
+    kind = "fp16"
+
+    def train(self, vectors):
+        return self
+
+    def encode(self, vectors):
+        return np.asarray(vectors, dtype=np.float16)
+
+    def decode(self, codes, out=None):
+        out = np.empty(codes.shape, dtype=np.float32) if out is None else out
+        np.copyto(out, codes)
+        return out
+
+    def prepare(self, queries):
+        return queries
+
+    def dot(self, prepared, codes, scratch):
+        """Query . decoded row for every query and row of a block."""
+        return prepared @ self.decode(codes, scratch[:len(codes)]).T
+
+    def state(self):
+        return {}
+
+    def load_state(self, state):
+        return self
+
+
+class Int8Codec:
+    """Scalar quantization: each dimension mapped linearly from its min..max to 0..255."""
+
+    kind = "int8"
+
+    def __init__(self):
+        self.offset = None
+        self.scale = None
+
+    def train(self, vectors):
+        lo = np.asarray(vectors.min(axis=0), dtype=np.float32)
+        hi = np.asarray(vectors.max(axis=0), dtype=np.float32)
+        self.offset = lo
+        self.scale = np.maximum(hi - lo, 1e-12) / 255.0
+        return self
+
+    def encode(self, vectors):
+        scaled = np.rint((np.asarray(vectors, dtype=np.float32) - self.offset) / self.scale)
+        return np.clip(scaled, 0, 255).astype(np.uint8)
+
+    def decode(self, codes, out=None):
+        out = np.empty(codes.shape, dtype=np.float32) if out is None else out
+        np.copyto(out, codes, casting="unsafe")
+        out *= self.scale
+        out += self.offset
+        return out
+
+    def prepare(self, queries):
+        # q . (offset + scale * c) = q . offset + (q * scale) . c, so rows are never rescaled
+        return queries * self.scale, queries @ self.offset
+
+    def dot(self, prepared, codes, scratch):
+        scaled_queries, offset_dot = prepared
+        block = scratch[:len(codes)]
+        np.copyto(block, codes, casting="unsafe")
+        return scaled_queries @ block.T + offset_dot[:, None]
+
+    def state(self):
+        return {"offset": self.offset, "scale": self.scale}
+
+    def load_state(self, state):
+        self.offset = np.asarray(state["offset"], dtype=np.float32)
+        self.scale = np.asarray(state["scale"], dtype=np.float32)
+        return self
+
+
+class PQCodec:
+    """Product quantization with 256 centroids (one byte) per sub-vector."""
+
+    kind = "pq"
+
+    def __init__(self, m=16, n_iter=15, seed=0):
+        if ENCODING_DIM % m:
+            raise ValueError(f"PQ_M must divide {ENCODING_DIM}, got {m}")
+        self.m = m
+        self.n_iter = n_iter
+        self.seed = seed
+        self.codebooks = None  # (m, ksub, ENCODING_DIM // m)
+
+    def _split(self, vectors):
+        return np.asarray(vectors, dtype=np.float32).reshape(len(vectors), self.m, -1)
+
+    def train(self, vectors):
+        ksub = max(1, min(256, len(vectors)))
+        subs = self._split(vectors)
+        self.codebooks = np.stack([_kmeans(np.ascontiguousarray(subs[:, j]), ksub, self.n_iter, self.seed + j)
+                                   for j in range(self.m)])
+        return self
+
+    def encode(self, vectors):
+        subs = self._split(vectors)
+        codes = np.empty((len(vectors), self.m), dtype=np.uint8)
+        for j in range(self.m):
+            codes[:, j] = _nearest_centroid(np.ascontiguousarray(subs[:, j]), self.codebooks[j])
+        return codes
+
+    def decode(self, codes, out=None):
+        return np.concatenate([self.codebooks[j][codes[:, j]] for j in range(self.m)], axis=1)
+
+    def distance_tables(self, queries):
+        """(M, m, ksub) squared distances from every query sub-vector to every sub-centroid."""
+        subs = self._split(queries)
+        return np.stack([_sq_distances(np.ascontiguousarray(subs[:, j]), self.codebooks[j])
+                         for j in range(self.m)], axis=1)
+
+    def sq_distances(self, tables, codes):
+        """Asymmetric distances of a block: sums of table lookups."""
+        out = np.zeros((len(tables), len(codes)), dtype=np.float32)
+        for j in range(self.m):
+            column = np.ascontiguousarray(codes[:, j])
+            for r in range(len(tables)):
+                out[r] += tables[r, j].take(column)
+        return out
+
+    def state(self):
+        return {"codebooks": self.codebooks}
+
+    def load_state(self, state):
+        self.codebooks = np.asarray(state["codebooks"], dtype=np.float32)
+        self.m = self.codebooks.shape[0]
+        return self
+
+
+class QuantizedIndex:
+    """Scan compact codes for a shortlist, re-rank it with exact float32 distances."""
+
+    quantized = True
+
+    def __init__(self, codec, rerank=32):
+        self.codec = codec
+        self.kind = codec.kind
+        self.rerank = rerank
+        self.vectors = None
+        self.codes = None
+        self.sq_norms = None  # of the decoded rows, scalar codecs only
+
+    @property
+    def bytes_per_vector(self):
+        size = self.codes.itemsize * int(np.prod(self.codes.shape[1:]))
+        return size + (self.sq_norms.itemsize if self.sq_norms is not None else 0)
+
+    def build(self, vectors):
+        self.vectors = vectors
+        self.codec.train(vectors)
+        # Encoded block by block, so a memory-mapped gallery is never fully copied
+        blocks = [self.codec.encode(vectors[start:start + SCAN_CHUNK])
+                  for start in range(0, len(vectors), SCAN_CHUNK)]
+        self.codes = np.concatenate(blocks) if blocks else self.codec.encode(vectors)
+        if self.kind != "pq":
+            self.sq_norms = np.empty(len(self.codes), dtype=np.float32)
+            for start in range(0, len(self.codes), SCAN_CHUNK):
+                decoded = self.codec.decode(self.codes[start:start + SCAN_CHUNK])
+                self.sq_norms[start:start + len(decoded)] = np.einsum("ij,ij->i", decoded, decoded)
+        return self
+
+    def approximate_sq_distances(self, queries):
+        """(M, N) approximate squared distances from the codes alone."""
+        n = len(self.codes)
+        out = np.empty((len(queries), n), dtype=np.float32)
+        if self.kind == "pq":
+            tables = self.codec.distance_tables(queries)
+            for start in range(0, n, SCAN_CHUNK):
+                chunk = self.codes[start:start + SCAN_CHUNK]
+                out[:, start:start + len(chunk)] = self.codec.sq_distances(tables, chunk)
+            return out
+
+        prepared = self.codec.prepare(queries)
+        q_norms = np.einsum("ij,ij->i", queries, queries)[:, None]
+        scratch = np.empty((min(SCAN_CHUNK, n), ENCODING_DIM), dtype=np.float32)
+        for start in range(0, n, SCAN_CHUNK):
+            chunk = self.codes[start:start + SCAN_CHUNK]
+            block = out[:, start:start + len(chunk)]
+            block[...] = self.codec.dot(prepared, chunk, scratch)
+            block *= -2.0
+            block += q_norms
+            block += self.sq_norms[start:start + len(chunk)]
+        return out
+
+    def search(self, face_encodings, k=1):
+        queries = as_queries(face_encodings)
+        n = len(self.codes)
+        if n == 0 or len(queries) == 0:
+            return _pad_results([[] for _ in queries], k)
+        sq = self.approximate_sq_distances(queries)
+        shortlist = min(max(k, self.rerank), n)
+        if shortlist < n:
+            cand = np.argpartition(sq, shortlist - 1, axis=1)[:, :shortlist]
+        else:
+            cand = np.broadcast_to(np.arange(n), sq.shape)
+
+        rows = []
+        for q, c, d in zip(queries, cand, sq):
+            if self.rerank:
+                rows.append(_exact_rerank(self.vectors, q, c, k))
+            else:
+                order = c[np.argsort(d[c], kind="stable")][:k]
+                rows.append(list(zip(np.sqrt(np.maximum(d[order], 0.0)).tolist(), order.tolist())))
+        return _pad_results(rows, k)
+
+    def state(self):
+        state = {"codes": self.codes, **self.codec.state()}
+        if self.sq_norms is not None:
+            state["code_sq_norms"] = self.sq_norms
+        return state
+
+    def load_state(self, state, vectors):
+        self.vectors = vectors
+        self.codes = state["codes"]
+        self.sq_norms = state.get("code_sq_norms")
+        self.codec.load_state(state)
+        return self
+
+
+def make_quantized_index(kind):
+    """Unbuilt quantized index of the given kind, tuned from environment variables."""
+    rerank = int(os.environ.get("QUANT_RERANK", 32))
+    if kind == "fp16":
+        return QuantizedIndex(Float16Codec(), rerank)
+    if kind == "int8":
+        return QuantizedIndex(Int8Codec(), rerank)
+    if kind == "pq":
+        return QuantizedIndex(PQCodec(m=int(os.environ.get("PQ_M", 16))), rerank)
+    raise ValueError(f"Unknown quantization '{kind}', expected one of {QUANT_KINDS}")
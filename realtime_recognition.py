@@ -1,133 +1,260 @@
-import face_recognition
-import pickle
 import cv2
-import numpy as np
-from datetime import datetime
+import argparse
+import time
 
+from detection import AdaptiveDetector, configured_target_ms
+from gallery import load_gallery
+from gallery_index import attach_index
+import metrics
+from motion import MotionGate, load_rois
+from pipeline import FrameGrabber, StageStats, WorkerPool
+from prototypes import apply_gallery_mode
+from tracking import FaceTracker
 
-def realtime_face_recognition():
-    """Real-time face recognition from webcam"""
+# Optical-flow tracking runs on a quarter-size grayscale frame
+TRACK_SCALE = 0.25
+# Detect anyway after this many frames without motion
+IDLE_DETECT_EVERY = 150
+
+
+def make_inference_handler(gallery, detector):
+    """Inference worker jobs, run off the render thread (boxes in full frame coordinates):
+    
+    ("detect", frame_id, rgb_frame) -> ("detect", frame_id, rgb_frame, face_locations)
+    ("encode", frame_id, rgb_frame, [(track_id, box)]) -> ("encode", frame_id, [(track_id, match)])
+    """
+    
+    import face_recognition
+    
+    def handle(job):
+        kind, frame_id, rgb_frame = job[:3]
+        if kind == "detect":
+            with metrics.timed("detect"):
+                face_locations = detector.detect(rgb_frame, refine=False)
+            metrics.FACES_PER_IMAGE.observe(len(face_locations))
+            return kind, frame_id, rgb_frame, face_locations
+        
+        # Encode on the full resolution frame, whatever scale the face was detected at
+        wanted = job[3]
+        with metrics.timed("encode"):
+            face_encodings = face_recognition.face_encodings(rgb_frame, [box for _, box in wanted])
+        with metrics.timed("match"):
+            matches = gallery.match_faces(face_encodings, tolerance=0.6)
+        return kind, frame_id, [(track_id, match) for (track_id, _), match in zip(wanted, matches)]
+    
+    return handle
+
+
+def pipeline_report(grabber, inference, render_stats):
+    """Per-stage FPS and queue depths / drops"""
+    return (f"capture {grabber.stats.rate():.1f} fps | "
+            f"inference {inference.stats.rate():.1f} jobs/s | "
+            f"render {render_stats.rate():.1f} fps | "
+            f"jobs queued {len(inference.jobs)}/{inference.jobs.maxsize} (dropped {inference.jobs.dropped}) | "
+            f"frames dropped {grabber.frames.dropped}")
+
+
+def realtime_face_recognition(source=0, headless=False, workers=2,
+                              detect_every_n_frames=10, target_ms=None,
+                              report_every=5.0):
+    """Real-time face recognition from webcam
+    
+    Runs as three stages: a capture thread that only keeps the newest frame,
+    a pool of inference workers (detection, encoding + matching) fed through
+    drop-oldest queues, and this render loop. Faces are tracked with optical
+    flow on every rendered frame, so a slow detection never stalls the display.
+    Detection runs every detect_every_n_frames frames while faces are tracked;
+    encoding only for new tracks or tracks whose identity has gone stale.
+    Detections arrive a few frames late: they are moved forward to the current
+    frame before they are matched to tracks, and faces are encoded from the
+    frame they were detected on, with the boxes they had there.
+    
+    The detection resolution and, with nobody tracked, how often detection
+    runs adapt to the target_ms budget (DETECT_TARGET_MS) and the size of the
+    faces seen recently: large faces are searched for on a small frame,
+    small or no faces on a finer one. Detection is skipped while nothing
+    moves (inside the ROI_CONFIG regions for CAMERA_ID, if configured).
+    """
+    
+    started = time.perf_counter()
     
-    # Load encodings
+    # Load encodings (mapped, so a quantized index keeps the float32 rows on disk)
     print("Loading face encodings...")
-    with open("encodings.pkl", "rb") as f:
-        loaded_encodings = pickle.load(f)
+    gallery = load_gallery(mmap=True)
+    attach_index(gallery)
+    gallery = apply_gallery_mode(gallery)
     
-    print(f"Loaded {len(loaded_encodings['encodings'])} encodings")
-    print(f"Known people: {set(loaded_encodings['names'])}")
+    print(f"Loaded {len(gallery)} encodings")
+    print(f"Known people: {set(gallery.known_people)}")
     
-    # Open webcam
-    video_capture = cv2.VideoCapture(0)
+    # Open webcam (or video file / stream URL)
+    grabber = FrameGrabber(source)
     
-    if not video_capture.isOpened():
+    if not grabber.is_opened():
         print("Error: Could not open webcam")
         return
     
-    print("\nStarting real-time face recognition...")
-    print("Press 'q' to quit, 'd' to toggle debug info")
+    detector = AdaptiveDetector(configured_target_ms(100) if target_ms is None else target_ms)
+    inference = WorkerPool(make_inference_handler(gallery, detector), workers=workers)
+    render_stats = StageStats("render")
+    gate = MotionGate(rois=load_rois(), force_every=IDLE_DETECT_EVERY)
+    metrics.GALLERY_SIZE.set(len(gallery))
+    metrics.QUEUE_DEPTH.set_function(lambda: len(inference.jobs), "inference")
+    metrics.QUEUE_DEPTH.set_function(lambda: len(inference.results), "results")
+    grabber.start()
     
-    show_debug = True
-    frame_count = 0
-    process_every_n_frames = 3  # Process every 3rd frame for performance
+    print(f"\nStarting real-time face recognition (ready in {time.perf_counter() - started:.2f}s)...")
+    if headless:
+        print("Headless mode, press Ctrl+C to quit")
+    else:
+        print("Press 'q' to quit, 'd' to toggle debug info")
     
-    # Store last detected faces to avoid blinking
-    last_face_data = []
+    show_debug = True
+    encodes = 0
+    last_detect_frame = 0
+    detect_grays = {}  # frame id -> tracking frame of a detection in flight
+    last_report = time.perf_counter()
+    tracker = FaceTracker()
     
-    while True:
-        ret, frame = video_capture.read()
-        if not ret:
-            break
-        
-        frame_count += 1
-        
-        # Process every Nth frame for performance
-        if frame_count % process_every_n_frames == 0:
-            # Resize frame for faster processing
-            small_frame = cv2.resize(frame, (0, 0), fx=0.25, fy=0.25)
-            rgb_small_frame = cv2.cvtColor(small_frame, cv2.COLOR_BGR2RGB)
+    try:
+        while True:
+            item = grabber.read(timeout=1.0)
+            if item is None:
+                if grabber.finished.is_set():
+                    break
+                continue
+            frame_id, frame = item
             
-            # Find faces
-            face_locations = face_recognition.face_locations(rgb_small_frame)
-            face_encodings = face_recognition.face_encodings(rgb_small_frame, face_locations)
+            # Resize frame for faster tracking
+            small_frame = cv2.resize(frame, (0, 0), fx=TRACK_SCALE, fy=TRACK_SCALE)
+            gray_small_frame = cv2.cvtColor(small_frame, cv2.COLOR_BGR2GRAY)
             
-            # Clear and rebuild face data
-            last_face_data = []
+            # Move existing boxes with optical flow (cheap, every frame)
+            lost = tracker.propagate(gray_small_frame)
+            moved = gate.check(gray_small_frame)
             
-            # Process each face
-            for (top, right, bottom, left), face_encoding in zip(face_locations, face_encodings):
-                # Scale back up face locations
-                top *= 4
-                right *= 4
-                bottom *= 4
-                left *= 4
-                
-                # Match faces
-                matches = face_recognition.compare_faces(
-                    loaded_encodings["encodings"], 
-                    face_encoding,
-                    tolerance=0.6
-                )
+            # Apply whatever the inference workers finished since the last frame
+            for result in inference.results.drain():
+                if result[0] == "detect":
+                    _, detect_frame_id, rgb_detect_frame, face_locations = result
+                    tracker.update_detections([[v * TRACK_SCALE for v in location]
+                                               for location in face_locations
+                                               if gate.contains(location, rgb_detect_frame.shape)],
+                                              gray=detect_grays.pop(detect_frame_id, None))
+                    
+                    # Encode + match only tracks that need an identity, with their
+                    # boxes in the frame the faces were detected on
+                    stale = [track for track in tracker.needs_identity() if track.detection is not None]
+                    if stale:
+                        tracker.mark_pending(stale)
+                        inference.submit(("encode", detect_frame_id, rgb_detect_frame,
+                                          [(track.id, track.detected_location(scale=1 / TRACK_SCALE))
+                                           for track in stale]))
+                else:
+                    for track_id, match in result[2]:
+                        track = tracker.get(track_id)
+                        if track is not None:  # may have been dropped meanwhile
+                            track.set_identity(match)
+                            encodes += 1
+            
+            # Detect as often as the budget allows while searching, every Nth frame while
+            # tracking, at once when a track was lost; skipped while nothing moves or the
+            # workers are busy
+            interval = detector.detect_interval(render_stats.rate())
+            if tracker.tracks:
+                interval = max(interval, detect_every_n_frames)
+            due = lost or (moved and frame_id - last_detect_frame >= interval)
+            if due and inference.in_flight() < workers:
+                rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+                inference.submit(("detect", frame_id, rgb_frame))
+                detect_grays[frame_id] = gray_small_frame
+                if len(detect_grays) > 4 * workers:
+                    del detect_grays[min(detect_grays)]  # its job was dropped from the queue
+                last_detect_frame = frame_id
+            
+            # Scale back up face locations of every identified track
+            last_face_data = [{
+                'location': track.location(scale=1 / TRACK_SCALE),
+                'name': f"#{track.id} {track.name}",
+                'confidence': track.confidence
+            } for track in tracker.tracks if track.name is not None]
+            render_stats.tick()
+            
+            now = time.perf_counter()
+            if now - last_report >= report_every:
+                last_report = now
+                print(pipeline_report(grabber, inference, render_stats))
+                print(f"detection {detector.stats()} every {interval} frame(s), motion {gate.stats()}")
+                metrics.write_textfile()  # METRICS_TEXTFILE, if set
+                if headless:
+                    for face_data in last_face_data:
+                        print(f"  - {face_data['name']} ({face_data['confidence']:.1f}%)")
+            
+            if headless:
+                continue
+            
+            # Draw all tracked faces (prevents blinking)
+            for face_data in last_face_data:
+                top, right, bottom, left = face_data['location']
+                name = face_data['name']
+                confidence = face_data['confidence']
                 
-                name = "Unknown"
-                confidence = 0
+                # Draw box and label
+                color = (0, 255, 0) if not name.endswith("Unknown") else (0, 0, 255)
+                cv2.rectangle(frame, (left, top), (right, bottom), color, 3)
                 
-                if True in matches:
-                    face_distances = face_recognition.face_distance(
-                        loaded_encodings["encodings"], 
-                        face_encoding
-                    )
-                    best_match_index = np.argmin(face_distances)
-                    if matches[best_match_index]:
-                        name = loaded_encodings["names"][best_match_index]
-                        confidence = (1 - face_distances[best_match_index]) * 100
+                # Draw label background with more height
+                label_height = 40
+                cv2.rectangle(frame, (left, bottom), (right, bottom + label_height), color, cv2.FILLED)
                 
-                # Store face data for continuous display
-                last_face_data.append({
-                    'location': (top, right, bottom, left),
-                    'name': name,
-                    'confidence': confidence
-                })
-        
-        # Draw all faces from last detection (prevents blinking)
-        for face_data in last_face_data:
-            top, right, bottom, left = face_data['location']
-            name = face_data['name']
-            confidence = face_data['confidence']
+                # Put text with better visibility
+                label = f"{name} ({confidence:.1f}%)"
+                cv2.putText(frame, label, (left + 8, bottom + 28), 
+                           cv2.FONT_HERSHEY_DUPLEX, 0.7, (255, 255, 255), 2)
             
-            # Draw box and label
-            color = (0, 255, 0) if name != "Unknown" else (0, 0, 255)
-            cv2.rectangle(frame, (left, top), (right, bottom), color, 3)
+            # Debug info on frame
+            if show_debug:
+                debug_text = f"Faces: {len(last_face_data)} | Frame: {frame_id} | Encodes: {encodes}"
+                cv2.putText(frame, debug_text, (10, 30), 
+                           cv2.FONT_HERSHEY_SIMPLEX, 0.8, (0, 255, 255), 2)
+                cv2.putText(frame, pipeline_report(grabber, inference, render_stats), (10, 60),
+                           cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 255), 1)
+                last = detector.stats()
+                detect_text = (f"detect x{last.get('scale', 1)} up{last.get('upsample', 0)} "
+                               f"{last.get('ms', 0)} ms every {interval} frame(s)")
+                cv2.putText(frame, detect_text, (10, 85),
+                           cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 255), 1)
             
-            # Draw label background with more height
-            label_height = 40
-            cv2.rectangle(frame, (left, bottom), (right, bottom + label_height), color, cv2.FILLED)
+            # Display frame
+            cv2.imshow('Real-time Face Recognition', frame)
             
-            # Put text with better visibility
-            label = f"{name} ({confidence:.1f}%)"
-            cv2.putText(frame, label, (left + 8, bottom + 28), 
-                       cv2.FONT_HERSHEY_DUPLEX, 0.7, (255, 255, 255), 2)
-        
-        # Debug info on frame
-        if show_debug:
-            debug_text = f"Faces: {len(last_face_data)} | Frame: {frame_count}"
-            cv2.putText(frame, debug_text, (10, 30), 
-                       cv2.FONT_HERSHEY_SIMPLEX, 0.8, (0, 255, 255), 2)
-        
-        # Display frame
-        cv2.imshow('Real-time Face Recognition', frame)
-        
-        # Handle key presses
-        key = cv2.waitKey(1) & 0xFF
-        if key == ord('q'):
-            break
-        elif key == ord('d'):
-            show_debug = not show_debug
+            # Handle key presses
+            key = cv2.waitKey(1) & 0xFF
+            if key == ord('q'):
+                break
+            elif key == ord('d'):
+                show_debug = not show_debug
+    except KeyboardInterrupt:
+        pass
     
     # Cleanup
-    video_capture.release()
-    cv2.destroyAllWindows()
+    grabber.stop()
+    inference.stop()
+    if not headless:
+        cv2.destroyAllWindows()
+    print(pipeline_report(grabber, inference, render_stats))
     print("\nStopped real-time recognition")
 
 
 if __name__ == "__main__":
-    realtime_face_recognition()
+    parser = argparse.ArgumentParser(description="Real-time face recognition")
+    parser.add_argument("--source", default="0", help="camera index, video file or stream URL")
+    parser.add_argument("--headless", action="store_true", help="no window, print stats and faces instead")
+    parser.add_argument("--workers", type=int, default=2, help="inference worker threads")
+    parser.add_argument("--detect-every", type=int, default=10, help="frames between detections while tracking")
+    parser.add_argument("--target-ms", type=float, default=None,
+                        help="detection latency budget (default: DETECT_TARGET_MS or 100)")
+    args = parser.parse_args()
+    source = int(args.source) if args.source.isdigit() else args.source
+    realtime_face_recognition(source=source, headless=args.headless, workers=args.workers,
+                              detect_every_n_frames=args.detect_every, target_ms=args.target_ms)
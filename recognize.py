@@ -1,65 +1,62 @@
-import face_recognition
-import pickle
 from pathlib import Path
 import cv2
-import numpy as np
 from datetime import datetime
 
+from detection import AdaptiveDetector
+from gallery import load_gallery
+from gallery_index import attach_index
+from imaging import decode_image
+from prototypes import apply_gallery_mode
+
+# Shared across calls so the face sizes of earlier images guide the next detection
+detector = AdaptiveDetector()
+
 def recognize_faces_with_boxes(image_path, output_path=None, show_debug=True):
     """Recognize faces and draw bounding boxes with labels"""
+    import face_recognition
     
-    # Load saved encodings
-    with open("encodings.pkl", "rb") as f:
-        loaded_encodings = pickle.load(f)
+    # Load saved encodings (mapped, so a quantized index keeps the float32 rows on disk)
+    gallery = load_gallery(mmap=True)
+    attach_index(gallery)
+    gallery = apply_gallery_mode(gallery)
     
     if show_debug:
         print(f"\n{'='*50}")
         print(f"FACE RECOGNITION DEBUG - {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
         print(f"{'='*50}")
-        print(f"Loaded {len(loaded_encodings['encodings'])} face encodings")
-        print(f"Known people: {set(loaded_encodings['names'])}")
+        print(f"Loaded {len(gallery)} face encodings")
+        print(f"Known people: {set(gallery.known_people)}")
         print(f"Analyzing image: {image_path}\n")
     
-    # Load image with face_recognition (RGB)
-    image = face_recognition.load_image_file(image_path)
+    # Decode upright, large photos at a reduced size (DECODE_MAX_SIDE); boxes are
+    # drawn and reported on the decoded image
+    decoded = decode_image(image_path)
+    image = decoded.rgb
     
     # Convert to BGR for OpenCV
     image_cv = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
     
-    # Detect faces
-    face_locations = face_recognition.face_locations(image)
+    if show_debug and decoded.scale != 1:
+        print(f"Decoded {decoded.size[0]}x{decoded.size[1]} at {image.shape[1]}x{image.shape[0]}\n")
+    
+    # Detect faces (coarse first, the whole decoded image only if needed), encode on the decoded image
+    face_locations = detector.detect(image)
     face_encodings = face_recognition.face_encodings(image, face_locations)
     
     if show_debug:
-        print(f"Found {len(face_encodings)} face(s) in the image\n")
+        print(f"Found {len(face_encodings)} face(s) in the image")
+        print(f"Detection: {detector.stats()}\n")
+    
+    # Match every face against the gallery in one batched pass
+    matches = gallery.match_faces(face_encodings, tolerance=0.6)
     
     # Process each detected face
-    for i, (face_encoding, face_location) in enumerate(zip(face_encodings, face_locations)):
+    for i, (match, face_location) in enumerate(zip(matches, face_locations)):
         # Get face location coordinates
         top, right, bottom, left = face_location
         
-        # Compare with known faces
-        matches = face_recognition.compare_faces(
-            loaded_encodings["encodings"], 
-            face_encoding,
-            tolerance=0.6
-        )
-        
-        # Calculate face distances
-        face_distances = face_recognition.face_distance(
-            loaded_encodings["encodings"], 
-            face_encoding
-        )
-        
-        # Find best match
-        name = "Unknown"
-        confidence = 0
-        
-        if True in matches:
-            best_match_index = np.argmin(face_distances)
-            if matches[best_match_index]:
-                name = loaded_encodings["names"][best_match_index]
-                confidence = (1 - face_distances[best_match_index]) * 100
+        name = match.name
+        confidence = match.confidence
         
         # Debug output
         if show_debug:
@@ -67,8 +64,8 @@ def recognize_faces_with_boxes(image_path, output_path=None, show_debug=True):
             print(f"  - Location: Top={top}, Right={right}, Bottom={bottom}, Left={left}")
             print(f"  - Identified as: {name}")
             print(f"  - Confidence: {confidence:.2f}%")
-            if len(face_distances) > 0:
-                print(f"  - Best distance: {face_distances[best_match_index]:.4f}")
+            if len(gallery) > 0:
+                print(f"  - Best distance: {match.distance:.4f}")
             print()
         
         # Draw rectangle around face
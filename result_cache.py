@@ -0,0 +1,180 @@
+"""Recognition result cache for the API.
+
+Maps an uploaded image to its complete /recognize result, so a repeated
+frame skips decode, detection, encoding and matching. By default only the
+very same bytes hit: the key is a content hash of the upload, which costs a
+few milliseconds even for a large JPEG.
+
+CACHE_HASH_DISTANCE > 0 opts in to near matches: the key becomes a
+perceptual hash (a difference hash of a small grayscale thumbnail, decoded
+with JPEG draft mode) and images whose hashes differ in at most that many
+bits count as the same image. That also answers re-encoded frames, but a
+frame with a small changed region can get the previous frame's answer.
+Near matches are found through band lookups (split into distance + 1 bands,
+two hashes within the distance share at least one band exactly), not a scan.
+
+The cache is a size-bounded LRU with a TTL. Entries belong to a gallery
+generation and the whole cache is dropped when the generation changes.
+"""
+from collections import OrderedDict
+import hashlib
+import io
+import os
+import threading
+import time
+
+import numpy as np
+from PIL import Image
+
+CACHE_MAX_ENTRIES = int(os.environ.get('CACHE_MAX_ENTRIES', 2048))
+CACHE_MAX_MB = float(os.environ.get('CACHE_MAX_MB', 32))
+CACHE_TTL = float(os.environ.get('CACHE_TTL', 300))
+CACHE_HASH_SIZE = int(os.environ.get('CACHE_HASH_SIZE', 16))  # hash is size*size bits
+CACHE_HASH_DISTANCE = int(os.environ.get('CACHE_HASH_DISTANCE', 0))  # 0: exact bytes only
+BAND_ENTRY_BYTES = 64  # rough size of one band -> fingerprint entry
+
+
+class LRUCache:
+    """Thread-safe LRU with entry count, byte size and TTL limits, tied to a generation."""
+
+    def __init__(self, max_entries=CACHE_MAX_ENTRIES, max_bytes=CACHE_MAX_MB * 2**20, ttl=CACHE_TTL):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.generation = None
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # key -> (value, size, expires)
+        self._lock = threading.Lock()
+
+    def _set_generation(self, generation):
+        if generation != self.generation:
+            self._entries.clear()
+            self.bytes = 0
+            self.generation = generation
+
+    def get(self, key, generation):
+        with self._lock:
+            self._set_generation(generation)
+            entry = self._entries.get(key)
+            if entry is not None and entry[2] < time.monotonic():
+                del self._entries[key]
+                self.bytes -= entry[1]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, size, generation):
+        with self._lock:
+            if generation != self.generation:
+                return  # computed against a gallery that has been swapped out
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.bytes -= old[1]
+            self._entries[key] = (value, size, time.monotonic() + self.ttl)
+            self.bytes += size
+            while self._entries and (len(self._entries) > self.max_entries or self.bytes > self.max_bytes):
+                _, (_, evicted_size, _) = self._entries.popitem(last=False)
+                self.bytes -= evicted_size
+                self.evictions += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'bytes': self.bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+            'evictions': self.evictions
+        }
+
+
+def content_key(data):
+    """Exact cache key: length and hash of the encoded bytes."""
+    return len(data), hashlib.blake2b(data, digest_size=16).digest()
+
+
+def image_fingerprint(data, hash_size=CACHE_HASH_SIZE):
+    """(width, height, difference hash as an int) of an encoded image."""
+    image = Image.open(io.BytesIO(data))
+    size = image.size
+    # JPEGs decode straight at 1/2..1/8 scale, enough for a tiny thumbnail
+    image.draft('L', (hash_size * 8, hash_size * 8))
+    thumb = np.asarray(image.convert('L').resize((hash_size + 1, hash_size), Image.BILINEAR), dtype=np.int16)
+    bits = thumb[:, 1:] > thumb[:, :-1]
+    return size + (int.from_bytes(np.packbits(bits).tobytes(), 'big'),)
+
+
+def similar_images(a, b, max_distance=CACHE_HASH_DISTANCE):
+    """Same size and hashes at most max_distance bits apart."""
+    return a[:2] == b[:2] and bin(a[2] ^ b[2]).count('1') <= max_distance
+
+
+def hash_bands(fingerprint, max_distance, hash_bits):
+    """(band number, size, band bits) keys; hashes within max_distance bits share one."""
+    n_bands = max_distance + 1
+    width = -(-hash_bits // n_bands)
+    mask = (1 << width) - 1
+    return [(i, fingerprint[:2], (fingerprint[2] >> (i * width)) & mask) for i in range(n_bands)]
+
+
+class ResultCache:
+    """Uploaded image (exact bytes, or opt-in perceptual hash) -> /recognize result."""
+
+    def __init__(self, enabled=None, max_distance=CACHE_HASH_DISTANCE, hash_size=CACHE_HASH_SIZE):
+        if enabled is None:
+            enabled = os.environ.get('RESULT_CACHE', '1') != '0'
+        self.enabled = enabled
+        self.max_distance = max_distance
+        self.hash_size = hash_size
+        self.images = LRUCache()
+        # Near mode: band -> fingerprint of the newest image with that band
+        self.bands = LRUCache(max_entries=CACHE_MAX_ENTRIES * (max_distance + 1)) if max_distance else None
+
+    def fingerprint(self, data):
+        """Cache key of an uploaded image, None if caching is off or it doesn't decode."""
+        if not self.enabled:
+            return None
+        if not self.max_distance:
+            return content_key(data)
+        try:
+            return image_fingerprint(data, self.hash_size)
+        except Exception:
+            return None  # the full decode reports the error
+
+    def get_result(self, fingerprint, generation):
+        if fingerprint is None:
+            return None
+        if self.bands is None:
+            return self.images.get(fingerprint, generation)
+        # Candidates sharing a band, checked for the full distance
+        for band in hash_bands(fingerprint, self.max_distance, self.hash_size ** 2):
+            other = self.bands.get(band, generation)
+            if other is not None and similar_images(fingerprint, other, self.max_distance):
+                return self.images.get(other, generation)
+        return self.images.get(fingerprint, generation)  # counts the miss
+
+    def put_result(self, fingerprint, result, generation):
+        if fingerprint is None:
+            return
+        self.images.put(fingerprint, result, len(repr(result)) + 64, generation)
+        if self.bands is not None:
+            for band in hash_bands(fingerprint, self.max_distance, self.hash_size ** 2):
+                self.bands.get(band, generation)  # follows the gallery generation
+                self.bands.put(band, fingerprint, BAND_ENTRY_BYTES, generation)
+
+    def stats(self):
+        return {
+            'enabled': self.enabled,
+            'mode': 'near' if self.bands is not None else 'exact',
+            'generation': self.images.generation,
+            'images': self.images.stats(),
+            'memory_bytes': self.images.bytes + (self.bands.bytes if self.bands is not None else 0)
+        }
@@ -0,0 +1,85 @@
+"""Run a sharded API on one machine: N match-only shard processes plus a front node.
+
+    python shard_cluster.py --shards 3 --port 5000
+
+Each shard process serves shards/<i>-of-<N>/ on --base-port + i; the front
+node on --port detects and encodes, then scatter-gathers the matches (see
+sharding.py). Missing shard directories are split from the current gallery
+first (--split re-splits anyway). Stop everything with Ctrl+C; kill a shard
+process to see the front node answer with partial results.
+"""
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+import requests
+
+from gallery import load_gallery
+from sharding import shard_dir, write_shards
+
+APP = os.path.join(os.path.dirname(os.path.abspath(__file__)), "api", "app.py")
+
+
+def start_node(port, **env):
+    return subprocess.Popen([sys.executable, APP], env=dict(os.environ, PORT=str(port), **env))
+
+
+def wait_ready(url, timeout=120):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if requests.get(f"{url}/readyz", timeout=1).status_code == 200:
+                return True
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    return False
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--shards", type=int, default=3)
+    parser.add_argument("--port", type=int, default=5000, help="front node port")
+    parser.add_argument("--base-port", type=int, default=5101, help="port of shard 0, the others follow")
+    parser.add_argument("--split", action="store_true", help="re-split the current gallery into shards/")
+    args = parser.parse_args()
+
+    dirs = [shard_dir(i, args.shards) for i in range(args.shards)]
+    if args.split or not all(os.path.isdir(path) for path in dirs):
+        gallery = load_gallery()
+        for path, n_faces, n_people in write_shards(gallery, args.shards):
+            print(f"✅ Shard {path}: {n_faces} encodings for {n_people} people")
+
+    nodes = []
+    try:
+        urls = []
+        for i, path in enumerate(dirs):
+            port = args.base_port + i
+            nodes.append(start_node(port, GALLERY_DIR=os.path.abspath(path), MATCH_ONLY="1"))
+            urls.append(f"http://127.0.0.1:{port}")
+        for url in urls:
+            if not wait_ready(url):
+                print(f"❌ Shard {url} did not become ready")
+                return
+
+        front = f"http://127.0.0.1:{args.port}"
+        nodes.append(start_node(args.port, GALLERY_SHARDS=",".join(urls)))
+        if not wait_ready(front):
+            print(f"❌ Front node {front} did not become ready")
+            return
+        print(f"\n✅ Front node at {front} matching against {len(urls)} shards, press Ctrl+C to stop")
+        while nodes[-1].poll() is None:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for node in nodes:
+            node.terminate()
+        for node in nodes:
+            node.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,278 @@
+"""Gallery sharded by identity across API nodes, matched by scatter-gather.
+
+train.py --shards N splits the gallery into N shard directories
+(shards/<i>-of-<N>/, each a complete gallery with its own index and
+prototypes). Every person lives on exactly one shard, chosen by a hash of
+their name, so adding people never moves anyone else and each shard can
+apply per-person tolerances on its own.
+
+Shard nodes are ordinary API processes started with GALLERY_DIR pointing at a
+shard directory (MATCH_ONLY=1 skips loading the face models) and answer
+POST /match: little-endian float32 encodings in, the top-k matches per face
+out. A front node started with GALLERY_SHARDS=<url>,<url>,... detects and
+encodes as usual, then ShardedGallery sends the encodings to every shard at
+once over pooled keep-alive connections and merges the answers.
+
+Shards that miss the SHARD_TIMEOUT_MS deadline or fail are left out of that
+answer (the result is marked partial and not cached) and a failed shard is
+skipped for SHARD_RETRY_SECONDS before it is tried again.
+"""
+from concurrent.futures import ThreadPoolExecutor, wait
+import hashlib
+import os
+import threading
+import time
+
+import numpy as np
+
+from gallery import (DEFAULT_TOLERANCE, ENCODING_DIM, FaceGallery, GALLERY_PATH, Match, UNKNOWN_NAME,
+                     as_queries, save_gallery)
+
+SHARDS_DIR = "shards"
+SHARD_TIMEOUT_MS = float(os.environ.get("SHARD_TIMEOUT_MS", 500))
+SHARD_RETRY_SECONDS = float(os.environ.get("SHARD_RETRY_SECONDS", 5))
+SHARD_POOL_SIZE = int(os.environ.get("SHARD_POOL_SIZE", 8))  # keep-alive connections per shard
+
+
+class ShardsUnavailable(RuntimeError):
+    pass
+
+
+class PartialMatches(list):
+    """Merged matches, plus the shards that did not answer in time."""
+
+    def __init__(self, matches, missing=()):
+        super().__init__(matches)
+        self.missing = list(missing)
+
+
+def shard_of(name, n_shards):
+    """Shard of an identity: stable across runs, processes and gallery changes."""
+    digest = hashlib.blake2b(name.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big") % n_shards
+
+
+def shard_dir(i, n_shards, base_dir="."):
+    return os.path.join(base_dir, SHARDS_DIR, f"{i}-of-{n_shards}")
+
+
+def split_gallery(gallery, n_shards):
+    """One FaceGallery per shard, every person's rows on one shard."""
+    shard_of_label = np.array([shard_of(name, n_shards) for name in gallery.label_names], dtype=np.int32)
+    row_shards = shard_of_label[gallery.labels] if len(gallery) else np.empty(0, dtype=np.int32)
+    shards = []
+    for i in range(n_shards):
+        rows = np.flatnonzero(row_shards == i)
+        names = [gallery.label_names[label] for label in gallery.labels[rows].tolist()]
+        shards.append(FaceGallery.from_names(names, gallery.encodings[rows]))
+    return shards
+
+
+def write_shards(gallery, n_shards, base_dir=".", index_kind=None):
+    """Save each shard as a complete gallery directory (encodings, index, prototypes)."""
+    # Imported here: gallery_index and prototypes are only needed when writing shards
+    from gallery_index import INDEX_PATH, build_index, configured_index_kind, save_index
+    from prototypes import PROTOTYPES_PATH, build_prototypes, save_prototypes
+
+    index_kind = index_kind or configured_index_kind()
+    paths = []
+    for i, shard in enumerate(split_gallery(gallery, n_shards)):
+        path = shard_dir(i, n_shards, base_dir)
+        os.makedirs(path, exist_ok=True)
+        save_gallery(shard, os.path.join(path, GALLERY_PATH))
+        if index_kind != "brute" and len(shard) > 0:
+            save_index(build_index(shard, index_kind), shard, os.path.join(path, INDEX_PATH))
+        save_prototypes(build_prototypes(shard), os.path.join(path, PROTOTYPES_PATH))
+        paths.append((path, len(shard), len(shard.label_names)))
+    return paths
+
+
+def configured_shard_urls():
+    urls = os.environ.get("GALLERY_SHARDS", "")
+    return [url.strip().rstrip("/") for url in urls.split(",") if url.strip()]
+
+
+def encode_queries(face_encodings):
+    """/match request body: the encodings as little-endian float32, row after row."""
+    return as_queries(face_encodings).astype("<f4").tobytes()
+
+
+def decode_queries(data):
+    if len(data) % (4 * ENCODING_DIM):
+        raise ValueError(f"Body must be a multiple of {4 * ENCODING_DIM} bytes (float32 encodings)")
+    queries = np.frombuffer(data, dtype="<f4").reshape(-1, ENCODING_DIM).astype(np.float32)
+    if not np.all(np.isfinite(queries)):
+        raise ValueError("Face encoding is not finite")
+    return queries
+
+
+def match_payload(matcher, queries, k=1, tolerance=DEFAULT_TOLERANCE):
+    """The /match answer of a shard: per face, up to k {name, confidence, distance}.
+
+    k=1 goes through matcher.match_faces, so prototype mode and its per-person
+    tolerances apply; the best entry may be Unknown with its distance.
+    """
+    if k <= 1 or not hasattr(matcher, "match_faces_top_k"):
+        rows = [[match] for match in matcher.match_faces(queries, tolerance=tolerance)]
+    else:
+        rows = matcher.match_faces_top_k(queries, k=k, tolerance=tolerance)
+    return [[{"name": m.name, "confidence": round(float(m.confidence), 4), "distance": float(m.distance)}
+             for m in row if m.distance != float("inf")] for row in rows]
+
+
+class ShardClient:
+    """One shard node: pooled HTTP session plus failure bookkeeping."""
+
+    def __init__(self, url, pool_size=SHARD_POOL_SIZE):
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        self.url = url
+        self.session = requests.Session()
+        self.session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+        self.session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+        self.faces_loaded = 0
+        self.known_people = []
+        self.generation = None  # (gallery_generation, gallery_loaded_at) from /health
+        self.requests = 0
+        self.failures = 0
+        self.timeouts = 0
+        self.last_error = None
+        self.last_ms = None
+        self.down_until = 0.0
+
+    def available(self):
+        return time.monotonic() >= self.down_until
+
+    def mark_failed(self, error):
+        self.failures += 1
+        self.last_error = str(error)
+        self.down_until = time.monotonic() + SHARD_RETRY_SECONDS
+
+    def refresh(self, timeout):
+        """Size and people of the shard from its /health."""
+        response = self.session.get(f"{self.url}/health", timeout=timeout)
+        response.raise_for_status()
+        info = response.json()
+        self.faces_loaded = int(info.get("faces_loaded", 0))
+        self.known_people = list(info.get("known_people", []))
+        self.generation = (info.get("gallery_generation"), info.get("gallery_loaded_at"))
+        self.down_until = 0.0
+        return info
+
+    def match(self, body, k, tolerance, timeout):
+        start = time.perf_counter()
+        self.requests += 1
+        response = self.session.post(f"{self.url}/match", data=body, timeout=timeout,
+                                     params={"k": k, "tolerance": tolerance},
+                                     headers={"Content-Type": "application/octet-stream"})
+        response.raise_for_status()
+        self.last_ms = round((time.perf_counter() - start) * 1000, 3)
+        answer = response.json()
+        self.faces_loaded = answer.get("faces_loaded", self.faces_loaded)
+        return answer["matches"]
+
+    def stats(self):
+        return {
+            "url": self.url,
+            "up": self.available(),
+            "faces_loaded": self.faces_loaded,
+            "generation": self.generation,
+            "requests": self.requests,
+            "failures": self.failures,
+            "timeouts": self.timeouts,
+            "last_ms": self.last_ms,
+            "last_error": self.last_error,
+        }
+
+
+class ShardedGallery:
+    """match_faces() over remote shards, same interface as FaceGallery for the API."""
+
+    def __init__(self, urls, timeout_ms=SHARD_TIMEOUT_MS):
+        if not urls:
+            raise ValueError("No shard URLs (GALLERY_SHARDS)")
+        self.shards = [ShardClient(url) for url in urls]
+        self.timeout = timeout_ms / 1000.0
+        self._pool = ThreadPoolExecutor(max_workers=len(urls) * SHARD_POOL_SIZE, thread_name_prefix="shard")
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        """Ask every shard for its size; raises if none answers."""
+        futures = {self._pool.submit(shard.refresh, max(self.timeout, 2.0)): shard for shard in self.shards}
+        answered = 0
+        for future, shard in futures.items():
+            try:
+                future.result()
+                answered += 1
+            except Exception as e:
+                shard.mark_failed(e)
+                print(f"⚠️  Shard {shard.url} not answering: {e}")
+        if not answered:
+            raise ShardsUnavailable(f"None of the {len(self.shards)} gallery shards answered")
+        return self
+
+    def signature(self):
+        """Polls every shard; changes when any shard reloads its gallery."""
+        self.refresh()
+        return tuple((shard.url, shard.generation) for shard in self.shards)
+
+    def __len__(self):
+        return sum(shard.faces_loaded for shard in self.shards)
+
+    @property
+    def known_people(self):
+        return sorted({name for shard in self.shards for name in shard.known_people})
+
+    def scatter(self, face_encodings, k=1, tolerance=DEFAULT_TOLERANCE):
+        """Per face, every shard's candidates merged nearest first as
+        [(distance, name, confidence)], and the URLs of the shards that are missing."""
+        queries = as_queries(face_encodings)
+        body = encode_queries(queries)
+        deadline = time.monotonic() + self.timeout
+        live = [shard for shard in self.shards if shard.available()]
+        futures = {self._pool.submit(shard.match, body, k, tolerance, self.timeout): shard for shard in live}
+        done, late = wait(futures, timeout=max(deadline - time.monotonic(), 0))
+
+        merged = [[] for _ in queries]
+        missing = [shard.url for shard in self.shards if shard not in live]
+        for future in late:
+            # Left running; its connection goes back to the pool when it finishes
+            shard = futures[future]
+            with self._lock:
+                shard.timeouts += 1
+            missing.append(shard.url)
+        for future in done:
+            shard = futures[future]
+            try:
+                rows = future.result()
+            except Exception as e:
+                with self._lock:
+                    shard.mark_failed(e)
+                missing.append(shard.url)
+                continue
+            for candidates, row in zip(merged, rows):
+                candidates += [(m["distance"], m["name"], m["confidence"]) for m in row]
+
+        if len(missing) == len(self.shards):
+            raise ShardsUnavailable(f"No gallery shard answered within {self.timeout * 1000:.0f} ms")
+        return [sorted(candidates) for candidates in merged], missing
+
+    def match_faces(self, face_encodings, tolerance=DEFAULT_TOLERANCE):
+        """Nearest of the shards' best matches, as one unsharded gallery would answer."""
+        if len(face_encodings) == 0:
+            return PartialMatches([])
+        rows, missing = self.scatter(face_encodings, 1, tolerance)
+        matches = []
+        for candidates in rows:
+            distance, name, confidence = candidates[0] if candidates else (float("inf"), UNKNOWN_NAME, 0.0)
+            matches.append(Match(name, confidence, distance, -1))
+        return PartialMatches(matches, missing)
+
+    def match_faces_top_k(self, face_encodings, k=5, tolerance=DEFAULT_TOLERANCE):
+        rows, _ = self.scatter(face_encodings, k, tolerance)
+        return [[Match(name, confidence, d, -1) for d, name, confidence in candidates if name != UNKNOWN_NAME][:k]
+                for candidates in rows]
+
+    def stats(self):
+        return [shard.stats() for shard in self.shards]
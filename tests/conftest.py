@@ -0,0 +1,37 @@
+"""Shared fixtures; the modules live at the repository root."""
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from gallery import ENCODING_DIM, FaceGallery  # noqa: E402
+
+
+def synthetic_faces(n_people=40, per_person=5, seed=0):
+    """Clustered encodings like dlib's: ~0.3 apart within a person, ~1.4 across people."""
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(0, 0.09, (n_people, ENCODING_DIM)).astype(np.float32)
+    names, encodings = [], []
+    for i, center in enumerate(centers):
+        names += [f"person_{i:03d}"] * per_person
+        encodings.append(center + rng.normal(0, 0.02, (per_person, ENCODING_DIM)).astype(np.float32))
+    return names, np.concatenate(encodings), centers
+
+
+@pytest.fixture
+def gallery():
+    names, encodings, _ = synthetic_faces()
+    return FaceGallery.from_names(names, encodings)
+
+
+@pytest.fixture
+def queries():
+    """Fresh samples of every person in the gallery fixture, plus two strangers."""
+    rng = np.random.default_rng(1)
+    _, _, centers = synthetic_faces()
+    known = centers + rng.normal(0, 0.02, centers.shape).astype(np.float32)
+    strangers = rng.normal(0, 0.09, (2, ENCODING_DIM)).astype(np.float32)
+    return np.concatenate([known, strangers])
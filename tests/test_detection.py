@@ -0,0 +1,38 @@
+import sys
+import types
+
+import numpy as np
+import pytest
+
+from detection import COARSE_SIDE, AdaptiveDetector
+
+
+@pytest.fixture(autouse=True)
+def fake_face_recognition(monkeypatch):
+    """face_locations finding one face covering the middle half of any image."""
+    module = types.ModuleType("face_recognition")
+
+    def face_locations(image, number_of_times_to_upsample=1, model="hog"):
+        h, w = image.shape[:2]
+        return [(h // 4, 3 * w // 4, 3 * h // 4, w // 4)]
+    module.face_locations = face_locations
+    monkeypatch.setitem(sys.modules, "face_recognition", module)
+
+
+def test_shared_history_plans_from_recent_faces():
+    detector = AdaptiveDetector(target_ms=10_000, adaptive=True)
+    close_up = np.zeros((1200, 1600, 3), dtype=np.uint8)
+    coarse = detector.plan(close_up.shape)
+    assert coarse == pytest.approx(COARSE_SIDE / 1600)
+    detector.detect(close_up)
+    # Half-height faces seen: the next frame is searched coarser still
+    assert detector.plan(close_up.shape) < coarse
+
+
+def test_without_history_every_image_is_planned_on_its_own():
+    detector = AdaptiveDetector(target_ms=10_000, adaptive=True, face_history=False)
+    image = np.zeros((1200, 1600, 3), dtype=np.uint8)
+    first = detector.plan(image.shape)
+    assert len(detector.detect(image)) == 1
+    assert detector.plan(image.shape) == first
+    assert detector.stats()["face_history"] is False
@@ -0,0 +1,63 @@
+import pickle
+
+import numpy as np
+
+from gallery import FaceGallery, UNKNOWN_NAME, load_gallery, load_shared_gallery, save_gallery
+
+
+def is_mapped(array):
+    """True if the array is a view into a memory-mapped file, not a copy."""
+    while array is not None:
+        if isinstance(array, np.memmap):
+            return True
+        array = array.base if isinstance(array.base, np.ndarray) else None
+    return False
+
+
+def test_save_load_round_trip(tmp_path, gallery, queries):
+    path = str(tmp_path / "encodings.npz")
+    save_gallery(gallery, path)
+    loaded = load_gallery(path)
+
+    np.testing.assert_array_equal(loaded.encodings, gallery.encodings)
+    np.testing.assert_array_equal(loaded.labels, gallery.labels)
+    assert loaded.label_names == gallery.label_names
+    assert loaded.fingerprint() == gallery.fingerprint()
+    assert loaded.match_faces(queries) == gallery.match_faces(queries)
+
+
+def test_mmap_load_maps_the_file(tmp_path, gallery, queries):
+    path = str(tmp_path / "encodings.npz")
+    save_gallery(gallery, path)
+    mapped = load_gallery(path, mmap=True)
+
+    assert is_mapped(mapped.encodings)
+    assert not mapped.encodings.flags.writeable
+    assert not is_mapped(load_gallery(path).encodings)
+    np.testing.assert_array_equal(mapped.encodings, gallery.encodings)
+    assert mapped.fingerprint() == gallery.fingerprint()
+
+    matches = mapped.match_faces(queries)
+    assert matches == gallery.match_faces(queries)
+    assert [m.name for m in matches[:-2]] == gallery.label_names
+    assert [m.name for m in matches[-2:]] == [UNKNOWN_NAME, UNKNOWN_NAME]
+
+
+def test_empty_gallery_round_trip(tmp_path, queries):
+    path = str(tmp_path / "encodings.npz")
+    save_gallery(FaceGallery.from_names([], []), path)
+    loaded = load_gallery(path, mmap=True)
+    assert len(loaded) == 0
+    assert all(m.name == UNKNOWN_NAME for m in loaded.match_faces(queries))
+
+
+def test_legacy_pickle_is_converted_once_and_mapped(tmp_path, monkeypatch, gallery, queries):
+    monkeypatch.setenv("GALLERY_CACHE_DIR", str(tmp_path / "cache"))
+    with open(tmp_path / "encodings.pkl", "wb") as f:
+        pickle.dump(gallery.to_legacy_dict(), f)
+
+    shared, path = load_shared_gallery(str(tmp_path))
+    assert path.startswith(str(tmp_path / "cache"))
+    assert is_mapped(shared.encodings)
+    assert shared.match_faces(queries) == gallery.match_faces(queries)
+    assert load_shared_gallery(str(tmp_path))[1] == path
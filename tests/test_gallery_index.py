@@ -0,0 +1,76 @@
+import numpy as np
+import pytest
+
+from conftest import synthetic_faces
+from gallery import FaceGallery
+from gallery_index import attach_index, build_index, load_index, save_index
+
+
+@pytest.fixture(scope="module")
+def big_gallery():
+    names, encodings, _ = synthetic_faces(n_people=200, per_person=4, seed=2)
+    return FaceGallery.from_names(names, encodings)
+
+
+@pytest.fixture(scope="module")
+def big_queries(big_gallery):
+    rng = np.random.default_rng(3)
+    rows = rng.choice(len(big_gallery), 100, replace=False)
+    return big_gallery.encodings[rows] + rng.normal(0, 0.02, (100, 128)).astype(np.float32)
+
+
+@pytest.fixture(scope="module")
+def built(big_gallery):
+    """Index of a kind over big_gallery, built once per module (HNSW builds take seconds)."""
+    indexes = {}
+
+    def get(kind):
+        if kind not in indexes:
+            indexes[kind] = build_index(big_gallery, kind)
+        return indexes[kind]
+    return get
+
+
+def recall(index, gallery, queries, k):
+    exact, _ = gallery.exact_top_k(queries, k)
+    found, _ = index.search(queries, k)
+    return np.mean([len(set(e) & set(f)) / k for e, f in zip(exact.tolist(), found.tolist())])
+
+
+@pytest.mark.parametrize("kind", ["brute", "ivf", "hnsw"])
+def test_recall_against_exact_top_k(kind, built, big_gallery, big_queries):
+    index = built(kind)
+    assert recall(index, big_gallery, big_queries, 1) == 1.0
+    # The query person's own photos; further neighbours are strangers at near-random distances
+    assert recall(index, big_gallery, big_queries, 4) >= 0.95
+
+
+@pytest.mark.parametrize("kind", ["ivf", "hnsw"])
+def test_distances_are_exact(kind, built, big_gallery, big_queries):
+    idx, dists = built(kind).search(big_queries, 3)
+    expected = np.linalg.norm(big_gallery.encodings[idx] - big_queries[:, None, :], axis=2)
+    np.testing.assert_allclose(dists, expected, rtol=1e-5, atol=1e-6)
+    assert np.all(np.diff(dists, axis=1) >= 0)
+
+
+@pytest.mark.parametrize("kind", ["ivf", "hnsw"])
+def test_saved_index_round_trip(kind, tmp_path, built, big_gallery, big_queries):
+    path = str(tmp_path / "encodings.index.npz")
+    index = built(kind)
+    save_index(index, big_gallery, path)
+
+    loaded = load_index(big_gallery, path)
+    assert loaded.kind == kind
+    for a, b in zip(loaded.search(big_queries, 5), index.search(big_queries, 5)):
+        np.testing.assert_array_equal(a, b)
+
+    # Built from other encodings: ignored
+    other = FaceGallery(big_gallery.encodings[::-1], big_gallery.labels[::-1], big_gallery.label_names)
+    assert load_index(other, path) is None
+
+
+def test_attached_index_matches_like_exact_scan(tmp_path, gallery, queries):
+    exact = gallery.match_faces(queries)
+    attach_index(gallery, str(tmp_path), "hnsw")
+    assert gallery.index is not None
+    assert gallery.match_faces(queries) == exact
@@ -0,0 +1,66 @@
+import numpy as np
+import pytest
+
+from conftest import synthetic_faces
+from gallery import FaceGallery, load_gallery, save_gallery
+from gallery_index import load_index, save_index
+from quantization import Float16Codec, Int8Codec, PQCodec, QuantizedIndex
+
+CODECS = {"fp16": Float16Codec, "int8": Int8Codec, "pq": lambda: PQCodec(m=16)}
+
+
+@pytest.fixture(scope="module")
+def faces():
+    names, encodings, _ = synthetic_faces(n_people=150, per_person=4, seed=4)
+    gallery = FaceGallery.from_names(names, encodings)
+    rng = np.random.default_rng(5)
+    rows = rng.choice(len(gallery), 60, replace=False)
+    return gallery, gallery.encodings[rows] + rng.normal(0, 0.02, (60, 128)).astype(np.float32)
+
+
+@pytest.mark.parametrize("kind", sorted(CODECS))
+def test_rerank_returns_exact_neighbours(kind, faces):
+    gallery, queries = faces
+    index = QuantizedIndex(CODECS[kind](), rerank=32).build(gallery.encodings)
+    idx, dists = index.search(queries, 4)
+    exact_idx, exact_dists = gallery.exact_top_k(queries, 4)
+
+    np.testing.assert_array_equal(idx[:, 0], exact_idx[:, 0])
+    # Re-ranked distances are float32 distances to the original rows, not to the codes
+    expected = np.linalg.norm(gallery.encodings[idx] - queries[:, None, :], axis=2)
+    np.testing.assert_allclose(dists, expected, rtol=1e-5, atol=1e-6)
+    np.testing.assert_allclose(dists[:, 0], exact_dists[:, 0], rtol=1e-5, atol=1e-6)
+
+
+@pytest.mark.parametrize("kind", sorted(CODECS))
+def test_without_rerank_distances_are_approximate(kind, faces):
+    gallery, queries = faces
+    index = QuantizedIndex(CODECS[kind](), rerank=0).build(gallery.encodings)
+    idx, dists = index.search(queries, 1)
+    exact = np.linalg.norm(gallery.encodings[idx[:, 0]] - queries, axis=1)
+    error = np.abs(dists[:, 0] - exact)
+    assert error.max() < {"fp16": 1e-3, "int8": 0.02, "pq": 0.15}[kind]
+    assert kind == "fp16" or error.max() > 1e-6
+
+
+def test_codes_are_smaller_than_float32(faces):
+    gallery, _ = faces
+    sizes = {kind: QuantizedIndex(codec()).build(gallery.encodings).bytes_per_vector
+             for kind, codec in CODECS.items()}
+    assert sizes["fp16"] < 128 * 4
+    assert sizes["int8"] < sizes["fp16"]
+    assert sizes["pq"] == 16
+
+
+@pytest.mark.parametrize("kind", sorted(CODECS))
+def test_saved_index_reranks_against_mapped_gallery(kind, tmp_path, faces):
+    gallery, queries = faces
+    save_gallery(gallery, str(tmp_path / "encodings.npz"))
+    mapped = load_gallery(str(tmp_path / "encodings.npz"), mmap=True)
+    index = QuantizedIndex(CODECS[kind]()).build(mapped.encodings)
+    save_index(index, mapped, str(tmp_path / "encodings.index.npz"))
+
+    loaded = load_index(mapped, str(tmp_path / "encodings.index.npz"))
+    assert loaded.quantized and loaded.kind == kind
+    for a, b in zip(loaded.search(queries, 3), index.search(queries, 3)):
+        np.testing.assert_array_equal(a, b)
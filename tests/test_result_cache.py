@@ -0,0 +1,92 @@
+import io
+import time
+
+import numpy as np
+from PIL import Image
+
+from result_cache import LRUCache, ResultCache
+
+
+def jpeg(array, quality=90):
+    buf = io.BytesIO()
+    Image.fromarray(array).save(buf, format="JPEG", quality=quality)
+    return buf.getvalue()
+
+
+def frame(seed=0):
+    """A smooth gradient with some noise, so re-encoding keeps its perceptual hash."""
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:240, 0:320]
+    base = (x * 0.5 + y * 0.3 + 40 * np.sin(x / 23.0 + seed) * np.cos(y / 17.0)).astype(np.float32)
+    base += rng.normal(0, 2, base.shape)
+    return np.clip(np.stack([base] * 3, axis=-1), 0, 255).astype(np.uint8)
+
+
+def test_exact_mode_hits_only_identical_bytes():
+    cache = ResultCache(enabled=True, max_distance=0)
+    data = jpeg(frame())
+    key = cache.fingerprint(data)
+    assert cache.get_result(key, 1) is None
+    cache.put_result(key, {"faces": []}, 1)
+
+    assert cache.get_result(cache.fingerprint(data), 1) == {"faces": []}
+    # Same picture, different bytes: a miss in the default exact mode
+    assert cache.get_result(cache.fingerprint(jpeg(frame(), quality=80)), 1) is None
+    stats = cache.stats()
+    assert stats["mode"] == "exact"
+    assert (stats["images"]["hits"], stats["images"]["misses"]) == (1, 2)
+
+
+def test_disabled_cache_never_stores():
+    cache = ResultCache(enabled=False)
+    data = jpeg(frame())
+    assert cache.fingerprint(data) is None
+    cache.put_result(cache.fingerprint(data), {"faces": []}, 1)
+    assert cache.get_result(cache.fingerprint(data), 1) is None
+
+
+def test_new_generation_flushes_and_stale_puts_are_dropped():
+    cache = ResultCache(enabled=True, max_distance=0)
+    key = cache.fingerprint(jpeg(frame()))
+    cache.get_result(key, 1)
+    cache.put_result(key, "old gallery", 1)
+
+    assert cache.get_result(key, 2) is None
+    # Computed against generation 1 while generation 2 was already live
+    cache.put_result(key, "old gallery", 1)
+    assert cache.get_result(key, 2) is None
+    cache.put_result(key, "new gallery", 2)
+    assert cache.get_result(key, 2) == "new gallery"
+
+
+def test_lru_limits_and_ttl():
+    lru = LRUCache(max_entries=2, max_bytes=1000, ttl=60)
+    lru.get("a", 0)
+    for key in "abc":
+        lru.put(key, key.upper(), 10, 0)
+    assert lru.get("a", 0) is None
+    assert lru.get("c", 0) == "C"
+    assert lru.stats()["evictions"] == 1
+
+    lru.put("big", "x", 2000, 0)
+    assert lru.get("big", 0) is None
+    assert lru.bytes <= lru.max_bytes
+
+    lru.ttl = 0.01
+    lru.put("d", "D", 10, 0)
+    time.sleep(0.02)
+    assert lru.get("d", 0) is None
+
+
+def test_near_mode_matches_reencoded_frame_but_not_changed_one():
+    cache = ResultCache(enabled=True, max_distance=8)
+    original = frame()
+    key = cache.fingerprint(jpeg(original))
+    cache.get_result(key, 1)
+    cache.put_result(key, "first", 1)
+
+    assert cache.get_result(cache.fingerprint(jpeg(original, quality=70)), 1) == "first"
+    changed = original.copy()
+    changed[:, :110] = 0
+    assert cache.get_result(cache.fingerprint(jpeg(changed)), 1) is None
+    assert cache.stats()["mode"] == "near"
@@ -0,0 +1,76 @@
+import numpy as np
+import pytest
+
+from gallery import UNKNOWN_NAME, load_gallery
+from sharding import (ShardedGallery, ShardsUnavailable, decode_queries, encode_queries, match_payload,
+                      shard_dir, shard_of, split_gallery, write_shards)
+
+N_SHARDS = 3
+
+
+def test_split_keeps_every_person_on_one_shard(gallery):
+    shards = split_gallery(gallery, N_SHARDS)
+    assert sum(len(shard) for shard in shards) == len(gallery)
+    assert sorted(name for shard in shards for name in shard.label_names) == gallery.label_names
+    for i, shard in enumerate(shards):
+        assert all(shard_of(name, N_SHARDS) == i for name in shard.label_names)
+        for name in shard.label_names:
+            np.testing.assert_array_equal(
+                np.sort(shard.encodings[np.array(shard.names) == name], axis=0),
+                np.sort(gallery.encodings[np.array(gallery.names) == name], axis=0))
+
+
+def test_queries_survive_the_wire_format(queries):
+    np.testing.assert_array_equal(decode_queries(encode_queries(queries)), queries)
+    with pytest.raises(ValueError):
+        decode_queries(b"\0" * 5)
+
+
+@pytest.fixture
+def sharded(tmp_path, gallery):
+    """ShardedGallery whose shards answer from galleries written by write_shards, in process."""
+    write_shards(gallery, N_SHARDS, str(tmp_path), index_kind="brute")
+    sharded = ShardedGallery([f"http://shard-{i}" for i in range(N_SHARDS)], timeout_ms=5000)
+    for i, shard in enumerate(sharded.shards):
+        local = load_gallery(f"{shard_dir(i, N_SHARDS, str(tmp_path))}/encodings.npz", mmap=True)
+
+        def match(body, k, tolerance, timeout, local=local):
+            return match_payload(local, decode_queries(body), k, tolerance)
+        shard.match = match
+    return sharded
+
+
+def test_merged_matches_equal_the_unsharded_gallery(sharded, gallery, queries):
+    merged = sharded.match_faces(queries)
+    expected = gallery.match_faces(queries)
+    assert merged.missing == []
+    assert [m.name for m in merged] == [m.name for m in expected]
+    np.testing.assert_allclose([m.distance for m in merged], [m.distance for m in expected], rtol=1e-5)
+    assert [m.name for m in merged[-2:]] == [UNKNOWN_NAME, UNKNOWN_NAME]
+
+
+def test_merged_top_k_equals_the_unsharded_gallery(sharded, gallery, queries):
+    for merged, expected in zip(sharded.match_faces_top_k(queries, k=3, tolerance=2.0),
+                                gallery.match_faces_top_k(queries, k=3, tolerance=2.0)):
+        assert [m.name for m in merged] == [m.name for m in expected]
+        np.testing.assert_allclose([m.distance for m in merged], [m.distance for m in expected], rtol=1e-5)
+
+
+def test_failed_shard_is_reported_missing(sharded, gallery, queries):
+    def down(body, k, tolerance, timeout):
+        raise ConnectionError("shard down")
+    sharded.shards[0].match = down
+
+    merged = sharded.match_faces(queries)
+    assert merged.missing == ["http://shard-0"]
+    on_shard_0 = {name for name in gallery.label_names if shard_of(name, N_SHARDS) == 0}
+    for match, expected in zip(merged, gallery.match_faces(queries)):
+        if expected.name not in on_shard_0:
+            assert match.name == expected.name
+    # Skipped until SHARD_RETRY_SECONDS have passed
+    assert not sharded.shards[0].available()
+
+    for shard in sharded.shards[1:]:
+        shard.match = down
+    with pytest.raises(ShardsUnavailable):
+        sharded.match_faces(queries)
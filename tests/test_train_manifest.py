@@ -0,0 +1,154 @@
+import os
+import pickle
+import sys
+import types
+import zlib
+
+import numpy as np
+import pytest
+
+import train
+from gallery import load_gallery
+
+
+def fake_process_image(path):
+    """process_image without face models: one encoding derived from the file's bytes.
+
+    Files starting with b"bad" fail while a decoder_broken file exists in the
+    working directory, like an image the decoder of the day can't read.
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    if data.startswith(b"bad") and os.path.exists("decoder_broken"):
+        return path, [], {"decode": 0.001}, "cannot identify image file"
+    rng = np.random.default_rng(zlib.crc32(data))
+    return path, [rng.normal(0, 0.09, 128)], {"decode": 0.001, "detect": 0.001, "encode": 0.001}, None
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    """A training/ tree in a scratch working directory, with encoding faked out."""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.delenv("GALLERY_INDEX", raising=False)
+    monkeypatch.setitem(sys.modules, "face_recognition", types.ModuleType("face_recognition"))
+    monkeypatch.setattr(train, "process_image", fake_process_image)
+    for person, image, data in [("alice", "1.jpg", b"alice one"), ("alice", "2.jpg", b"alice two"),
+                                ("bob", "1.jpg", b"bad bob")]:
+        os.makedirs(tmp_path / "training" / person, exist_ok=True)
+        (tmp_path / "training" / person / image).write_bytes(data)
+    return tmp_path
+
+
+@pytest.fixture
+def encoded(monkeypatch):
+    """Image paths run_pipeline was asked to encode, one list per call."""
+    calls = []
+    run_pipeline = train.run_pipeline
+
+    def spy(image_paths, workers=None, checkpoint_path=train.CHECKPOINT_PATH, hashes=None):
+        calls.append(sorted(image_paths))
+        return run_pipeline(image_paths, workers=1, checkpoint_path=checkpoint_path, hashes=hashes)
+    monkeypatch.setattr(train, "run_pipeline", spy)
+    return calls
+
+
+def bob_image():
+    return os.path.join("training", "bob", "1.jpg")
+
+
+def test_failed_image_is_retried_until_it_encodes(workdir, encoded, capsys):
+    (workdir / "decoder_broken").touch()
+    train.train_faces(workers=1)
+    assert load_gallery("encodings.npz").names == ["alice", "alice"]
+    assert bob_image() not in train.load_checkpoint()
+    manifest = train.load_manifest()
+    assert train.file_hash(bob_image()) not in manifest["images"]
+
+    # Unchanged but still failing: asked again, no "up to date" shortcut
+    capsys.readouterr()
+    train.train_faces(workers=1)
+    assert encoded[-1] == [bob_image()]
+    assert "Retrying 1 image(s)" in capsys.readouterr().out
+
+    # Readable now, without the file having changed
+    (workdir / "decoder_broken").unlink()
+    train.train_faces(workers=1)
+    assert encoded[-1] == [bob_image()]
+    assert load_gallery("encodings.npz").names == ["alice", "alice", "bob"]
+
+    calls = len(encoded)
+    train.train_faces(workers=1)
+    assert len(encoded) == calls
+    assert "No changes to train" in capsys.readouterr().out
+    assert not os.path.exists(train.CHECKPOINT_PATH)
+
+
+def test_changed_outputs_rebuild_without_reencoding(workdir, encoded, monkeypatch):
+    train.train_faces(workers=1)
+    assert encoded == [sorted(str(p.relative_to(workdir)) for p in (workdir / "training").rglob("*.jpg"))]
+
+    monkeypatch.setenv("GALLERY_INDEX", "ivf")
+    train.train_faces(workers=1)
+    assert encoded[-1] == []
+    assert os.path.exists("encodings.index.npz")
+    assert train.load_manifest()["outputs"] == {"index": "ivf", "shards": 0}
+
+    train.train_faces(workers=1, shards=2)
+    assert encoded[-1] == []
+    assert sorted(os.listdir("shards")) == ["0-of-2", "1-of-2"]
+
+
+def test_modified_and_deleted_images(workdir, encoded):
+    train.train_faces(workers=1)
+    before = load_gallery("encodings.npz")
+
+    (workdir / "training" / "alice" / "2.jpg").write_bytes(b"alice two, retaken")
+    (workdir / "training" / "bob" / "1.jpg").unlink()
+    train.train_faces(workers=1)
+    assert encoded[-1] == [os.path.join("training", "alice", "2.jpg")]
+    after = load_gallery("encodings.npz")
+    assert after.names == ["alice", "alice"]
+    np.testing.assert_array_equal(after.encodings[0], before.encodings[0])
+    assert not np.array_equal(after.encodings[1], before.encodings[1])
+
+
+def interrupted_run(paths):
+    """Checkpoint records for paths, as left behind by a run that crashed before saving."""
+    train.run_pipeline(paths, workers=1, hashes={path: train.file_hash(path) for path in paths})
+
+
+def test_checkpoint_of_interrupted_run_is_resumed(workdir, encoded, capsys):
+    alice = os.path.join("training", "alice", "1.jpg")
+    interrupted_run([alice])
+    capsys.readouterr()
+    train.train_faces(workers=1)
+    assert "Resuming: 1 image(s) already done" in capsys.readouterr().out
+    assert len(load_gallery("encodings.npz")) == 3
+
+
+def test_file_edited_after_interrupted_run_is_encoded_again(workdir, encoded):
+    alice = os.path.join("training", "alice", "1.jpg")
+    interrupted_run([alice])
+    (workdir / alice).write_bytes(b"alice one, retaken")
+    train.train_faces(workers=1)
+
+    expected = fake_process_image(alice)[1][0]
+    gallery = load_gallery("encodings.npz")
+    np.testing.assert_allclose(gallery.encodings[0], expected, rtol=1e-6)
+    # Stored under the new content, so later runs would never correct it
+    np.testing.assert_allclose(train.load_manifest()["images"][train.file_hash(alice)][0], expected)
+
+
+def test_truncated_checkpoint_record_is_redone(workdir):
+    done = {"a.jpg": [np.zeros(128)], "b.jpg": [np.ones(128)]}
+    with open(train.CHECKPOINT_PATH, "wb") as f:
+        for record in done.items():
+            pickle.dump(record, f)
+        f.write(pickle.dumps(("c.jpg", [np.ones(128)]))[:-20])
+
+    restored = train.load_checkpoint()
+    assert sorted(restored) == ["a.jpg", "b.jpg"]
+    # The partial record was cut off, so new records append after the good ones
+    with open(train.CHECKPOINT_PATH, "ab") as f:
+        pickle.dump(("c.jpg", []), f)
+    assert sorted(train.load_checkpoint()) == ["a.jpg", "b.jpg", "c.jpg"]
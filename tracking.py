@@ -0,0 +1,230 @@
+"""Cheap face tracking between detections for the realtime loop.
+
+Faces are detected every few frames; in between, each box is moved with
+Lucas-Kanade optical flow on a handful of corner points inside it (one
+cv2.calcOpticalFlowPyrLK call for all tracks). Detections come back from the
+workers a few frames late, so they are first moved forward the same way from
+the frame they were detected on to the current one, then associated to tracks
+by IoU so every face keeps a persistent ID. The encoder + gallery match only
+run for tracks that are new or whose identity has gone stale, on the box the
+face had in the detected frame.
+"""
+from itertools import count
+
+import cv2
+import numpy as np
+
+MAX_CORNERS = 20
+MIN_POINTS = 3
+IOU_MATCH = 0.3
+PENDING_TIMEOUT = 30  # frames before an unanswered identity request is asked again
+
+
+class FaceTrack:
+    """One tracked face; box is (top, right, bottom, left) in tracker coordinates."""
+
+    def __init__(self, track_id, box):
+        self.id = track_id
+        self.box = np.asarray(box, dtype=np.float32)
+        self.points = None
+        self.name = None  # None until identified
+        self.confidence = 0.0
+        self.identity_score = 0.0  # confidence in the identity, decays every frame
+        self.frames_since_identified = 0
+        self.missed_detections = 0
+        self.pending_frames = None  # frames since identity was requested, None if not waiting
+        self.detection = None  # box in the frame of the latest detection, None if missed there
+
+    def location(self, scale=1):
+        return _location(self.box, scale)
+
+    def detected_location(self, scale=1):
+        return _location(self.detection, scale)
+
+    def set_identity(self, match):
+        self.name = match.name
+        self.confidence = match.confidence
+        self.identity_score = 1.0
+        self.frames_since_identified = 0
+        self.pending_frames = None
+
+
+class FaceTracker:
+    """Keeps FaceTracks alive across frames and decides when to re-identify them."""
+
+    def __init__(self, max_missed=2, identity_decay=0.99, min_identity=0.5, reidentify_every=90):
+        self.max_missed = max_missed  # detections a track may miss before it is dropped
+        self.identity_decay = identity_decay
+        self.min_identity = min_identity
+        self.reidentify_every = reidentify_every  # frames, even for confident tracks
+        self.tracks = []
+        self._ids = count(1)
+        self._prev_gray = None
+
+    def propagate(self, gray):
+        """Move every track to the new frame with optical flow.
+
+        Returns how many tracks were lost (too few points left to follow).
+        """
+        prev, self._prev_gray = self._prev_gray, gray
+        for track in self.tracks:
+            track.frames_since_identified += 1
+            track.identity_score *= self.identity_decay
+            if track.pending_frames is not None:
+                track.pending_frames += 1
+        if prev is None or not self.tracks:
+            return 0
+
+        for track in self.tracks:
+            if track.points is None or len(track.points) < MIN_POINTS:
+                track.points = _seed_points(prev, track.box)
+        live = [t for t in self.tracks if t.points is not None]
+        if not live:
+            return 0
+
+        points = np.concatenate([t.points for t in live])
+        moved, status, _ = cv2.calcOpticalFlowPyrLK(prev, gray, points, None,
+                                                    winSize=(15, 15), maxLevel=2)
+        start = 0
+        lost = set()
+        for track in live:
+            n = len(track.points)
+            ok = status[start:start + n, 0] == 1
+            old, new = track.points[ok], moved[start:start + n][ok]
+            start += n
+            if len(new) < MIN_POINTS:
+                lost.add(track.id)
+                continue
+            track.box = _moved_box(track.box, old.reshape(-1, 2), new.reshape(-1, 2), gray.shape)
+            track.points = new.reshape(-1, 1, 2)
+        self.tracks = [t for t in self.tracks if t.id not in lost]
+        return len(lost)
+
+    def update_detections(self, boxes, gray=None):
+        """Associate fresh detections with tracks (greedy IoU); returns new tracks.
+
+        gray is the frame the boxes were detected on; if the tracks have moved
+        on since, the boxes are carried forward to the current frame first.
+        Each track's detection is set to its box as detected, or None.
+        """
+        detected = [np.asarray(b, dtype=np.float32) for b in boxes]
+        boxes = detected
+        if gray is not None and self._prev_gray is not None and gray is not self._prev_gray:
+            boxes = _flow_boxes(gray, self._prev_gray, detected)
+        for track in self.tracks:
+            track.detection = None
+        pairs = sorted(((_iou(t.box, b), ti, bi) for ti, t in enumerate(self.tracks)
+                        for bi, b in enumerate(boxes)), reverse=True)
+        matched_tracks, matched_boxes = set(), set()
+        for iou, ti, bi in pairs:
+            if iou < IOU_MATCH:
+                break
+            if ti in matched_tracks or bi in matched_boxes:
+                continue
+            track = self.tracks[ti]
+            track.box = boxes[bi]
+            track.detection = detected[bi]
+            track.points = None  # re-seed inside the corrected box
+            track.missed_detections = 0
+            matched_tracks.add(ti)
+            matched_boxes.add(bi)
+
+        for ti, track in enumerate(self.tracks):
+            if ti not in matched_tracks:
+                track.missed_detections += 1
+        self.tracks = [t for t in self.tracks if t.missed_detections <= self.max_missed]
+
+        new_tracks = []
+        for bi, box in enumerate(boxes):
+            if bi not in matched_boxes:
+                track = FaceTrack(next(self._ids), box)
+                track.detection = detected[bi]
+                new_tracks.append(track)
+        self.tracks += new_tracks
+        return new_tracks
+
+    def needs_identity(self):
+        """Tracks that are new, or whose identity decayed or is due a re-check.
+
+        Tracks with an identity request still in flight (see mark_pending) are
+        left out until it is answered or times out.
+        """
+        return [t for t in self.tracks
+                if (t.pending_frames is None or t.pending_frames >= PENDING_TIMEOUT)
+                and (t.name is None
+                     or t.identity_score < self.min_identity
+                     or t.frames_since_identified >= self.reidentify_every)]
+
+    def mark_pending(self, tracks):
+        for track in tracks:
+            track.pending_frames = 0
+
+    def get(self, track_id):
+        return next((t for t in self.tracks if t.id == track_id), None)
+
+
+def _location(box, scale):
+    top, right, bottom, left = (box * scale).round().astype(int)
+    return int(top), int(right), int(bottom), int(left)
+
+
+def _seed_points(gray, box):
+    top, right, bottom, left = box.round().astype(int)
+    h, w = gray.shape[:2]
+    top, left = max(top, 0), max(left, 0)
+    bottom, right = min(bottom, h), min(right, w)
+    if bottom - top < 4 or right - left < 4:
+        return None
+    mask = np.zeros_like(gray)
+    mask[top:bottom, left:right] = 255
+    return cv2.goodFeaturesToTrack(gray, MAX_CORNERS, 0.01, 2, mask=mask)
+
+
+def _flow_boxes(prev, gray, boxes):
+    """Boxes on prev moved to gray with optical flow; a box without enough points stays put."""
+    seeded = [_seed_points(prev, box) for box in boxes]
+    live = [i for i, points in enumerate(seeded) if points is not None]
+    moved_boxes = list(boxes)
+    if not live:
+        return moved_boxes
+    points = np.concatenate([seeded[i] for i in live])
+    moved, status, _ = cv2.calcOpticalFlowPyrLK(prev, gray, points, None, winSize=(15, 15), maxLevel=3)
+    start = 0
+    for i in live:
+        n = len(seeded[i])
+        ok = status[start:start + n, 0] == 1
+        old, new = seeded[i][ok], moved[start:start + n][ok]
+        start += n
+        if len(new) >= MIN_POINTS:
+            moved_boxes[i] = _moved_box(boxes[i], old.reshape(-1, 2), new.reshape(-1, 2), gray.shape)
+    return moved_boxes
+
+
+def _moved_box(box, old, new, shape):
+    """Shift by the median point motion, scale by the median change in spread."""
+    dx, dy = np.median(new - old, axis=0)
+    scale = 1.0
+    if len(old) >= 2:
+        old_spread = np.linalg.norm(old - old.mean(axis=0), axis=1)
+        new_spread = np.linalg.norm(new - new.mean(axis=0), axis=1)
+        valid = old_spread > 1e-3
+        if valid.any():
+            scale = float(np.clip(np.median(new_spread[valid] / old_spread[valid]), 0.8, 1.25))
+    top, right, bottom, left = box
+    cy, cx = (top + bottom) / 2 + dy, (left + right) / 2 + dx
+    half_h, half_w = (bottom - top) * scale / 2, (right - left) * scale / 2
+    h, w = shape[:2]
+    return np.array([
+        np.clip(cy - half_h, 0, h), np.clip(cx + half_w, 0, w),
+        np.clip(cy + half_h, 0, h), np.clip(cx - half_w, 0, w),
+    ], dtype=np.float32)
+
+
+def _iou(a, b):
+    top, bottom = max(a[0], b[0]), min(a[2], b[2])
+    left, right = max(a[3], b[3]), min(a[1], b[1])
+    inter = max(0.0, bottom - top) * max(0.0, right - left)
+    area_a = (a[2] - a[0]) * (a[1] - a[3])
+    area_b = (b[2] - b[0]) * (b[1] - b[3])
+    union = area_a + area_b - inter
+    return float(inter / union) if union > 0 else 0.0
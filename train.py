@@ -1,10 +1,24 @@
-import face_recognition
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
+import argparse
+import hashlib
 import pickle
 import os
 import csv
+import time
+
+from gallery import ENCODING_DIM, FaceGallery, GALLERY_PATH, save_gallery
+from gallery_index import INDEX_PATH, build_index, configured_index_kind, save_index
+from imaging import decode_image
+import metrics
+from prototypes import PROTOTYPES_PATH, build_prototypes, save_prototypes
+from sharding import write_shards
 
 FOLDER_CSV = "trained_folders.csv"
+CHECKPOINT_PATH = "training_checkpoint.pkl"
+MANIFEST_PATH = "training_manifest.pkl"
+MANIFEST_VERSION = 1
+STAGES = ("decode", "detect", "encode")
 
 
 def load_trained_folders(csv_path=FOLDER_CSV):
@@ -25,47 +39,267 @@ def save_trained_folders(trained, csv_path=FOLDER_CSV):
             writer.writerow([folder])
 
 
-def train_faces(incremental=True):
-    """Train faces and skip folders (people) already trained before."""
+def process_image(path):
+    """Decode, detect and encode one training image (runs in a worker process)."""
+    import face_recognition
+    timings = {}
+    try:
+        start = time.perf_counter()
+        # Upright, and phone photos decoded at a reduced size (DECODE_MAX_SIDE)
+        img = decode_image(path).rgb
+        timings["decode"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        locs = face_recognition.face_locations(img, model="hog")  # Use "cnn" if GPU is available
+        timings["detect"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        codes = face_recognition.face_encodings(img, locs)
+        timings["encode"] = time.perf_counter() - start
+        return path, codes, timings, None
+    except Exception as e:
+        return path, [], timings, str(e)
+
+
+def load_checkpoint(path=CHECKPOINT_PATH, hashes=None):
+    """Per-image results of an interrupted run: {image path: encodings}.
+
+    The checkpoint is a stream of pickled records; a record cut short by a crash
+    is ignored and that image is simply processed again. With hashes
+    ({image path: content hash}), records of a path whose content has changed
+    since, or that carry no hash, are ignored too.
+    """
+    done = {}
+    if not os.path.exists(path):
+        return done
+    with open(path, "r+b") as f:
+        while True:
+            offset = f.tell()
+            try:
+                record = pickle.load(f)
+            except EOFError:
+                break
+            except Exception:
+                # Drop the partial record so new records append after the last good one
+                print("⚠️  Ignoring truncated checkpoint record")
+                f.truncate(offset)
+                break
+            # (path, codes) records predate content hashes in the checkpoint
+            image_path, content_hash, codes = record if len(record) == 3 else (record[0], None, record[1])
+            if hashes is not None and hashes.get(image_path) != content_hash:
+                continue
+            done[image_path] = codes
+    return done
+
+
+def run_pipeline(image_paths, workers=None, checkpoint_path=CHECKPOINT_PATH, hashes=None):
+    """Encode images across a process pool, checkpointing each result in order.
+
+    Returns {image path: encodings} for every path that was processed, including
+    ones restored from the checkpoint of a previous, interrupted run. Images
+    that failed are left out (and out of the checkpoint), so they are retried.
+    hashes ({image path: content hash}) are stored with each checkpoint record,
+    so a file edited after an interrupted run is encoded again.
+    """
+    results = load_checkpoint(checkpoint_path, hashes)
+    pending = [p for p in image_paths if p not in results]
+    if results:
+        print(f"Resuming: {len(image_paths) - len(pending)} image(s) already done in {checkpoint_path}")
+    if not pending:
+        return results
+
+    workers = workers or os.cpu_count() or 1
+    # Only now that there is work: loaded once here, forked workers inherit it
+    import face_recognition  # noqa: F401
+    print(f"Encoding {len(pending)} image(s) with {workers} worker(s)...")
+    stage_totals = dict.fromkeys(STAGES, 0.0)
+    stage_counts = dict.fromkeys(STAGES, 0)
+    failed = 0
+    start = time.perf_counter()
+    with open(checkpoint_path, "ab") as checkpoint, ProcessPoolExecutor(max_workers=workers) as pool:
+        # map() yields in submission order, so the checkpoint and output stay deterministic
+        chunksize = max(1, len(pending) // (workers * 8))
+        for done, (path, codes, timings, error) in enumerate(pool.map(process_image, pending, chunksize=chunksize), 1):
+            if error:
+                failed += 1
+                print(f"⚠️  Skipping {path}, will retry next run: {error}")
+            for stage, seconds in timings.items():
+                stage_totals[stage] += seconds
+                stage_counts[stage] += 1
+                # Observed here, the worker processes have registries of their own
+                metrics.STAGE_SECONDS.observe(seconds, stage)
+            if not error:
+                metrics.FACES_PER_IMAGE.observe(len(codes))
+                results[path] = codes
+                pickle.dump((path, hashes.get(path) if hashes is not None else None, codes), checkpoint)
+                checkpoint.flush()
+            if done % 50 == 0:
+                print(f"  {done}/{len(pending)} images ({done / (time.perf_counter() - start):.1f} img/s)")
+
+    elapsed = time.perf_counter() - start
+    print(f"Encoded {len(pending)} image(s) in {elapsed:.1f}s ({len(pending) / elapsed:.2f} img/s overall, {failed} failed)")
+    for stage in STAGES:
+        if stage_totals[stage] > 0:
+            # Per-core rate: images one worker gets through per second in this stage
+            print(f"  {stage:>6}: {stage_counts[stage] / stage_totals[stage]:.2f} img/s per worker")
+    return results
+
+
+def file_hash(path, chunk_size=1 << 20):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def new_manifest():
+    """Training manifest layout.
+
+    files:  {image path: {"hash", "size", "mtime_ns"}} for every image in training/
+    images: {content hash: encodings}, None for images covered by legacy encodings;
+            images that failed to decode or encode have no entry and are retried
+    legacy: {person: encodings} carried over from an encodings.pkl trained before
+            the manifest existed, when we can't tell which file produced which encoding
+    outputs: {"index", "shards"} the saved gallery files were built with
+    """
+    return {"version": MANIFEST_VERSION, "files": {}, "images": {}, "legacy": {}, "outputs": {}}
+
+
+def load_manifest(path=MANIFEST_PATH):
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as f:
+        manifest = pickle.load(f)
+    if manifest.get("version") != MANIFEST_VERSION:
+        print(f"⚠️  {path} has an unsupported version, ignoring it")
+        return None
+    return manifest
+
 
-    # Load model if exists
-    if incremental and os.path.exists("encodings.pkl"):
-        print("Loading existing encodings...")
-        with open("encodings.pkl", "rb") as f:
-            data = pickle.load(f)
-            names = data["names"]
-            encodings = data["encodings"]
-        print(f"Loaded {len(encodings)} known faces.")
-    else:
-        print("Starting fresh training...")
-        names, encodings = [], []
+def save_manifest(manifest, path=MANIFEST_PATH):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        pickle.dump(manifest, f)
+    os.replace(tmp_path, path)
+
+
+def scan_training(training_root, known_files):
+    """{image path: file entry} for training/<person>/<image>.
+
+    Files whose size and mtime match the manifest reuse the stored hash, so
+    only new or touched files are read.
+    """
+    files = {}
+    for folder in sorted(p for p in training_root.iterdir() if p.is_dir()):
+        for fp in sorted(folder.glob("*")):
+            if not fp.is_file():
+                continue
+            path = str(fp)
+            stat = fp.stat()
+            known = known_files.get(path)
+            if known and known["size"] == stat.st_size and known["mtime_ns"] == stat.st_mtime_ns:
+                files[path] = known
+            else:
+                files[path] = {"hash": file_hash(fp), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+    return files
+
+
+def migrate_legacy_model(manifest, training_root):
+    """Carry an encodings.pkl trained before the manifest existed into the manifest.
+
+    Its encodings are kept per person, and images in folders listed in
+    trained_folders.csv are marked as already covered by them (the old
+    behaviour), so the first manifest run doesn't retrain or drop anyone.
+    """
+    with open("encodings.pkl", "rb") as f:
+        data = pickle.load(f)
+    for name, code in zip(data["names"], data["encodings"]):
+        manifest["legacy"].setdefault(name, []).append(code)
 
-    # Load which folders (names) are already trained
     trained_folders = load_trained_folders()
-    print(f"Already trained folders: {trained_folders or 'None'}")
+    covered = scan_training(training_root, {})
+    for path, entry in covered.items():
+        if Path(path).parent.name in trained_folders:
+            manifest["files"][path] = entry
+            manifest["images"][entry["hash"]] = None
+    print(f"Migrated {len(data['encodings'])} legacy encodings for {len(manifest['legacy'])} people into {MANIFEST_PATH}")
+
+
+def train_faces(incremental=True, workers=None, forget=(), shards=0):
+    """Train faces, only (re)processing images that were added or changed.
 
+    The training manifest records, per image content hash, the encodings it
+    produced. Unchanged images reuse them, modified and new images are
+    encoded, and encodings of deleted images are dropped.
+    
+    With shards > 1 the gallery is also split by person into shards/<i>-of-<N>/
+    for sharded API nodes (see sharding.py).
+    """
     training_root = Path("training")
-    new_folders = [p for p in training_root.iterdir() if p.is_dir() and p.name not in trained_folders]
 
-    if not new_folders:
-        print("No new folders to train. Everything is up to date.")
+    manifest = load_manifest() if incremental else None
+    migrated = False
+    if manifest is None:
+        manifest = new_manifest()
+        if incremental and os.path.exists("encodings.pkl"):
+            print("Loading existing encodings...")
+            migrate_legacy_model(manifest, training_root)
+            migrated = True
+        else:
+            print("Starting fresh training...")
+
+    forgotten = [name for name in forget if manifest["legacy"].pop(name, None) is not None]
+    for name in forgotten:
+        print(f"Forgot legacy encodings of '{name}'")
+
+    old_files = manifest["files"]
+    files = scan_training(training_root, old_files)
+    added = [p for p in files if p not in old_files]
+    modified = [p for p in files if p in old_files and old_files[p]["hash"] != files[p]["hash"]]
+    deleted = [p for p in old_files if p not in files]
+    print(f"Images: {len(added)} added, {len(modified)} modified, {len(deleted)} deleted, "
+          f"{len(files) - len(added) - len(modified)} unchanged")
+
+    # Encode one file per content hash we have no encodings for yet (new,
+    # modified, or failed last time)
+    images = manifest["images"]
+    pending = {}
+    for path, entry in files.items():
+        if entry["hash"] not in images:
+            pending.setdefault(entry["hash"], path)
+    retries = len([h for h, path in pending.items() if path not in added and path not in modified])
+    if retries:
+        print(f"Retrying {retries} image(s) that failed before")
+
+    index_kind = configured_index_kind()
+    outputs = {"index": index_kind, "shards": shards if shards > 1 else 0}
+    if (not (added or modified or deleted or forgotten or pending or migrated)
+            and manifest.get("outputs") == outputs and os.path.exists("encodings.pkl")):
+        print("No changes to train. Everything is up to date.")
         return
 
-    for folder in new_folders:
-        person_name = folder.name
-        print(f"\nTraining new folder: {person_name}")
+    results = run_pipeline(list(pending.values()), workers=workers,
+                           hashes={path: content_hash for content_hash, path in pending.items()})
+    for content_hash, path in pending.items():
+        if path in results:
+            images[content_hash] = results[path]
 
-        for fp in folder.glob("*"):
-            if fp.is_file():
-                img = face_recognition.load_image_file(fp)
-                locs = face_recognition.face_locations(img, model="hog")  # Use "cnn" if GPU is available
-                codes = face_recognition.face_encodings(img, locs)
-                for code in codes:
-                    names.append(person_name)
-                    encodings.append(code)
+    # Drop encodings no remaining file refers to
+    live = {entry["hash"] for entry in files.values()}
+    manifest["images"] = {h: codes for h, codes in images.items() if h in live}
+    manifest["files"] = files
 
-        trained_folders.add(person_name)
-        print(f"Trained folder '{person_name}' with {len(list(folder.glob('*')))} images.")
+    names, encodings = [], []
+    for person_name, codes in sorted(manifest["legacy"].items()):
+        names += [person_name] * len(codes)
+        encodings += codes
+    for path, entry in files.items():
+        codes = manifest["images"].get(entry["hash"]) or []
+        names += [Path(path).parent.name] * len(codes)
+        encodings += codes
+    trained_folders = set(names)
+    print(f"Gallery has {len(encodings)} encodings for {len(trained_folders)} people.")
 
     # Save updated encodings
     out = {"names": names, "encodings": encodings}
@@ -73,10 +307,56 @@ def train_faces(incremental=True):
         pickle.dump(out, f)
     print("✅ Updated model saved as encodings.pkl")
 
+    # Compact gallery (float32 matrix + labels) used by the recognizers
+    gallery = FaceGallery.from_names(names, encodings)
+    save_gallery(gallery, GALLERY_PATH)
+    print(f"✅ Compact gallery saved as {GALLERY_PATH}")
+    metrics.GALLERY_SIZE.set(len(gallery))
+
+    # Nearest-neighbour index for the configured GALLERY_INDEX (brute needs none)
+    if index_kind != "brute" and len(gallery) > 0:
+        index = build_index(gallery, index_kind)
+        save_index(index, gallery, INDEX_PATH)
+        print(f"✅ {index_kind} index saved as {INDEX_PATH}")
+        if getattr(index, "quantized", False):
+            print(f"   {index.bytes_per_vector} bytes per face instead of {gallery.encodings.itemsize * ENCODING_DIM}")
+
+    # Per-person prototypes and tolerances for GALLERY_MODE=prototype
+    protos = build_prototypes(gallery)
+    save_prototypes(protos, PROTOTYPES_PATH)
+    print(f"✅ {len(protos.prototypes)} prototypes for {len(gallery.label_names)} people saved as {PROTOTYPES_PATH}")
+
+    # One complete gallery directory per shard node
+    if shards > 1:
+        for path, n_faces, n_people in write_shards(gallery, shards, index_kind=index_kind):
+            print(f"✅ Shard {path}: {n_faces} encodings for {n_people} people")
+
     # Save updated trained folder list
     save_trained_folders(trained_folders)
     print(f"✅ Updated folder list saved in {FOLDER_CSV}")
 
+    # Manifest last, so a crash above means the next run redoes the save
+    manifest["outputs"] = outputs
+    save_manifest(manifest)
+    print(f"✅ Training manifest saved as {MANIFEST_PATH}")
+
+    # Everything is saved, the per-image checkpoint is no longer needed
+    if os.path.exists(CHECKPOINT_PATH):
+        os.remove(CHECKPOINT_PATH)
+
+    if metrics.write_textfile():
+        print(f"✅ Metrics written to {metrics.TEXTFILE}")
+
 
 if __name__ == "__main__":
-    train_faces(incremental=True)
+    parser = argparse.ArgumentParser(description="Train face encodings from training/")
+    parser.add_argument("--workers", type=int, default=int(os.environ.get("TRAIN_WORKERS", 0)) or None,
+                        help="worker processes (default: TRAIN_WORKERS or all cores)")
+    parser.add_argument("--full", action="store_true",
+                        help="ignore the manifest and existing encodings, retrain every image")
+    parser.add_argument("--forget", nargs="+", default=[], metavar="PERSON",
+                        help="drop legacy encodings of these people (delete their training folder to drop the rest)")
+    parser.add_argument("--shards", type=int, default=int(os.environ.get("GALLERY_SHARD_COUNT", 0)),
+                        help="also split the gallery by person into this many shards/ for sharded API nodes")
+    args = parser.parse_args()
+    train_faces(incremental=not args.full, workers=args.workers, forget=args.forget, shards=args.shards)